@@ -1,5 +1,7 @@
+import asyncio
 import pytest
 from starlette.config import environ
+import starlette.responses
 
 environ["DATABASE_URL"] = "sqlite:///"
 
@@ -9,13 +11,52 @@ from crawl_rss import appconfig
 
 @pytest.fixture
 def connection():
-    connection = appconfig.engine.connect()
+    connection = appconfig.get_engine().connect()
     tx = connection.begin()
     appconfig.metadata.create_all(connection)
     yield connection
     tx.rollback()
 
 
+@pytest.fixture
+def engine(monkeypatch, tmp_path):
+    """
+    A database which the app can reach from any of its threads, unlike the
+    in-memory one in the `connection` fixture.
+    """
+
+    engine = appconfig._create_engine(f"sqlite:///{tmp_path / 'db.sqlite'}")
+    appconfig.metadata.create_all(engine)
+    monkeypatch.setattr(appconfig, "_engine", engine)
+    return engine
+
+
+@pytest.fixture(autouse=True)
+def wrap_coroutines(monkeypatch):
+    """
+    Starlette 0.13 streams responses by passing bare coroutines to
+    asyncio.wait, which Python 3.11 refuses, so wrap them in tasks first.
+    """
+
+    async def run_until_first_complete(*args):
+        tasks = [asyncio.ensure_future(handler(**kwargs)) for handler, kwargs in args]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            task.result()
+
+    monkeypatch.setattr(
+        starlette.responses, "run_until_first_complete", run_until_first_complete
+    )
+
+
+@pytest.fixture
+def non_mocked_hosts():
+    "Send requests for the app to the app, not to pytest-httpx."
+    return ["app.test"]
+
+
 def pytest_collection_modifyitems(items):
     "Don't type-check source files which only contain tests."
 
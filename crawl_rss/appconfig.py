@@ -1,6 +1,14 @@
+from concurrent.futures import Executor, ProcessPoolExecutor
+import datetime
 import os
 import sqlalchemy
+from sqlalchemy.engine import Connection, Engine
 from starlette.config import Config
+import threading
+from typing import Any, List, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import httpx
 
 
 config = Config(".env")
@@ -9,21 +17,102 @@ DEBUG = config("DEBUG", cast=bool, default=False)
 DATABASE_URL = config("DATABASE_URL", default="sqlite:///db.sqlite")
 HTTP_PROXY = config("HTTP_PROXY", default=None)
 
-# https://www.python-httpx.org/environment_variables/#httpx_log_level
-if DEBUG:
-    os.environ["HTTPX_LOG_LEVEL"] = "debug"
+# An optional read-only replica of the database, for requests which only list
+# posts. Crawls always read and write the primary at DATABASE_URL. When
+# READ_YOUR_WRITES is set, the redirect after a crawl tells the reader which
+# generation of the feed it produced, and if the replica hasn't caught up to
+# that yet, the reader uses the primary instead.
+DATABASE_READ_URL = config("DATABASE_READ_URL", default=None)
+READ_YOUR_WRITES = config("READ_YOUR_WRITES", cast=bool, default=True)
+
+# How long clients may reuse a page of posts before revalidating it, and how
+# many rendered pages to keep in memory. Set the latter to 0 to disable.
+POSTS_MAX_AGE = config("POSTS_MAX_AGE", cast=int, default=0)
+POSTS_CACHE_SIZE = config("POSTS_CACHE_SIZE", cast=int, default=0)
 
-# Delay loading httpx until we've set its log level above
-import httpx
+# How long, in seconds, a request for posts may spend loading archive pages
+# before giving up on the rest and marking their posts as missing. A fetch
+# which takes longer than this percentile of recent fetches is hedged with a
+# second request to another proxy or the origin.
+READ_DEADLINE = config("READ_DEADLINE", cast=float, default=10)
+HEDGE_PERCENTILE = config("HEDGE_PERCENTILE", cast=float, default=95)
+
+# Requests to crawl a feed which was crawled less than this many seconds ago
+# just use the results of that crawl.
+CRAWL_FRESHNESS = datetime.timedelta(
+    seconds=config("CRAWL_FRESHNESS", cast=float, default=30)
+)
+
+# Bounds on how often to poll each feed, in seconds, and how much to randomly
+# vary each interval by, as a fraction of it.
+POLL_MIN_INTERVAL = datetime.timedelta(
+    seconds=config("POLL_MIN_INTERVAL", cast=float, default=15 * 60)
+)
+POLL_MAX_INTERVAL = datetime.timedelta(
+    seconds=config("POLL_MAX_INTERVAL", cast=float, default=24 * 60 * 60)
+)
+POLL_JITTER = config("POLL_JITTER", cast=float, default=0.1)
 
+# After a crawl fails, wait POLL_MIN_INTERVAL before trying that feed again,
+# doubling the wait after each further failure up to BACKOFF_MAX_INTERVAL
+# seconds. After BREAKER_THRESHOLD consecutive failures from one host, stop
+# fetching anything from it for BREAKER_COOLDOWN seconds. Archive pages which
+# return 404 or 410 aren't requested again for NEGATIVE_CACHE_TTL seconds.
+BACKOFF_MAX_INTERVAL = datetime.timedelta(
+    seconds=config("BACKOFF_MAX_INTERVAL", cast=float, default=7 * 24 * 60 * 60)
+)
+BREAKER_THRESHOLD = config("BREAKER_THRESHOLD", cast=int, default=5)
+BREAKER_COOLDOWN = config("BREAKER_COOLDOWN", cast=float, default=5 * 60)
+NEGATIVE_CACHE_TTL = config("NEGATIVE_CACHE_TTL", cast=float, default=60 * 60)
 
-http_client = httpx.Client(
-    headers={"User-Agent": "jamey@minilop.net"},
-    # use forward-only mode so the proxy can see and cache even HTTPS requests
-    # https://www.python-httpx.org/advanced/#proxy-mechanisms
-    proxies=httpx.Proxy(url=HTTP_PROXY, mode="FORWARD_ONLY") if HTTP_PROXY else {},
+# The public URL of this service, which WebSub hubs can reach. When it's set,
+# feeds which name a hub are subscribed to there, and while the hub's lease
+# lasts, they're crawled when the hub says they changed rather than polled.
+# WEBSUB_LEASE_SECONDS is how long a lease to ask hubs for.
+WEBSUB_CALLBACK_URL = config("WEBSUB_CALLBACK_URL", default=None)
+WEBSUB_LEASE_SECONDS = config(
+    "WEBSUB_LEASE_SECONDS", cast=int, default=10 * 24 * 60 * 60
 )
 
+# Whether crawls should compare old and new posts in a temporary table
+# instead of in memory. That's slower for typical crawls, but uses a fixed
+# amount of memory no matter how large a feed's archives are.
+STAGED_DIFF = config("STAGED_DIFF", cast=bool, default=False)
+
+# Batch crawls (see batch.py) fetch BATCH_CRAWL_THREADS feeds at a time, each
+# on its own database connection, and commit the changes from up to
+# BATCH_COMMIT_SIZE feeds in each transaction.
+BATCH_CRAWL_THREADS = config("BATCH_CRAWL_THREADS", cast=int, default=8)
+BATCH_COMMIT_SIZE = config("BATCH_COMMIT_SIZE", cast=int, default=100)
+
+# On PostgreSQL, how many hash partitions the migration to partitioned post
+# storage should split the post table into; see partitioning.py. With the
+# default of 0, it isn't partitioned.
+POST_PARTITIONS = config("POST_PARTITIONS", cast=int, default=0)
+
+# Where to send trace spans covering each crawl's fetches, parses, phases, and
+# SQL statements, if anywhere: "otlp" for an OpenTelemetry collector, which
+# the standard OTEL_EXPORTER_OTLP_* environment variables configure, or "file"
+# to append them to TRACE_FILE as JSON, one span per line. Either needs the
+# packages in the "tracing" extra.
+TRACE_EXPORTER = config("TRACE_EXPORTER", default=None)
+TRACE_FILE = config("TRACE_FILE", default="traces.jsonl")
+
+# When PROFILE_SLOW_CRAWLS is above 0, every crawl's thread is sampled every
+# PROFILE_INTERVAL seconds, and the samples from crawls which took at least
+# PROFILE_SLOW_CRAWLS seconds are saved in PROFILE_DIR for flame graph tools.
+PROFILE_SLOW_CRAWLS = config("PROFILE_SLOW_CRAWLS", cast=float, default=0)
+PROFILE_INTERVAL = config("PROFILE_INTERVAL", cast=float, default=0.005)
+PROFILE_DIR = config("PROFILE_DIR", default="profiles")
+
+# Number of worker processes for parsing feeds during crawls. With the default
+# of 0, crawls parse on whichever thread fetched the feed.
+PARSE_WORKERS = config("PARSE_WORKERS", cast=int, default=0)
+
+# https://www.python-httpx.org/environment_variables/#httpx_log_level
+if DEBUG:
+    os.environ["HTTPX_LOG_LEVEL"] = "debug"
+
 metadata = sqlalchemy.MetaData(
     naming_convention={
         "ix": "ix_%(column_0_label)s",
@@ -34,10 +123,96 @@ metadata = sqlalchemy.MetaData(
     }
 )
 
-engine = sqlalchemy.create_engine(DATABASE_URL, echo=DEBUG)
+# The HTTP client, database engine, and parsing pool are only created when
+# something first needs them, so processes which don't, such as CLI tools and
+# parse workers, start faster. A forked child can't safely share its parent's
+# sockets or worker processes, so after a fork it creates its own.
+
+_lock = threading.Lock()
+_http_client: Optional["httpx.Client"] = None
+_engine: Optional[Engine] = None
+_read_engine: Optional[Engine] = None
+_parse_executor: Optional[Executor] = None
+_parse_executor_created = False
+
+# Objects inherited from the parent which the child must not close, since
+# closing a connection would also end the parent's session on it. Keeping
+# references here stops them from being garbage-collected.
+_inherited: List[Any] = []
+
+
+def _after_fork_in_child() -> None:
+    global _lock, _http_client, _engine, _read_engine
+    global _parse_executor, _parse_executor_created
+    _inherited.extend(
+        filter(None, (_http_client, _engine, _read_engine, _parse_executor))
+    )
+    _lock = threading.Lock()
+    _http_client = _engine = _read_engine = _parse_executor = None
+    _parse_executor_created = False
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def get_http_client() -> "httpx.Client":
+    global _http_client
+    with _lock:
+        if _http_client is None:
+            import httpx
+
+            _http_client = httpx.Client(
+                headers={"User-Agent": "jamey@minilop.net"},
+                # use forward-only mode so the proxy can see and cache even
+                # HTTPS requests
+                # https://www.python-httpx.org/advanced/#proxy-mechanisms
+                proxies=httpx.Proxy(url=HTTP_PROXY, mode="FORWARD_ONLY")
+                if HTTP_PROXY
+                else {},
+            )
+        return _http_client
+
+
+def get_engine() -> Engine:
+    global _engine
+    with _lock:
+        if _engine is None:
+            _engine = _create_engine(DATABASE_URL)
+        return _engine
+
+
+def get_read_engine() -> Engine:
+    "The read replica's engine, or the primary's if there's no replica."
+
+    global _read_engine
+    if DATABASE_READ_URL is None:
+        return get_engine()
+    with _lock:
+        if _read_engine is None:
+            _read_engine = _create_engine(DATABASE_READ_URL)
+        return _read_engine
+
+
+def _create_engine(url: str) -> Engine:
+    engine = sqlalchemy.create_engine(url, echo=DEBUG)
+    if engine.name == "sqlite":
+        sqlalchemy.event.listen(engine, "engine_connect", _enable_sqlite_foreign_keys)
+    if TRACE_EXPORTER is not None:
+        from . import tracing
+
+        tracing.instrument(engine)
+    return engine
+
+
+def _enable_sqlite_foreign_keys(connection: Connection, branch: bool) -> None:
+    connection.execute("PRAGMA foreign_keys = ON")
 
-if engine.name == "sqlite":
 
-    @sqlalchemy.event.listens_for(engine, "engine_connect")
-    def enable_sqlite_foreign_keys(connection, branch):  # type: ignore
-        connection.execute("PRAGMA foreign_keys = ON")
+def get_parse_executor() -> Optional[Executor]:
+    global _parse_executor, _parse_executor_created
+    with _lock:
+        if not _parse_executor_created:
+            _parse_executor_created = True
+            if PARSE_WORKERS > 0:
+                _parse_executor = ProcessPoolExecutor(PARSE_WORKERS)
+        return _parse_executor
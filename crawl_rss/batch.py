@@ -0,0 +1,214 @@
+"""
+Crawl every feed that's due, committing the results in groups.
+
+    python -m crawl_rss.batch [--limit N]
+
+Most scheduled crawls find a post or two on a single page, so crawling feeds
+one transaction at a time spends most of its time waiting for commits. Here,
+feeds are fetched BATCH_CRAWL_THREADS at a time, each compared against the
+database on its own connection, and then their changes are applied
+BATCH_COMMIT_SIZE feeds to a transaction. Each feed's changes go in their own
+savepoint, so if one fails to apply, only it is rolled back and the rest of
+its group still commits.
+
+Batches always compare posts in memory, even with STAGED_DIFF set: a staged
+diff lives in a temporary table on the connection which fetched the feed, and
+that isn't the connection which applies it.
+"""
+
+import argparse
+from collections import Counter
+from concurrent.futures import as_completed, ThreadPoolExecutor
+import datetime
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql import select
+import sys
+from typing import Dict, List, Mapping, NamedTuple, Optional, Sequence, Text, Union
+from . import appconfig, models, profiling, tracing, websub
+from .crawl import crawl, DiffPosts, FeedMoved, finish_crawl, merge_feed
+from .feeds import FeedHints, FetchError
+from .schedule import backoff
+
+
+# What became of each feed: "crawled", "skipped" if another crawl of the same
+# feed committed first, or else the exception that stopped it.
+Outcome = Union[Text, Exception]
+
+
+class Fetched(NamedTuple):
+    "One feed's crawl, ready to apply."
+
+    feed_id: int
+    crawled: Optional[datetime.datetime]
+    started: datetime.datetime
+    diff: DiffPosts
+    headers: Mapping[Text, Text]
+    hints: FeedHints
+    error: Optional[Exception] = None
+
+
+def due_feeds(
+    connection: Connection, limit: int, now: Optional[datetime.datetime] = None
+) -> List[int]:
+    "The feeds whose next check is due, most overdue first."
+
+    if now is None:
+        now = datetime.datetime.utcnow()
+
+    return [
+        row[0]
+        for row in connection.execute(
+            select([models.feed.c.id])
+            .where(models.feed.c.next_check <= now)
+            .order_by(models.feed.c.next_check)
+            .limit(limit)
+        )
+    ]
+
+
+def fetch_feed(feed_id: int, connection: Connection) -> Fetched:
+    """
+    Crawl this feed without changing its posts yet. Failures are returned for
+    `apply_fetched` to record, rather than raised.
+    """
+
+    crawled = connection.execute(
+        select([models.feed.c.crawled]).where(models.feed.c.id == feed_id)
+    ).scalar()
+    started = datetime.datetime.utcnow()
+    diff = DiffPosts()
+    try:
+        with tracing.span("crawl", feed_id=feed_id):
+            with profiling.profile_if_slow(f"feed-{feed_id}"):
+                headers, hints = crawl(feed_id, connection, diff)
+    except (FetchError, FeedMoved) as error:
+        return Fetched(feed_id, crawled, started, diff, {}, FeedHints(), error)
+    return Fetched(feed_id, crawled, started, diff, headers, hints)
+
+
+def apply_fetched(fetched: Fetched, connection: Connection) -> Outcome:
+    """
+    Apply one feed's crawl, or record why it failed, unless another crawl of
+    the feed has committed since this one read it, in which case this one's
+    changes may be out of date.
+    """
+
+    feed_id = fetched.feed_id
+    row = connection.execute(
+        select([models.feed.c.crawled])
+        .where(models.feed.c.id == feed_id)
+        .with_for_update()
+    ).first()
+    if row is None or row[0] != fetched.crawled:
+        return "skipped"
+
+    error = fetched.error
+    if isinstance(error, FetchError):
+        error.retry_at = backoff(feed_id, connection, error, fetched.started)
+        return error
+    if isinstance(error, FeedMoved):
+        merge_feed(feed_id, connection, error.feed_id)
+        return error
+
+    finish_crawl(feed_id, connection, fetched.diff, fetched.headers, fetched.hints)
+    return "crawled"
+
+
+def apply_batch(connection: Connection, batch: Sequence[Fetched]) -> Dict[int, Outcome]:
+    """
+    Apply a group of crawls in the caller's transaction, each in a savepoint
+    so that an error applying one feed doesn't lose the others.
+    """
+
+    outcomes: Dict[int, Outcome] = {}
+    for fetched in batch:
+        savepoint = connection.begin_nested()
+        try:
+            outcomes[fetched.feed_id] = apply_fetched(fetched, connection)
+        except Exception as error:
+            savepoint.rollback()
+            outcomes[fetched.feed_id] = error
+        else:
+            savepoint.commit()
+    return outcomes
+
+
+def crawl_batch(feed_ids: Sequence[int]) -> Dict[int, Outcome]:
+    """
+    Crawl these feeds concurrently, applying their changes in groups as the
+    crawls finish. Afterward, ask the hubs of any newly crawled feeds which
+    we aren't subscribed to yet to subscribe us.
+    """
+
+    engine = appconfig.get_engine()
+
+    def fetch(feed_id: int) -> Fetched:
+        with engine.begin() as connection:
+            return fetch_feed(feed_id, connection)
+
+    def commit(batch: Sequence[Fetched]) -> None:
+        with tracing.span("apply_batch", feeds=len(batch)):
+            with engine.begin() as connection:
+                outcomes.update(apply_batch(connection, batch))
+
+    outcomes: Dict[int, Outcome] = {}
+    batch: List[Fetched] = []
+    with ThreadPoolExecutor(max_workers=appconfig.BATCH_CRAWL_THREADS) as executor:
+        futures = {executor.submit(fetch, feed_id): feed_id for feed_id in feed_ids}
+        for future in as_completed(futures):
+            try:
+                batch.append(future.result())
+            except Exception as error:
+                outcomes[futures[future]] = error
+                continue
+            if len(batch) >= appconfig.BATCH_COMMIT_SIZE:
+                commit(batch)
+                batch = []
+    if batch:
+        commit(batch)
+
+    if appconfig.WEBSUB_CALLBACK_URL is not None:
+        for feed_id, outcome in outcomes.items():
+            if outcome == "crawled":
+                websub.send_request(feed_id)
+    return outcomes
+
+
+def summarize(outcomes: Mapping[int, Outcome]) -> str:
+    """
+    >>> summarize({1: "crawled", 2: "crawled", 3: FetchError("u", "x", 404)})
+    'crawled 2, FetchError 1'
+    """
+
+    counts = Counter(
+        outcome if isinstance(outcome, str) else type(outcome).__name__
+        for outcome in outcomes.values()
+    )
+    return ", ".join(f"{name} {count}" for name, count in counts.most_common())
+
+
+def main(argv: Sequence[str] = sys.argv[1:]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m crawl_rss.batch",
+        description=__doc__.split("\n\n")[0].strip(),
+    )
+    parser.add_argument(
+        "--limit", type=int, default=1000, help="most feeds to crawl in this run"
+    )
+    args = parser.parse_args(argv)
+
+    with appconfig.get_engine().begin() as connection:
+        feed_ids = due_feeds(connection, args.limit)
+    outcomes = crawl_batch(feed_ids)
+
+    for feed_id, outcome in sorted(outcomes.items()):
+        if isinstance(outcome, Exception) and not isinstance(
+            outcome, (FetchError, FeedMoved)
+        ):
+            print(f"feed {feed_id}: {outcome!r}", file=sys.stderr)
+    print(summarize(outcomes) or "nothing due")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,4 @@
+"""
+Benchmarks for tracking the performance of particular parts of crawl_rss.
+Run each with `python -m crawl_rss.benchmarks.<name> --help`.
+"""
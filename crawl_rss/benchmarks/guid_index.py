@@ -0,0 +1,187 @@
+"""
+Compare indexing posts by their full GUID, as a unique (feed_id, guid)
+constraint does, against indexing the 64-bit hash in post.guid_hash: the
+size of each index, and how fast the crawler can insert posts and then find
+and update them by GUID.
+"""
+
+import argparse
+import random
+import sqlalchemy
+from sqlalchemy import BigInteger, Column, Index, Integer, MetaData, Table, Text
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql import bindparam
+import sys
+import tempfile
+import time
+from typing import Dict, Iterator, NamedTuple, Optional, Sequence
+from ..models import hash_guid
+
+
+VARIANTS = ("guid", "guid_hash")
+
+
+def post_table(variant: str) -> Table:
+    "Just enough of the post table to see the difference between indexes."
+
+    table = Table(
+        "bench_post",
+        MetaData(),
+        Column("id", Integer, primary_key=True),
+        Column("feed_id", Integer, nullable=False),
+        Column("guid", Text, nullable=False),
+        Column("guid_hash", BigInteger, nullable=False),
+        Column("episode", Integer),
+    )
+    if variant == "guid":
+        Index("ix_bench_" + variant, table.c.feed_id, table.c.guid, unique=True)
+    else:
+        Index("ix_bench_" + variant, table.c.feed_id, table.c.guid_hash)
+    return table
+
+
+def make_guids(count: int, feeds: int) -> Iterator[Dict[str, object]]:
+    """
+    Posts spread evenly across feeds, with GUIDs shaped like the permalinks
+    that many blogs use.
+
+    >>> next(make_guids(1, 1))["guid"]
+    'https://blog0.example.com/2020/01/a-post-about-something-0/?utm_source=feed'
+    """
+
+    for n in range(count):
+        feed_id = n % feeds
+        month = n // feeds % 12 + 1
+        guid = (
+            f"https://blog{feed_id}.example.com/{2020 + n // 100000}/{month:02}/"
+            f"a-post-about-something-{n}/?utm_source=feed"
+        )
+        yield {"feed_id": feed_id, "guid": guid, "guid_hash": hash_guid(guid)}
+
+
+def index_bytes(connection: Connection, name: str) -> Optional[int]:
+    "How much space an index takes, if we know how to ask this database."
+
+    dialect = connection.dialect.name
+    if dialect == "sqlite":
+        return connection.execute(
+            "SELECT sum(pgsize) FROM dbstat WHERE name = ?", name
+        ).scalar()
+    if dialect == "postgresql":
+        return connection.execute(
+            "SELECT pg_relation_size(%s::regclass)", name
+        ).scalar()
+    return None
+
+
+class Result(NamedTuple):
+    index_bytes: Optional[int]
+    inserts_per_second: float
+    updates_per_second: float
+
+
+def measure(
+    engine: sqlalchemy.engine.Engine,
+    variant: str,
+    posts: int,
+    feeds: int,
+    updates: int,
+    batch: int,
+) -> Result:
+    table = post_table(variant)
+    table.metadata.drop_all(engine)
+    table.metadata.create_all(engine)
+
+    try:
+        rows = make_guids(posts, feeds)
+        start = time.perf_counter()
+        while True:
+            chunk = [row for _, row in zip(range(batch), rows)]
+            if not chunk:
+                break
+            with engine.begin() as connection:
+                connection.execute(table.insert(), chunk)
+        inserts = posts / (time.perf_counter() - start)
+
+        # The crawler's per-post lookups: find a post by feed and GUID.
+        update = table.update().where(table.c.feed_id == bindparam("post_feed_id"))
+        if variant == "guid_hash":
+            update = update.where(table.c.guid_hash == bindparam("post_guid_hash"))
+        update = update.where(table.c.guid == bindparam("post_guid"))
+
+        picked = set(random.Random(0).sample(range(posts), min(updates, posts)))
+        sample = [
+            {
+                "post_feed_id": row["feed_id"],
+                "post_guid": row["guid"],
+                "post_guid_hash": row["guid_hash"],
+                "episode": n,
+            }
+            for n, row in enumerate(make_guids(posts, feeds))
+            if n in picked
+        ]
+        random.Random(1).shuffle(sample)
+        start = time.perf_counter()
+        for offset in range(0, len(sample), batch):
+            with engine.begin() as connection:
+                connection.execute(update, sample[offset : offset + batch])
+        elapsed = time.perf_counter() - start
+
+        with engine.connect() as connection:
+            size = index_bytes(connection, "ix_bench_" + variant)
+    finally:
+        table.metadata.drop_all(engine)
+
+    return Result(size, inserts, len(sample) / elapsed if elapsed else 0.0)
+
+
+def report(results: Dict[str, Result]) -> str:
+    """
+    >>> print(report({"guid_hash": Result(2 ** 20, 51234.5, 12345.6)}))
+    index         index MiB   inserts/s   updates/s
+    guid_hash           1.0       51234       12346
+    """
+
+    lines = [f"{'index':<12} {'index MiB':>10} {'inserts/s':>11} {'updates/s':>11}"]
+    for variant, result in results.items():
+        size = (
+            "?" if result.index_bytes is None else f"{result.index_bytes / 2 ** 20:.1f}"
+        )
+        lines.append(
+            f"{variant:<12} {size:>10} {result.inserts_per_second:>11.0f}"
+            f" {result.updates_per_second:>11.0f}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv: Sequence[str] = sys.argv[1:]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m crawl_rss.benchmarks.guid_index", description=__doc__
+    )
+    parser.add_argument("--posts", type=int, default=1000000)
+    parser.add_argument("--feeds", type=int, default=100)
+    parser.add_argument("--updates", type=int, default=100000)
+    parser.add_argument("--batch", type=int, default=10000)
+    parser.add_argument(
+        "--database-url",
+        help="where to create the scratch table (default: a temporary SQLite file)",
+    )
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as scratch:
+        url = args.database_url or f"sqlite:///{scratch}/guid_index.sqlite"
+        engine = sqlalchemy.create_engine(url)
+        results = {
+            variant: measure(
+                engine, variant, args.posts, args.feeds, args.updates, args.batch
+            )
+            for variant in VARIANTS
+        }
+        engine.dispose()
+
+    print(report(results))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,239 @@
+"""
+Compare a plain post table against a hash-partitioned one on PostgreSQL: how
+long a crawl takes to apply its changes to one feed, and how long listing a
+page of a feed's posts takes, as the tables grow.
+"""
+
+import argparse
+import datetime
+import random
+import sqlalchemy
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql import select
+import sys
+import time
+from typing import Dict, List, NamedTuple, Sequence
+from .. import appconfig, models
+from ..crawl import DiffPosts
+from ..feeds import PostMetadata
+from ..partitioning import rebuild_statements
+from ..server import PAGE_COLUMNS, POST_COLUMNS
+
+
+EPOCH = datetime.datetime(2020, 1, 1)
+
+
+def populate(engine: Engine, feeds: int, pages: int, posts: int, batch: int) -> None:
+    "Feeds with `pages` archive pages of `posts` posts each, oldest first."
+
+    with engine.begin() as connection:
+        connection.execute(
+            models.feed.insert(),
+            [{"id": f + 1, "url": f"https://feed{f}.example"} for f in range(feeds)],
+        )
+        connection.execute(
+            models.page.insert(),
+            [
+                {
+                    "id": f * pages + p + 1,
+                    "feed_id": f + 1,
+                    "idx": p,
+                    "url": page_url(f, p, pages),
+                }
+                for f in range(feeds)
+                for p in range(pages)
+            ],
+        )
+        connection.execute("SELECT setval('page_id_seq', (SELECT max(id) FROM page))")
+
+    rows: List[Dict[str, object]] = []
+    for f in range(feeds):
+        for p in range(pages):
+            for n in range(posts):
+                number = p * posts + n
+                rows.append(
+                    {
+                        "feed_id": f + 1,
+                        "page_id": f * pages + p + 1,
+                        "guid": f"https://feed{f}.example/posts/{number}",
+                        "published": EPOCH + datetime.timedelta(hours=number),
+                        "episode": number,
+                    }
+                )
+                if len(rows) >= batch:
+                    with engine.begin() as connection:
+                        connection.execute(models.post.insert(), rows)
+                    rows = []
+    if rows:
+        with engine.begin() as connection:
+            connection.execute(models.post.insert(), rows)
+
+    with engine.connect() as connection:
+        connection.execute("ANALYZE")
+
+
+def page_url(feed: int, page: int, pages: int) -> str:
+    if page == pages - 1:
+        return f"https://feed{feed}.example"
+    return f"https://feed{feed}.example/archive/{page}"
+
+
+def apply_crawl(engine: Engine, feed_id: int, changes: int, serial: int) -> float:
+    """
+    Time applying what a typical crawl finds: a few new posts on the
+    subscription page, a few edited ones, and a few which scrolled off.
+    """
+
+    with engine.begin() as connection:
+        page = connection.execute(
+            select([models.page.c.id, models.page.c.idx, models.page.c.url])
+            .where(models.page.c.feed_id == feed_id)
+            .order_by(models.page.c.idx.desc())
+            .limit(1)
+        ).first()
+        old = connection.execute(
+            models.post.select()
+            .where(models.post.c.feed_id == feed_id)
+            .where(models.post.c.page_id == page[0])
+        ).fetchall()
+
+        posts = {
+            post[models.post.c.guid]: PostMetadata.from_db(post)
+            for post in old[changes:]
+        }
+        for post in old[changes : 2 * changes]:
+            posts[post[models.post.c.guid]] = PostMetadata.from_db(post)._replace(
+                season=serial
+            )
+        for n in range(changes):
+            posts[f"https://new.example/{serial}/{n}"] = PostMetadata(
+                published=EPOCH + datetime.timedelta(days=serial, minutes=n)
+            )
+
+        start = time.perf_counter()
+        diff = DiffPosts()
+        diff.new_page(page[2], page[0], posts)
+        for post in old:
+            diff.old_post(post)
+        diff.first_replaced_page = page[1]
+        diff.apply(feed_id, connection)
+        return time.perf_counter() - start
+
+
+def list_posts(engine: Engine, feed_id: int, limit: int) -> float:
+    "Time the queries list_posts makes for the first page of a feed."
+
+    start = time.perf_counter()
+    with engine.begin() as connection:
+        posts = connection.execute(
+            select(POST_COLUMNS)
+            .where(models.post.c.feed_id == feed_id)
+            .order_by(models.post.c.published.desc(), models.post.c.id.desc())
+            .limit(limit)
+        ).fetchall()
+        connection.execute(
+            select(PAGE_COLUMNS).where(
+                models.page.c.id.in_({post[0] for post in posts})
+            )
+        ).fetchall()
+    return time.perf_counter() - start
+
+
+class Result(NamedTuple):
+    apply_ms: Sequence[float]
+    list_ms: Sequence[float]
+
+
+def percentile(samples: Sequence[float], pct: float) -> float:
+    """
+    >>> percentile([3.0, 1.0, 2.0, 4.0], 50)
+    2.0
+    """
+
+    ordered = sorted(samples)
+    rank = max(0, -(-len(ordered) * pct // 100) - 1)
+    return ordered[int(rank)]
+
+
+def measure(engine: Engine, partitions: int, args: argparse.Namespace) -> Result:
+    appconfig.metadata.drop_all(engine)
+    appconfig.metadata.create_all(engine)
+    try:
+        if partitions:
+            with engine.begin() as connection:
+                for statement in rebuild_statements(partitions):
+                    connection.execute(statement)
+        populate(engine, args.feeds, args.pages, args.posts_per_page, args.batch)
+
+        rng = random.Random(0)
+        applies = [
+            apply_crawl(engine, rng.randrange(args.feeds) + 1, args.changes, n) * 1000
+            for n in range(args.rounds)
+        ]
+        lists = [
+            list_posts(engine, rng.randrange(args.feeds) + 1, args.limit) * 1000
+            for _ in range(args.rounds)
+        ]
+    finally:
+        appconfig.metadata.drop_all(engine)
+
+    return Result(applies, lists)
+
+
+def report(results: Dict[str, Result]) -> str:
+    """
+    >>> print(report({"plain": Result([1.0, 2.0], [0.5, 0.25])}))
+    tables        apply p50   apply p95    list p50    list p95
+    plain           1.00 ms     2.00 ms     0.25 ms     0.50 ms
+    """
+
+    lines = [
+        f"{'tables':<12} {'apply p50':>10} {'apply p95':>11}"
+        f" {'list p50':>11} {'list p95':>11}"
+    ]
+    for variant, result in results.items():
+        lines.append(
+            f"{variant:<12}"
+            f" {percentile(result.apply_ms, 50):>7.2f} ms"
+            f" {percentile(result.apply_ms, 95):>8.2f} ms"
+            f" {percentile(result.list_ms, 50):>8.2f} ms"
+            f" {percentile(result.list_ms, 95):>8.2f} ms"
+        )
+    return "\n".join(lines)
+
+
+def main(argv: Sequence[str] = sys.argv[1:]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m crawl_rss.benchmarks.partitions", description=__doc__
+    )
+    parser.add_argument(
+        "--database-url",
+        required=True,
+        help="a scratch PostgreSQL database; its tables will be dropped",
+    )
+    parser.add_argument("--partitions", type=int, default=16)
+    parser.add_argument("--feeds", type=int, default=1000)
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--posts-per-page", type=int, default=100)
+    parser.add_argument("--changes", type=int, default=5, help="per crawl")
+    parser.add_argument("--rounds", type=int, default=500)
+    parser.add_argument("--limit", type=int, default=25)
+    parser.add_argument("--batch", type=int, default=10000)
+    args = parser.parse_args(argv)
+
+    engine = sqlalchemy.create_engine(args.database_url)
+    if engine.name != "postgresql":
+        parser.error("partitioning is only supported on PostgreSQL")
+
+    results = {
+        "plain": measure(engine, 0, args),
+        f"{args.partitions} parts": measure(engine, args.partitions, args),
+    }
+    engine.dispose()
+
+    print(report(results))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""
+Measure how long it takes to import each crawl_rss module in a fresh
+interpreter, and which expensive dependencies each one loads up front.
+Worker processes and CLI tools pay this cost every time they start.
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+from typing import Dict, List, NamedTuple, Sequence
+
+
+MODULES = (
+    "crawl_rss.appconfig",
+    "crawl_rss.models",
+    "crawl_rss.feeds",
+    "crawl_rss.crawl",
+    "crawl_rss.server",
+)
+
+# Dependencies that should only be loaded once they're actually used.
+HEAVY = ("feedparser", "httpx")
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+from crawl_rss import appconfig
+print(json.dumps({{
+    "seconds": elapsed,
+    "loaded": [name for name in {heavy!r} if name in sys.modules],
+    "engine": appconfig._engine is not None,
+    "http_client": appconfig._http_client is not None,
+}}))
+"""
+
+
+class Startup(NamedTuple):
+    seconds: float
+    loaded: List[str]
+    eager: List[str]
+
+
+def measure(module: str, runs: int) -> Startup:
+    "Import `module` in `runs` fresh interpreters and keep the fastest time."
+
+    results = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY)],
+            check=True,
+            stdout=subprocess.PIPE,
+        ).stdout
+        results.append(json.loads(output))
+    last = results[-1]
+    return Startup(
+        seconds=min(result["seconds"] for result in results),
+        loaded=last["loaded"],
+        eager=[name for name in ("engine", "http_client") if last[name]],
+    )
+
+
+def report(results: Dict[str, Startup]) -> str:
+    """
+    >>> print(report({"crawl_rss.feeds": Startup(0.0123, ["httpx"], [])}))
+    module                    import ms  eagerly loaded
+    crawl_rss.feeds                12.3  httpx
+    """
+
+    lines = [f"{'module':<24} {'import ms':>10}  eagerly loaded"]
+    for module, result in results.items():
+        eager = ", ".join(result.loaded + result.eager)
+        lines.append(f"{module:<24} {result.seconds * 1000:>10.1f}  {eager}".rstrip())
+    return "\n".join(lines)
+
+
+def main(argv: Sequence[str] = sys.argv[1:]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m crawl_rss.benchmarks.startup", description=__doc__
+    )
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--max-ms",
+        type=float,
+        help="exit with an error if any module takes longer than this to import",
+    )
+    parser.add_argument(
+        "--strict",
+        action="store_true",
+        help="exit with an error if any module loads heavy dependencies eagerly",
+    )
+    args = parser.parse_args(argv)
+
+    results = {module: measure(module, args.runs) for module in MODULES}
+    print(report(results))
+
+    failed = False
+    for result in results.values():
+        if args.max_ms is not None and result.seconds * 1000 > args.max_ms:
+            failed = True
+        if args.strict and (result.loaded or result.eager):
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
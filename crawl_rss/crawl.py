@@ -1,12 +1,48 @@
 from collections import defaultdict
-from sqlalchemy.sql import and_, bindparam, func, select
+from concurrent.futures import Future
+import datetime
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import Column, DateTime, Integer, MetaData, Table, types
+from sqlalchemy.sql import and_, bindparam, exists, func, literal, or_, select
+from sqlalchemy.sql import ClauseElement
 from sqlalchemy.engine import Connection, RowProxy
-from typing import DefaultDict, Dict, List, Mapping, Optional, Set, Text, Tuple
-from . import models
-from .feeds import FeedDocument, PostMetadata
+import threading
+from typing import (
+    Any,
+    Callable,
+    cast,
+    DefaultDict,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Text,
+    Tuple,
+    TypeVar,
+    Union,
+)
+from urllib.parse import urlsplit
+from . import appconfig, models, profiling, redirects, tracing, websub
+from .failures import CircuitBreaker, NegativeCache
+from .feeds import canonical_url, EntryLayout, FeedDocument, FeedHints, FetchError
+from .feeds import PostMetadata, Rank
+from .schedule import backoff, reschedule
+
+
+# How many GUIDs to look up in a single query.
+GUID_BATCH_SIZE = 500
 
 
 class DiffPosts:
+    # Whether `crawl` should read the old posts from the database and hand
+    # each one to old_post. Diffs which find them some other way turn it off.
+    wants_old_posts = True
+
     def __init__(self) -> None:
         self.first_replaced_page: int = 0
         self.old_posts: Dict[Text, Tuple[int, int, PostMetadata]] = {}
@@ -16,6 +52,13 @@ class DiffPosts:
         self.updated: DefaultDict[str, List[Tuple[int, PostMetadata]]] = defaultdict(
             list
         )
+        self.layouts: Dict[str, Tuple[Optional[str], Optional[EntryLayout]]] = {}
+        self.ranks: Dict[str, Mapping[Text, Sequence[Rank]]] = {}
+        # Pages other than the new pages which may have lost posts.
+        self.touched_pages: Set[int] = set()
+        # GUIDs of matched posts whose page or metadata changed, for the
+        # change log.
+        self.revised: List[Text] = []
 
     def _match(
         self,
@@ -26,6 +69,7 @@ class DiffPosts:
         self.matched.add(guid)
         if old[1:] != new[1:]:
             self.updated[new[0]].append((old[0], new[2]))
+            self.revised.append(guid)
 
     def old_post(self, post: RowProxy) -> None:
         guid = post[models.post.c.guid]
@@ -57,7 +101,74 @@ class DiffPosts:
             else:
                 self._match(guid, old_post, new_post)
 
+    def page_layout(
+        self, page_url: str, validator: Optional[str], layout: Optional[EntryLayout]
+    ) -> None:
+        """
+        Record where the posts are within an archive page. This is only
+        useful if we can tell later whether the page has changed, so it's
+        discarded if the page doesn't have a validator.
+        """
+
+        self.layouts[page_url] = (validator, layout if validator is not None else None)
+
+    def page_ranks(self, page_url: str, ranks: Mapping[Text, Sequence[Rank]]) -> None:
+        "Record the feed-index ranks of the posts on a page we fetched."
+
+        if ranks:
+            self.ranks[page_url] = ranks
+
+    def has_old_posts(self, feed_id: int, connection: Connection) -> bool:
+        """
+        Whether any of the old posts we've been given haven't turned up in the
+        new pages yet.
+        """
+
+        return bool(self.old_posts)
+
+    def abandon(self, connection: Connection) -> None:
+        "Clean up after a crawl that failed before it could be applied."
+        pass
+
     def apply(self, feed_id: int, connection: Connection) -> None:
+        with tracing.span("add_pages", pages=len(self.new_pages)):
+            page_ids = self._add_pages(feed_id, connection)
+        with tracing.span(
+            "apply_posts", new=len(self.new_posts), old=len(self.old_posts)
+        ):
+            changed = self._apply_posts(feed_id, connection, page_ids)
+        with tracing.span("apply_ranks"):
+            changed = self._apply_ranks(feed_id, connection, page_ids) or changed
+        with tracing.span("summarize_pages"):
+            self._summarize_pages(feed_id, connection)
+
+        # Only tell readers that something changed if it actually did. Page
+        # renumbering alone doesn't affect which posts they'll see.
+        if changed:
+            connection.execute(
+                models.feed.update()
+                .where(models.feed.c.id == feed_id)
+                .values(generation=models.feed.c.generation + 1)
+            )
+
+        # Finally, delete any now-unreferenced pages and renumber the used
+        # pages to their final indexes.
+
+        with tracing.span("renumber_pages"):
+            connection.execute(
+                models.page.delete()
+                .where(models.page.c.feed_id == feed_id)
+                .where(models.page.c.idx >= self.first_replaced_page)
+            )
+
+            connection.execute(
+                models.page.update()
+                .where(models.page.c.feed_id == feed_id)
+                .where(models.page.c.idx < 0)
+                .values(idx=-models.page.c.idx + (self.first_replaced_page - 1))
+            )
+
+    def _add_pages(self, feed_id: int, connection: Connection) -> Dict[str, int]:
         # First, ensure all the URLs in self.new_pages have corresponding rows
         # in the database. (Re-)number them to use negative indexes so they
         # can't conflict with any existing page indexes. We can't delete the
@@ -90,20 +201,37 @@ class DiffPosts:
                 update_pages,
             )
 
-        # Now ensure that all the right posts exist and that they use the new
-        # page IDs.
+        return page_ids
+
+    def _apply_posts(
+        self, feed_id: int, connection: Connection, page_ids: Dict[str, int]
+    ) -> bool:
+        "Make the posts table match the new pages. Returns whether it changed."
+
+        self._find_older_copies(feed_id, connection)
+
+        # Ensure that all the right posts exist and that they use the new page
+        # IDs.
 
         update_posts = []
         for page, posts in self.updated.items():
             page_id = page_ids[page]
             for post_id, post in posts:
                 update_posts.append(
-                    {"page_id": page_id, "post_id": post_id, **post._asdict()}
+                    {
+                        "page_id": page_id,
+                        "post_id": post_id,
+                        "entry_offset": None,
+                        "entry_length": None,
+                        **post._asdict(),
+                    }
                 )
 
         if update_posts:
             connection.execute(
-                models.post.update().where(models.post.c.id == bindparam("post_id")),
+                models.post.update()
+                .where(models.post.c.feed_id == feed_id)
+                .where(models.post.c.id == bindparam("post_id")),
                 update_posts,
             )
 
@@ -123,28 +251,642 @@ class DiffPosts:
 
         if self.old_posts:
             connection.execute(
-                models.post.delete().where(models.post.c.id == bindparam("id")),
-                [{"id": old[1]} for old in self.old_posts.values()],
+                models.post.delete()
+                .where(models.post.c.feed_id == feed_id)
+                .where(models.post.c.id == bindparam("id")),
+                [{"id": old[0]} for old in self.old_posts.values()],
             )
 
-        # Finally, delete any now-unreferenced pages and renumber the used
-        # pages to their final indexes.
+        changes = (
+            [{"guid": guid, "action": "insert"} for guid in self.new_posts]
+            + [{"guid": guid, "action": "update"} for guid in self.revised]
+            + [{"guid": guid, "action": "delete"} for guid in self.old_posts]
+        )
+        if changes:
+            lock_change_log(connection)
+            connection.execute(
+                models.change_log.insert().values(feed_id=feed_id), changes
+            )
+
+        # Any post which moved has now lost its old offset, so record offsets
+        # for the posts on the archive pages we just fetched.
+
+        for page_url, (validator, layout) in self._update_pages(connection, page_ids):
+            page_id = page_ids[page_url]
+            connection.execute(
+                models.post.update()
+                .where(on_page(connection, feed_id, page_id))
+                .values(entry_offset=None, entry_length=None)
+            )
+            if layout is not None and layout.spans:
+                connection.execute(
+                    models.post.update()
+                    .where(models.post.c.feed_id == feed_id)
+                    .where(models.post.c.guid_hash == bindparam("post_guid_hash"))
+                    .where(models.post.c.guid == bindparam("post_guid"))
+                    .where(models.post.c.page_id == page_id),
+                    [
+                        {
+                            "post_guid_hash": models.hash_guid(guid),
+                            "post_guid": guid,
+                            "entry_offset": start,
+                            "entry_length": end - start,
+                        }
+                        for guid, (start, end) in layout.spans.items()
+                    ],
+                )
+
+        return bool(update_posts or self.new_posts or self.old_posts)
+
+    def _find_older_copies(self, feed_id: int, connection: Connection) -> None:
+        """
+        A post which looks new may already be stored on an archive page
+        before `first_replaced_page`, which the crawl didn't read again. The
+        newest copy of a post is the current one, so move it here instead of
+        inserting it twice.
+        """
+
+        if self.first_replaced_page == 0 or not self.new_posts:
+            return
+
+        guids = list(self.new_posts)
+        for start in range(0, len(guids), GUID_BATCH_SIZE):
+            hashes = [
+                models.hash_guid(guid)
+                for guid in guids[start : start + GUID_BATCH_SIZE]
+            ]
+            for post in connection.execute(
+                models.post.select()
+                .where(models.post.c.feed_id == feed_id)
+                .where(models.post.c.guid_hash.in_(hashes))
+            ):
+                guid = post[models.post.c.guid]
+                new_post = self.new_posts.pop(guid, None)
+                if new_post is None:
+                    # Just a hash collision.
+                    continue
+                self.touched_pages.add(post[models.post.c.page_id])
+                self._match(
+                    guid,
+                    (
+                        post[models.post.c.id],
+                        post[models.post.c.page_id],
+                        PostMetadata.from_db(post),
+                    ),
+                    new_post,
+                )
 
+    def _apply_ranks(
+        self, feed_id: int, connection: Connection, page_ids: Dict[str, int]
+    ) -> bool:
+        """
+        Replace the ranks of the posts on every page we fetched, if they've
+        changed. Returns whether any did.
+        """
+
+        # Most feeds never have any ranks, so check for that first.
+        if not self.ranks and (
+            connection.execute(
+                select([models.rank.c.post_id])
+                .where(models.rank.c.feed_id == feed_id)
+                .limit(1)
+            ).first()
+            is None
+        ):
+            return False
+
+        uri_ids: Dict[Tuple[Table, Text], int] = {}
+        changed = False
+        for page_url in self.new_pages:
+            page_id = page_ids[page_url]
+            post_ids = dict(
+                connection.execute(
+                    select([models.post.c.guid, models.post.c.id]).where(
+                        on_page(connection, feed_id, page_id)
+                    )
+                ).fetchall()
+            )
+
+            new_ranks: Dict[Tuple[int, int, int], float] = {}
+            for guid, ranks in self._page_ranks(connection, page_url).items():
+                post_id = post_ids.get(guid)
+                if post_id is None:
+                    # This post's current copy is on a newer page.
+                    continue
+                for rank in ranks:
+                    scheme_id = get_uri_id(
+                        connection, models.rank_scheme, rank.scheme, uri_ids
+                    )
+                    domain_id = get_uri_id(
+                        connection, models.rank_domain, rank.domain, uri_ids
+                    )
+                    new_ranks.setdefault((post_id, scheme_id, domain_id), rank.value)
+
+            old_ranks = set(
+                tuple(row)
+                for row in connection.execute(
+                    select(
+                        [
+                            models.rank.c.post_id,
+                            models.rank.c.scheme_id,
+                            models.rank.c.domain_id,
+                            models.rank.c.rank,
+                        ]
+                    )
+                    .select_from(models.rank.join(models.post))
+                    .where(on_page(connection, feed_id, page_id))
+                )
+            )
+
+            if {(*key, value) for key, value in new_ranks.items()} == old_ranks:
+                continue
+
+            changed = True
+            connection.execute(
+                models.rank.delete().where(
+                    models.rank.c.post_id.in_(
+                        select([models.post.c.id]).where(
+                            on_page(connection, feed_id, page_id)
+                        )
+                    )
+                )
+            )
+            if new_ranks:
+                connection.execute(
+                    models.rank.insert(),
+                    [
+                        {
+                            "post_id": post_id,
+                            "feed_id": feed_id,
+                            "scheme_id": scheme_id,
+                            "domain_id": domain_id,
+                            "rank": value,
+                        }
+                        for (post_id, scheme_id, domain_id), value in new_ranks.items()
+                    ],
+                )
+
+        return changed
+
+    def _page_ranks(
+        self, connection: Connection, page_url: str
+    ) -> Mapping[Text, Sequence[Rank]]:
+        return self.ranks.get(page_url, {})
+
+    def _summarize_pages(self, feed_id: int, connection: Connection) -> None:
+        "Recompute the summaries of every page whose posts may have changed."
+
+        post = models.post
+        page = models.page
+        summaries = {
+            "post_count": func.count(),
+            "published_count": func.count(post.c.published),
+            "published_min": func.min(post.c.published),
+            "published_max": func.max(post.c.published),
+            "updated_count": func.count(post.c.updated),
+            "updated_min": func.min(post.c.updated),
+            "updated_max": func.max(post.c.updated),
+        }
         connection.execute(
-            models.page.delete()
-            .where(models.page.c.feed_id == feed_id)
-            .where(models.page.c.idx >= self.first_replaced_page)
+            page.update()
+            .where(page.c.feed_id == feed_id)
+            .where(or_(page.c.idx < 0, page.c.id.in_(self.touched_pages)))
+            .values(
+                {
+                    name: select([aggregate])
+                    .where(on_page(connection, feed_id, page.c.id))
+                    .as_scalar()
+                    for name, aggregate in summaries.items()
+                }
+            )
+        )
+
+    def _update_pages(
+        self, connection: Connection, page_ids: Dict[str, int]
+    ) -> Iterator[Tuple[str, Tuple[Optional[str], Optional[EntryLayout]]]]:
+        "Record each fetched archive page's validator and where its entries are."
+
+        for page_url, (validator, layout) in self.layouts.items():
+            connection.execute(
+                models.page.update()
+                .where(models.page.c.id == page_ids[page_url])
+                .values(
+                    validator=validator,
+                    entries_start=layout and layout.head,
+                    entries_end=layout and layout.tail,
+                )
+            )
+            yield page_url, (validator, layout)
+
+
+def get_uri_id(
+    connection: Connection,
+    table: Table,
+    uri: Text,
+    cache: Dict[Tuple[Table, Text], int],
+) -> int:
+    "Find or add the row for this URI in rank_scheme or rank_domain."
+
+    key = (table, uri)
+    uri_id = cache.get(key)
+    if uri_id is None:
+        uri_id = connection.execute(
+            select([table.c.id]).where(table.c.uri == uri)
+        ).scalar()
+        if uri_id is None:
+            uri_id = connection.execute(
+                table.insert().values(uri=uri)
+            ).inserted_primary_key[0]
+        cache[key] = uri_id
+    return cast(int, uri_id)
+
+
+def on_page(connection: Connection, feed_id: int, page_id: Any) -> ClauseElement:
+    """
+    Match the posts on this page of this feed. Only PostgreSQL is told which
+    feed, which it needs to search just that feed's partition when the post
+    table is partitioned (see partitioning.py). Given the choice, SQLite may
+    use one of the indexes which start with feed_id, and scan all the feed's
+    posts for every page.
+    """
+
+    condition = models.post.c.page_id == page_id
+    if connection.dialect.name == "postgresql":
+        condition = and_(condition, models.post.c.feed_id == feed_id)
+    return condition
+
+
+# Scratch space for StagedDiffPosts, private to each database connection.
+staged_post = Table(
+    "staged_post",
+    MetaData(),
+    Column("guid", types.Text, primary_key=True),
+    Column("guid_hash", types.BigInteger, nullable=False),
+    Column("page_url", types.Text, nullable=False),
+    Column("page_id", Integer),
+    Column("published", DateTime),
+    Column("updated", DateTime),
+    Column("season", Integer),
+    Column("episode", Integer),
+    Column("entry_offset", Integer),
+    Column("entry_length", Integer),
+    prefixes=["TEMPORARY"],
+)
+
+staged_rank = Table(
+    "staged_rank",
+    staged_post.metadata,
+    Column("guid", types.Text, nullable=False),
+    Column("page_url", types.Text, nullable=False, index=True),
+    Column("scheme", types.Text, nullable=False),
+    Column("domain", types.Text, nullable=False),
+    Column("value", types.Float, nullable=False),
+    prefixes=["TEMPORARY"],
+)
+
+POST_METADATA = ("published", "updated", "season", "episode")
+
+
+def same_guid(staged: Any, post: Any) -> ClauseElement:
+    "Match staged posts to stored ones by GUID, using the stored post's index."
+
+    return and_(staged.c.guid_hash == post.c.guid_hash, staged.c.guid == post.c.guid)
+
+
+class StagedDiffPosts(DiffPosts):
+    """
+    Computes the same changes as DiffPosts, but writes the new posts to a
+    temporary table as each page arrives, and then finds the differences
+    using set operations in the database. Memory use doesn't depend on how
+    many posts the feed has, which matters when a crawl has to rewrite an
+    entire large archive.
+
+    Rather than being told about each old post, this assumes the old posts
+    are exactly those on pages at or after `first_replaced_page`, which is
+    what `crawl` provides anyway.
+    """
+
+    wants_old_posts = False
+
+    def __init__(self, connection: Connection) -> None:
+        super().__init__()
+        self.connection = connection
+        staged_post.metadata.create_all(connection)
+
+    def new_page(
+        self, page_url: str, page_id: Optional[int], posts: Mapping[Text, PostMetadata]
+    ) -> None:
+        self.new_pages.append(page_url)
+        if not posts:
+            return
+
+        # INSERT ... SELECT lets the database skip posts we've already seen on
+        # a newer page, without a round trip per post.
+        columns = [
+            staged_post.c.guid,
+            staged_post.c.guid_hash,
+            staged_post.c.page_url,
+        ] + [staged_post.c[name] for name in POST_METADATA]
+        self.connection.execute(
+            staged_post.insert().from_select(
+                columns,
+                select([bindparam(c.name, type_=c.type) for c in columns]).where(
+                    ~exists().where(staged_post.c.guid == bindparam("guid"))
+                ),
+            ),
+            [
+                {
+                    "guid": guid,
+                    "guid_hash": models.hash_guid(guid),
+                    "page_url": page_url,
+                    **post._asdict(),
+                }
+                for guid, post in posts.items()
+            ],
+        )
+
+    def old_post(self, post: RowProxy) -> None:
+        pass
+
+    def page_layout(
+        self, page_url: str, validator: Optional[str], layout: Optional[EntryLayout]
+    ) -> None:
+        # Keep only the page-level parts of the layout in memory; the offsets
+        # of the posts go into the staging table with the posts themselves.
+        super().page_layout(page_url, validator, layout)
+        validator, layout = self.layouts[page_url]
+        if layout is None:
+            return
+
+        self.layouts[page_url] = (validator, layout._replace(spans={}))
+        if layout.spans:
+            self.connection.execute(
+                staged_post.update()
+                .where(staged_post.c.guid == bindparam("post_guid"))
+                .where(staged_post.c.page_url == page_url),
+                [
+                    {
+                        "post_guid": guid,
+                        "entry_offset": start,
+                        "entry_length": end - start,
+                    }
+                    for guid, (start, end) in layout.spans.items()
+                ],
+            )
+
+    def page_ranks(self, page_url: str, ranks: Mapping[Text, Sequence[Rank]]) -> None:
+        if ranks:
+            self.ranks[page_url] = {}
+            self.connection.execute(
+                staged_rank.insert(),
+                [
+                    {"guid": guid, "page_url": page_url, **rank._asdict()}
+                    for guid, post_ranks in ranks.items()
+                    for rank in post_ranks
+                ],
+            )
+
+    def _page_ranks(
+        self, connection: Connection, page_url: str
+    ) -> Mapping[Text, Sequence[Rank]]:
+        if page_url not in self.ranks:
+            return {}
+        ranks: DefaultDict[Text, List[Rank]] = defaultdict(list)
+        for row in connection.execute(
+            select([staged_rank]).where(staged_rank.c.page_url == page_url)
+        ):
+            ranks[row[staged_rank.c.guid]].append(
+                Rank(
+                    row[staged_rank.c.scheme],
+                    row[staged_rank.c.domain],
+                    row[staged_rank.c.value],
+                )
+            )
+        return ranks
+
+    def has_old_posts(self, feed_id: int, connection: Connection) -> bool:
+        return (
+            connection.execute(
+                select([models.post.c.id])
+                .select_from(models.post.join(models.page))
+                .where(models.page.c.feed_id == feed_id)
+                .where(models.page.c.idx >= self.first_replaced_page)
+                .where(~exists().where(same_guid(staged_post, models.post)))
+                .limit(1)
+            ).first()
+            is not None
         )
 
+    def abandon(self, connection: Connection) -> None:
+        staged_post.metadata.drop_all(connection)
+
+    def apply(self, feed_id: int, connection: Connection) -> None:
+        super().apply(feed_id, connection)
+        staged_post.metadata.drop_all(connection)
+
+    def _apply_posts(
+        self, feed_id: int, connection: Connection, page_ids: Dict[str, int]
+    ) -> bool:
+        post = models.post
         connection.execute(
-            models.page.update()
+            staged_post.update().values(
+                page_id=select([models.page.c.id])
+                .where(models.page.c.url == staged_post.c.page_url)
+                .as_scalar()
+            )
+        )
+
+        staged = (
+            select([staged_post])
+            .where(same_guid(staged_post, post))
+            .correlate(post)
+            .alias()
+        )
+
+        def updated(columns: Iterable[str]) -> Dict[str, Any]:
+            return {
+                name: select([staged.c[name]]).as_scalar().correlate(post)
+                for name in columns
+            }
+
+        def differs(columns: Iterable[str]) -> Any:
+            return exists(
+                select([staged.c.guid]).where(
+                    or_(
+                        *(
+                            staged.c[name].is_distinct_from(post.c[name])
+                            for name in columns
+                        )
+                    )
+                )
+            ).correlate(post)
+
+        new_post = (
+            ~exists()
+            .where(post.c.feed_id == feed_id)
+            .where(same_guid(staged_post, post))
+        )
+        replaced_pages = (
+            select([models.page.c.id])
             .where(models.page.c.feed_id == feed_id)
-            .where(models.page.c.idx < 0)
-            .values(idx=-models.page.c.idx + (self.first_replaced_page - 1))
+            .where(
+                or_(
+                    models.page.c.idx >= self.first_replaced_page,
+                    models.page.c.idx < 0,
+                )
+            )
+        )
+        removed = (
+            post.c.feed_id == feed_id,
+            post.c.page_id.in_(replaced_pages),
+            ~exists().where(same_guid(staged_post, post)),
+        )
+
+        changed_columns = ("page_id",) + POST_METADATA
+
+        # Log the changes before making them, while they can still be found
+        # by comparing the staged posts with the stored ones. Every crawl that
+        # logs anything waits for the others to commit, so first check that
+        # there's something to log.
+        changes = [
+            (action, guid, conditions)
+            for action, guid, conditions in [
+                (
+                    "update",
+                    post.c.guid,
+                    (post.c.feed_id == feed_id, differs(changed_columns)),
+                ),
+                ("insert", staged_post.c.guid, (new_post,)),
+                ("delete", post.c.guid, removed),
+            ]
+            if connection.execute(
+                select([exists(select([guid]).where(and_(*conditions)))])
+            ).scalar()
+        ]
+        if changes:
+            lock_change_log(connection)
+        for action, guid, conditions in changes:
+            connection.execute(
+                models.change_log.insert().from_select(
+                    ["feed_id", "guid", "action"],
+                    select([literal(feed_id), guid, literal(action)]).where(
+                        and_(*conditions)
+                    ),
+                )
+            )
+
+        self.touched_pages.update(
+            row[0]
+            for row in connection.execute(
+                select([post.c.page_id])
+                .distinct()
+                .where(post.c.feed_id == feed_id)
+                .where(differs(("page_id",)))
+            )
         )
+        changed = connection.execute(
+            post.update()
+            .where(post.c.feed_id == feed_id)
+            .where(differs(changed_columns))
+            .values(updated(changed_columns))
+        ).rowcount
 
+        offset_columns = ("entry_offset", "entry_length")
+        connection.execute(
+            post.update()
+            .where(post.c.feed_id == feed_id)
+            .where(differs(offset_columns))
+            .values(updated(offset_columns))
+        )
+
+        insert_columns = (
+            ("guid", "guid_hash", "page_id") + POST_METADATA + offset_columns
+        )
+        changed += connection.execute(
+            post.insert().from_select(
+                insert_columns + ("feed_id",),
+                select(
+                    [staged_post.c[name] for name in insert_columns]
+                    + [literal(feed_id)]
+                ).where(new_post),
+            )
+        ).rowcount
+        changed += connection.execute(post.delete().where(and_(*removed))).rowcount
+
+        for _ in self._update_pages(connection, page_ids):
+            pass
+
+        return changed > 0
+
+
+def lock_change_log(connection: Connection) -> None:
+    """
+    Take the lock that orders appends to the change log by commit. It's held
+    until the caller's transaction ends.
+    """
+
+    lock = models.change_log_lock
+    if not connection.execute(
+        lock.update().where(lock.c.id == 1).values(appends=lock.c.appends + 1)
+    ).rowcount:
+        connection.execute(lock.insert().values(id=1, appends=1))
+
+
+# Shared by every crawl in this process, so that once a host or an archive
+# page is known to be failing, no crawl wastes time on it for a while.
+host_breaker = CircuitBreaker(appconfig.BREAKER_THRESHOLD, appconfig.BREAKER_COOLDOWN)
+missing_pages = NegativeCache(appconfig.NEGATIVE_CACHE_TTL)
+
+
+def fetch(
+    url: Text, proxy: Optional[Text], headers: Dict[Text, Text] = {}
+) -> FeedDocument:
+    """
+    Fetch a document for a crawl, unless its server is failing or it has
+    recently been reported missing, in which case raise FetchError without
+    trying. Only archive pages are remembered as missing: a subscription
+    document that has gone away is tracked through the feed's backoff.
+    """
+
+    missing_pages.check(url)
+
+    host = urlsplit(url).netloc
+    host_breaker.check(host, url)
+    try:
+        doc = FeedDocument(url, proxy, headers)
+    except FetchError as error:
+        if error.host_failed:
+            host_breaker.failed(host)
+        else:
+            host_breaker.succeeded(host)
+        raise
+    host_breaker.succeeded(host)
+    return doc
+
+
+class FeedMoved(Exception):
+    """
+    This feed's URL permanently redirects to the URL of another feed we
+    already have, which should be crawled instead.
+    """
+
+    def __init__(self, url: Text, feed_id: int) -> None:
+        super().__init__(f"{url} has moved to feed {feed_id}")
+        self.url = url
+        self.feed_id = feed_id
+
+
+def crawl(
+    feed_id: int, connection: Connection, diff: DiffPosts, revalidate: bool = False
+) -> Tuple[Mapping[Text, Text], FeedHints]:
+    """
+    Fetch this feed's subscription document and any archive pages that have
+    changed, and tell the diff about their posts. Returns the subscription
+    document's response headers and polling hints, for scheduling. If
+    `revalidate` is set, caches must check with the origin for the
+    subscription document, such as when its hub has just said it changed.
+    """
 
-def crawl(feed_id: int, connection: Connection, diff: DiffPosts) -> None:
     feed = connection.execute(
         models.feed.outerjoin(models.proxy)
         .outerjoin(
@@ -161,17 +903,33 @@ def crawl(feed_id: int, connection: Connection, diff: DiffPosts) -> None:
     url = feed[models.feed.c.url]
     proxy = feed[models.proxy.c.url]
 
-    doc = FeedDocument(url, proxy)
+    subscription = fetch(
+        url, proxy, {"Cache-Control": "no-cache"} if revalidate else {}
+    )
+    redirects.record(connection, subscription.redirects)
+    if subscription.url != url:
+        move_feed(feed_id, connection, url, subscription.url)
+        url = subscription.url
+
+    doc = subscription.index(hints=True)
+    hints = (doc.hints or FeedHints())._replace(
+        hub=doc.get_link("hub"), topic=doc.get_link("self") or url
+    )
+    result = (subscription.headers, hints)
 
     subscription_page_id = feed[models.page.c.id]
-    diff.new_page(url, subscription_page_id, doc.posts())
+    diff.new_page(url, subscription_page_id, doc.posts)
+    diff.page_ranks(url, doc.ranks)
 
     if subscription_page_id is not None:
         diff.first_replaced_page = feed[models.page.c.idx]
-        for post in connection.execute(
-            models.post.select().where(models.post.c.page_id == subscription_page_id)
-        ):
-            diff.old_post(post)
+        if diff.wants_old_posts:
+            for post in connection.execute(
+                models.post.select().where(
+                    on_page(connection, feed_id, subscription_page_id)
+                )
+            ):
+                diff.old_post(post)
     else:
         diff.first_replaced_page = connection.execute(
             select([func.count()])
@@ -198,7 +956,10 @@ def crawl(feed_id: int, connection: Connection, diff: DiffPosts) -> None:
     seen: Set[str] = set()
     url = doc.get_link("prev-archive")
 
-    while url is not None and url not in seen:
+    while url is not None:
+        url = redirects.resolve(connection, canonical_url(url))
+        if url in seen:
+            break
         seen.add(url)
 
         old_page = connection.execute(get_old_page, url=url).first()
@@ -207,12 +968,13 @@ def crawl(feed_id: int, connection: Connection, diff: DiffPosts) -> None:
             page_id = old_page[models.page.c.id]
             old_page_idx = old_page[models.page.c.idx]
             if old_page_idx + 1 < diff.first_replaced_page:
-                for post in connection.execute(
-                    get_old_posts.where(models.page.c.idx > old_page_idx).where(
-                        models.page.c.idx < diff.first_replaced_page
-                    )
-                ):
-                    diff.old_post(post)
+                if diff.wants_old_posts:
+                    for post in connection.execute(
+                        get_old_posts.where(models.page.c.idx > old_page_idx).where(
+                            models.page.c.idx < diff.first_replaced_page
+                        )
+                    ):
+                        diff.old_post(post)
 
                 diff.first_replaced_page = old_page_idx + 1
 
@@ -222,21 +984,298 @@ def crawl(feed_id: int, connection: Connection, diff: DiffPosts) -> None:
             # after this point, but that we haven't seen so far on this crawl,
             # then we need to check back further to figure out which page those
             # posts were on, if any.
-            if not diff.old_posts:
-                return
+            if not diff.has_old_posts(feed_id, connection):
+                return result
 
         # Archive feed documents aren't supposed to change without being moved
         # to a new URL, so if there's a copy in cache it's supposed to be okay
         # to just use it.
-        doc = FeedDocument(url, proxy, headers={"Cache-Control": "max-stale"})
-        diff.new_page(url, page_id, doc.posts())
+        try:
+            page = fetch(url, proxy, headers={"Cache-Control": "max-stale"})
+        except FetchError as error:
+            if error.gone:
+                missing_pages.put(url, error)
+            raise
+        if page.redirects:
+            # Start this page over at its new URL, which we may already have.
+            redirects.record(connection, page.redirects)
+            continue
+        doc = page.index(layout=True)
+        diff.new_page(url, page_id, doc.posts)
+        diff.page_ranks(url, doc.ranks)
+        diff.page_layout(url, page.validator, doc.layout)
         url = doc.get_link("prev-archive")
 
     # We've checked all the (possibly empty) archives without finding an
     # unchanged prefix, so we need to rewrite all pages.
+    if diff.wants_old_posts:
+        for post in connection.execute(
+            get_old_posts.where(
+                models.page.c.idx < diff.first_replaced_page
+            ).execution_options(stream_results=True)
+        ):
+            diff.old_post(post)
+
+    diff.first_replaced_page = 0
+    return result
+
+
+def move_feed(feed_id: int, connection: Connection, old_url: Text, url: Text) -> None:
+    """
+    Give this feed, and its subscription page, a new URL. If some other feed
+    already has that URL, this is a duplicate of it, so raise FeedMoved.
+    """
+
+    other = connection.execute(
+        select([models.feed.c.id]).where(models.feed.c.url == url)
+    ).scalar()
+    if other is not None:
+        raise FeedMoved(old_url, other)
+
+    connection.execute(
+        models.feed.update().where(models.feed.c.id == feed_id).values(url=url)
+    )
+    connection.execute(
+        models.page.update()
+        .where(models.page.c.feed_id == feed_id)
+        .where(models.page.c.url == old_url)
+        .values(url=url)
+    )
+
+
+def merge_feed(feed_id: int, connection: Connection, into: int) -> None:
+    """
+    Empty out a feed which turned out to be a duplicate of another, leaving a
+    note in its properties so readers can be sent to the other one instead.
+    """
+
+    diff = DiffPosts()
     for post in connection.execute(
-        get_old_posts.where(models.page.c.idx < diff.first_replaced_page)
+        models.post.select().where(models.post.c.feed_id == feed_id)
     ):
         diff.old_post(post)
+    diff.apply(feed_id, connection)
 
-    diff.first_replaced_page = 0
+    connection.execute(models.websub.delete().where(models.websub.c.feed_id == feed_id))
+    properties = dict(
+        connection.execute(
+            select([models.feed.c.properties]).where(models.feed.c.id == feed_id)
+        ).scalar()
+        or {}
+    )
+    properties["merged_into"] = into
+    # Nothing polls a merged feed again, so it shouldn't keep coming up as the
+    # most overdue feed in every batch.
+    connection.execute(
+        models.feed.update()
+        .where(models.feed.c.id == feed_id)
+        .values(properties=properties, next_check=datetime.datetime.max)
+    )
+
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """
+    Lets concurrent callers asking for the same thing share a single attempt
+    at it: whoever asks first does the work, and anyone who asks for the same
+    key before it's done waits for and gets the same result or exception.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.flights: Dict[Hashable, "Future[Any]"] = {}
+
+    def run(self, key: Hashable, work: Callable[[], T]) -> T:
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if flight is None:
+                flight = self.flights[key] = Future()
+
+        if not leader:
+            return cast(T, flight.result())
+
+        try:
+            result = work()
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        else:
+            flight.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.flights[key]
+
+
+crawls_in_flight = SingleFlight()
+
+
+def refresh_feed(
+    feed_id: int,
+    connection: Connection,
+    fresh_for: datetime.timedelta,
+    revalidate: bool = False,
+) -> bool:
+    """
+    Crawl this feed and apply the changes, unless another crawl finished
+    within the last `fresh_for`. Returns whether it crawled.
+
+    This locks the feed's row for the rest of the caller's transaction, so if
+    another process is crawling the same feed, this waits for that crawl to
+    commit and then, usually, finds it fresh enough to use.
+
+    If the crawl fails, or the feed is still backing off from an earlier
+    failure, this raises FetchError with its `retry_at` set. Any failure is
+    recorded in the feed's row by then, so the caller should still commit.
+    Likewise, if the feed turns out to have moved to another feed's URL, this
+    merges it into that feed and raises FeedMoved.
+    """
+
+    with tracing.span("crawl", feed_id=feed_id):
+        with profiling.profile_if_slow(f"feed-{feed_id}"):
+            return _refresh_feed(feed_id, connection, fresh_for, revalidate)
+
+
+def _refresh_feed(
+    feed_id: int,
+    connection: Connection,
+    fresh_for: datetime.timedelta,
+    revalidate: bool,
+) -> bool:
+    feed = connection.execute(
+        select(
+            [
+                models.feed.c.url,
+                models.feed.c.crawled,
+                models.feed.c.next_check,
+                models.feed.c.properties,
+            ]
+        )
+        .where(models.feed.c.id == feed_id)
+        .with_for_update()
+    ).first()
+    url, crawled, next_check, properties = feed
+
+    now = datetime.datetime.utcnow()
+    if crawled is not None and now - crawled < fresh_for:
+        return False
+
+    failure = (properties or {}).get("failure")
+    if failure is not None and next_check > now:
+        error = FetchError(
+            url,
+            "backing off after {} failures, most recently {}".format(
+                failure["count"], failure["error"]
+            ),
+            failure["status"],
+        )
+        error.retry_at = next_check
+        raise error
+
+    diff = StagedDiffPosts(connection) if appconfig.STAGED_DIFF else DiffPosts()
+    try:
+        headers, hints = crawl(feed_id, connection, diff, revalidate)
+    except FetchError as error:
+        diff.abandon(connection)
+        error.retry_at = backoff(feed_id, connection, error, now)
+        raise
+    except FeedMoved as moved:
+        diff.abandon(connection)
+        merge_feed(feed_id, connection, moved.feed_id)
+        raise
+    finish_crawl(feed_id, connection, diff, headers, hints)
+    return True
+
+
+def finish_crawl(
+    feed_id: int,
+    connection: Connection,
+    diff: DiffPosts,
+    headers: Mapping[Text, Text],
+    hints: FeedHints,
+) -> None:
+    "Apply a successful crawl's changes, and schedule the feed's next one."
+
+    with tracing.span("apply", feed_id=feed_id):
+        diff.apply(feed_id, connection)
+    lease = websub.update(feed_id, connection, hints)
+    reschedule(feed_id, connection, headers, hints, lease=lease)
+
+    connection.execute(
+        models.feed.update()
+        .where(models.feed.c.id == feed_id)
+        .values(crawled=datetime.datetime.utcnow())
+    )
+
+
+def subscribe(url: str) -> int:
+    "Find the feed with this URL, adding it if necessary, and return its ID."
+
+    query = select([models.feed.c.id]).where(models.feed.c.url == url)
+    with appconfig.get_engine().begin() as connection:
+        feed_id = connection.execute(query).scalar()
+        if feed_id is not None:
+            return cast(int, feed_id)
+
+    try:
+        with appconfig.get_engine().begin() as connection:
+            result = connection.execute(models.feed.insert().values(url=url))
+            return cast(int, result.inserted_primary_key[0])
+    except IntegrityError:
+        # Another process added this feed since we checked.
+        with appconfig.get_engine().begin() as connection:
+            return cast(int, connection.execute(query).scalar())
+
+
+def refresh(
+    url: str,
+    fresh_for: Optional[datetime.timedelta] = None,
+    revalidate: bool = False,
+) -> int:
+    """
+    Subscribe to the feed at this URL if necessary, bring it up to date, and
+    return its ID. Concurrent requests for the same feed in this process share
+    one crawl, and requests from other processes wait on the feed's row lock,
+    so a popular feed is only fetched once no matter how many people ask.
+    Raises FetchError if the feed couldn't be crawled.
+
+    Variations on the URL which can't refer to different documents, and URLs
+    which we've seen permanently redirected, all find the same feed. If the
+    feed turns out to have moved to another feed's URL, this merges the two
+    and refreshes the other one instead.
+
+    Afterward, if the feed names a WebSub hub we aren't subscribed to yet,
+    ask the hub to subscribe us.
+    """
+
+    freshness = appconfig.CRAWL_FRESHNESS if fresh_for is None else fresh_for
+    with appconfig.get_engine().begin() as connection:
+        url = redirects.resolve(connection, canonical_url(url))
+
+    def work() -> Union[int, FeedMoved]:
+        feed_id = subscribe(url)
+        failed = None
+        with appconfig.get_engine().begin() as connection:
+            try:
+                refresh_feed(feed_id, connection, freshness, revalidate)
+            except FetchError as error:
+                # Commit the record of this failure before reporting it.
+                failed = error
+            except FeedMoved as moved:
+                # Likewise, commit the merge before moving on.
+                return moved
+        if failed is not None:
+            raise failed
+        if appconfig.WEBSUB_CALLBACK_URL is not None:
+            websub.send_request(feed_id)
+        return feed_id
+
+    # A crawl prompted by a hub's notification mustn't share one which may
+    # have fetched the feed before the change it's about.
+    result = crawls_in_flight.run((url, revalidate), work)
+    if isinstance(result, FeedMoved):
+        return refresh(url, fresh_for, revalidate)
+    return result
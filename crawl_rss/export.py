@@ -0,0 +1,216 @@
+"""
+Write out the post index of some or all feeds, one line per post.
+
+    python -m crawl_rss.export [--format ndjson|csv] [FEED_ID ...]
+
+Each post comes with the URL of the archive page it's on, its dates, and its
+season and episode. Nothing is fetched: this only reads the database, a row at
+a time, so it takes the same memory no matter how many posts there are.
+"""
+
+import argparse
+import csv
+import datetime
+import io
+import json
+import queue
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql import select
+import sys
+import threading
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    Optional,
+    Sequence,
+    Union,
+)
+from . import appconfig, models
+
+
+COLUMNS = (
+    models.post.c.feed_id,
+    models.post.c.guid,
+    models.page.c.url.label("page_url"),
+    models.post.c.published,
+    models.post.c.updated,
+    models.post.c.season,
+    models.post.c.episode,
+)
+FIELDS = ("feed_id", "guid", "page_url", "published", "updated", "season", "episode")
+
+# Hand output over in chunks of about this many bytes, rather than a line at
+# a time.
+CHUNK_SIZE = 64 * 1024
+
+# How many chunks an export running on its own thread may get ahead of
+# whoever is reading it.
+QUEUED_CHUNKS = 4
+
+
+def export_rows(
+    connection: Connection, feed_ids: Optional[Sequence[int]] = None
+) -> Iterator[Dict[str, Any]]:
+    """
+    Every post of the given feeds, or of all feeds if none are given, in
+    order by feed. Rows are read through a server-side cursor where the
+    database supports one.
+    """
+
+    if not feed_ids:
+        feed_ids = [
+            row[0]
+            for row in connection.execute(
+                select([models.feed.c.id]).order_by(models.feed.c.id)
+            )
+        ]
+
+    query = (
+        select(COLUMNS)
+        .select_from(models.post.join(models.page))
+        .order_by(models.post.c.id)
+        .execution_options(stream_results=True)
+    )
+    for feed_id in feed_ids:
+        for row in connection.execute(query.where(models.post.c.feed_id == feed_id)):
+            yield dict(zip(FIELDS, row))
+
+
+def _value(value: Any) -> Any:
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def _chunked(lines: Iterable[str]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    for line in lines:
+        buffer.write(line)
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue().encode("utf-8")
+            buffer = io.StringIO()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def format_ndjson(rows: Iterable[Dict[str, Any]]) -> Iterator[bytes]:
+    """
+    >>> row = {"guid": "urn:example:1", "published": datetime.datetime(2020, 1, 1)}
+    >>> b"".join(format_ndjson([row]))
+    b'{"guid":"urn:example:1","published":"2020-01-01T00:00:00"}\\n'
+    """
+
+    return _chunked(
+        json.dumps(
+            {name: _value(value) for name, value in row.items()},
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+        + "\n"
+        for row in rows
+    )
+
+
+def format_csv(rows: Iterable[Dict[str, Any]]) -> Iterator[bytes]:
+    """
+    >>> row = dict.fromkeys(FIELDS)
+    >>> row.update(feed_id=1, guid="urn:example:1", episode=2)
+    >>> print(b"".join(format_csv([row])).decode(), end="")
+    feed_id,guid,page_url,published,updated,season,episode
+    1,urn:example:1,,,,,2
+    """
+
+    def lines() -> Iterator[str]:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(FIELDS)
+        for row in rows:
+            writer.writerow([_value(row[name]) for name in FIELDS])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    return _chunked(lines())
+
+
+FORMATS: Dict[str, Callable[[Iterable[Dict[str, Any]]], Iterator[bytes]]] = {
+    "ndjson": format_ndjson,
+    "csv": format_csv,
+}
+
+# Starlette adds "; charset=utf-8" to text types itself.
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def export(feed_ids: Sequence[int], output_format: str) -> Iterator[bytes]:
+    "Stream an export from the read replica, if there is one."
+
+    with appconfig.get_read_engine().connect() as connection:
+        yield from FORMATS[output_format](export_rows(connection, feed_ids))
+
+
+def export_on_thread(feed_ids: Sequence[int], output_format: str) -> Iterator[bytes]:
+    """
+    Like `export`, but read the database on a thread of its own. A database
+    connection may only be used from the thread which opened it, and servers
+    may ask for each chunk from whichever thread is free.
+    """
+
+    chunks: "queue.Queue[Union[bytes, Exception, None]]" = queue.Queue(QUEUED_CHUNKS)
+    stopped = threading.Event()
+
+    def produce() -> None:
+        result: Union[Exception, None] = None
+        try:
+            for chunk in export(feed_ids, output_format):
+                if stopped.is_set():
+                    return
+                chunks.put(chunk)
+        except Exception as e:
+            result = e
+        if not stopped.is_set():
+            chunks.put(result)
+
+    thread = threading.Thread(target=produce, name="export", daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        # If the reader gave up early, make room for the producer's last put
+        # so that it gets to notice and close its connection.
+        stopped.set()
+        while True:
+            try:
+                chunks.get_nowait()
+            except queue.Empty:
+                break
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m crawl_rss.export",
+        description=__doc__.split("\n\n")[0].strip(),
+    )
+    parser.add_argument("--format", choices=sorted(FORMATS), default="ndjson")
+    parser.add_argument("feed_ids", metavar="FEED_ID", type=int, nargs="*")
+    args = parser.parse_args()
+
+    for chunk in export(args.feed_ids, args.format):
+        sys.stdout.buffer.write(chunk)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import math
+import threading
+import time
+from typing import Callable, Dict, Optional, Text, Tuple
+from .feeds import FetchError
+
+
+class CircuitBreaker:
+    """
+    Tracks consecutive failures per host. Once a host has failed `threshold`
+    times in a row, stop sending it requests for `cooldown` seconds, then let
+    requests through again: one success closes the circuit, while another
+    failure opens it for another cool-down.
+    """
+
+    def __init__(
+        self,
+        threshold: int,
+        cooldown: float,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.lock = threading.Lock()
+        # host -> (consecutive failures, when the circuit may close again)
+        self.hosts: Dict[Text, Tuple[int, float]] = {}
+
+    def check(self, host: Text, url: Text) -> None:
+        "Raise FetchError if requests to this host are currently cut off."
+
+        with self.lock:
+            failures, until = self.hosts.get(host, (0, 0.0))
+        remaining = until - self.clock()
+        if failures >= self.threshold and remaining > 0:
+            raise FetchError(
+                url, f"{host} failed {failures} times; waiting {remaining:.0f}s"
+            )
+
+    def succeeded(self, host: Text) -> None:
+        with self.lock:
+            self.hosts.pop(host, None)
+
+    def failed(self, host: Text) -> None:
+        with self.lock:
+            failures = self.hosts.get(host, (0, 0.0))[0] + 1
+            self.hosts[host] = (failures, self.clock() + self.cooldown)
+
+
+class NegativeCache:
+    """
+    Remembers documents which the server said don't exist, so we don't ask
+    for them again for `ttl` seconds. Only the status is kept, and every hit
+    raises a FetchError of its own, so callers may annotate the error they
+    get without affecting anyone else's.
+    """
+
+    def __init__(self, ttl: float, clock: Callable[[], float] = time.monotonic) -> None:
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        # url -> (HTTP status, when to ask again)
+        self.entries: Dict[Text, Tuple[Optional[int], float]] = {}
+
+    def check(self, url: Text) -> None:
+        """
+        Raise FetchError if this document was recently reported missing. Its
+        Retry-After header says when the entry runs out, so that a feed which
+        backs off because of it doesn't retry while it would still hit.
+        """
+
+        with self.lock:
+            if url not in self.entries:
+                return
+            status, expires = self.entries[url]
+            remaining = expires - self.clock()
+            if remaining <= 0:
+                del self.entries[url]
+                return
+        raise FetchError(
+            url,
+            f"HTTP {status} less than {self.ttl:.0f}s ago",
+            status,
+            {"retry-after": str(math.ceil(remaining))},
+        )
+
+    def put(self, url: Text, error: FetchError) -> None:
+        with self.lock:
+            now = self.clock()
+            self.entries[url] = (error.status, now + self.ttl)
+            # Don't let entries for feeds nobody asks about again pile up.
+            for key in [
+                k for k, (_, expires) in self.entries.items() if expires <= now
+            ]:
+                del self.entries[key]
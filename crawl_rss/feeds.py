@@ -1,9 +1,29 @@
 import datetime
-import feedparser
+import io
 from sqlalchemy.engine import RowProxy
-from typing import cast, Dict, Mapping, NamedTuple, Optional, Text
+from typing import (
+    AbstractSet,
+    Any,
+    cast,
+    Dict,
+    FrozenSet,
+    List,
+    Mapping,
+    NamedTuple,
+    Optional,
+    Text,
+    Tuple,
+    TYPE_CHECKING,
+)
+from urllib.parse import urlsplit, urlunsplit
+from xml.parsers import expat
 from . import appconfig
 from . import models
+from . import tracing
+
+# feedparser is slow to import and only needed once we actually fetch a feed.
+if TYPE_CHECKING:
+    import feedparser
 
 
 class PostMetadata(NamedTuple):
@@ -13,7 +33,7 @@ class PostMetadata(NamedTuple):
     episode: Optional[int] = None
 
     @classmethod
-    def from_parsed(cls, entry: feedparser.FeedParserDict) -> "PostMetadata":
+    def from_parsed(cls, entry: "feedparser.FeedParserDict") -> "PostMetadata":
         published = entry.get("published_parsed")
         # feedparser defaults "updated" to match "published" if not otherwise
         # set, but emits a loud warning if trip that check. This does the same
@@ -38,20 +58,583 @@ class PostMetadata(NamedTuple):
         )
 
 
+class EntryLayout(NamedTuple):
+    """
+    Where each entry is in the raw bytes of a feed document. Everything before
+    `head` is the root element and any feed metadata that precedes the
+    entries. If the whole document was scanned, everything from `tail` onward
+    is whatever follows the last entry; either way, `closing` has end tags
+    for all the elements enclosing the entries.
+    """
+
+    head: int
+    tail: Optional[int]
+    closing: bytes
+    spans: Dict[Text, Tuple[int, int]]
+
+
+ENTRY_TAGS = {"entry", "item"}
+ENTRY_PARENT_TAGS = {"feed", "channel", "RDF"}
+ENTRY_ID_TAGS = {"id", "guid"}
+SCAN_CHUNK = 64 * 1024
+
+
+def local_name(name: Text) -> Text:
+    return name.rpartition(":")[2]
+
+
+def scan_entries(
+    content: bytes, wanted: Optional[AbstractSet[Text]] = None
+) -> Optional[EntryLayout]:
+    """
+    Find the byte range and ID of each entry in a feed document, without the
+    cost of feedparser's full parse. If `wanted` is given, stop as soon as all
+    of those IDs have been found. Returns None for documents this can't
+    handle, such as ones which aren't well-formed XML or which aren't in an
+    ASCII-compatible encoding; callers should fall back to feedparser then.
+    """
+
+    if content[:2] in (b"\xfe\xff", b"\xff\xfe") or b"\x00" in content[:4]:
+        return None
+
+    parser = expat.ParserCreate()
+    stack: List[Text] = []
+    spans: Dict[Text, Tuple[int, int]] = {}
+    head: Optional[int] = None
+    closing: Optional[bytes] = None
+    entry_depth: Optional[int] = None
+    entry_start = entry_end = 0
+    entry_id: Optional[Text] = None
+    id_text: Optional[List[Text]] = None
+
+    def start_element(name: Text, attrs: Dict[Text, Text]) -> None:
+        nonlocal head, entry_depth, entry_start, entry_id, id_text
+        if entry_depth is None:
+            if local_name(name) in ENTRY_TAGS and (
+                stack and local_name(stack[-1]) in ENTRY_PARENT_TAGS
+            ):
+                entry_depth = len(stack)
+                entry_start = parser.CurrentByteIndex
+                if head is None:
+                    head = entry_start
+                # RSS 1.0 identifies items by their rdf:about attribute.
+                entry_id = next(
+                    (v for k, v in attrs.items() if local_name(k) == "about"), None
+                )
+        elif len(stack) == entry_depth + 1 and local_name(name) in ENTRY_ID_TAGS:
+            id_text = []
+        stack.append(name)
+
+    def end_element(name: Text) -> None:
+        nonlocal entry_depth, entry_end, entry_id, id_text, closing
+        stack.pop()
+        if id_text is not None:
+            entry_id = "".join(id_text)
+            id_text = None
+        elif entry_depth is not None and len(stack) == entry_depth:
+            entry_depth = None
+            entry_end = content.index(b">", parser.CurrentByteIndex) + 1
+            if entry_id and entry_id.strip():
+                spans[entry_id.strip()] = (entry_start, entry_end)
+            entry_id = None
+            if wanted is not None and wanted <= spans.keys() and closing is None:
+                try:
+                    closing = b"".join(
+                        b"</" + tag.encode("ascii") + b">" for tag in reversed(stack)
+                    )
+                except UnicodeEncodeError:
+                    pass
+
+    def character_data(data: Text) -> None:
+        if id_text is not None:
+            id_text.append(data)
+
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+
+    try:
+        for offset in range(0, len(content), SCAN_CHUNK):
+            parser.Parse(content[offset : offset + SCAN_CHUNK], False)
+            if closing is not None:
+                assert head is not None
+                return EntryLayout(head=head, tail=None, closing=closing, spans=spans)
+        parser.Parse(b"", True)
+    except (expat.ExpatError, ValueError):
+        return None
+
+    if head is None:
+        return EntryLayout(head=len(content), tail=len(content), closing=b"", spans={})
+    return EntryLayout(head=head, tail=entry_end, closing=b"", spans=spans)
+
+
+def excerpt(content: bytes, layout: EntryLayout, guids: AbstractSet[Text]) -> bytes:
+    "Cut a feed document down to only the entries with the given IDs."
+
+    pieces = [content[: layout.head]]
+    pieces.extend(
+        content[start:end]
+        for start, end in sorted(layout.spans[guid] for guid in guids)
+    )
+    pieces.append(content[layout.tail :] if layout.tail is not None else layout.closing)
+    return b"".join(pieces)
+
+
+class Rank(NamedTuple):
+    "One entry's position in a publisher-defined ordering."
+
+    scheme: Text
+    domain: Text
+    value: float
+
+
+# https://tools.ietf.org/html/draft-snell-atompub-feed-index-10
+RANK_NS = "http://purl.org/atompub/rank/1.0"
+
+
+def scan_ranks(content: bytes) -> Dict[Text, Tuple[Rank, ...]]:
+    """
+    Find the feed-index ranks of each entry in a feed document, by entry ID.
+    feedparser drops the attributes that say which ordering a rank is for,
+    so we have to look for these ourselves. An entry may have a rank in any
+    number of schemes and domains, but only one per pair.
+
+    >>> ranks = scan_ranks(
+    ...     b'<feed xmlns="http://www.w3.org/2005/Atom" xmlns:r="%s">'
+    ...     b'<entry><id>urn:1</id><r:rank scheme="urn:s">2.5</r:rank></entry>'
+    ...     b'<entry><id>urn:2</id><r:rank scheme="urn:s" domain="urn:d">1</r:rank>'
+    ...     b'<r:rank scheme="urn:s" domain="urn:d">3</r:rank></entry>'
+    ...     b"</feed>" % RANK_NS.encode()
+    ... )
+    >>> ranks["urn:1"]
+    (Rank(scheme='urn:s', domain='', value=2.5),)
+    >>> ranks["urn:2"]
+    (Rank(scheme='urn:s', domain='urn:d', value=1.0),)
+    """
+
+    parser = expat.ParserCreate(namespace_separator=" ")
+    stack: List[Text] = []
+    text: List[Text] = []
+    ranks: Dict[Text, Tuple[Rank, ...]] = {}
+    entry_depth: Optional[int] = None
+    entry_id: Optional[Text] = None
+    entry_ranks: Dict[Tuple[Text, Text], Rank] = {}
+    rank_attrs: Optional[Dict[Text, Text]] = None
+
+    def start_element(name: Text, attrs: Dict[Text, Text]) -> None:
+        nonlocal entry_depth, entry_id, rank_attrs
+        local = name.rpartition(" ")[2]
+        if entry_depth is None:
+            if local in ENTRY_TAGS and (
+                stack and stack[-1].rpartition(" ")[2] in ENTRY_PARENT_TAGS
+            ):
+                entry_depth = len(stack)
+                entry_id = next(
+                    (v for k, v in attrs.items() if k.endswith(" about")), None
+                )
+                entry_ranks.clear()
+        elif len(stack) == entry_depth + 1:
+            if name == RANK_NS + " rank" and "scheme" in attrs:
+                rank_attrs = attrs
+        stack.append(name)
+        text.clear()
+
+    def end_element(name: Text) -> None:
+        nonlocal entry_depth, entry_id, rank_attrs
+        stack.pop()
+        value = "".join(text).strip()
+        text.clear()
+        if entry_depth is None:
+            return
+        if len(stack) == entry_depth:
+            if entry_id and entry_ranks:
+                ranks[entry_id.strip()] = tuple(entry_ranks.values())
+            entry_depth = None
+        elif len(stack) == entry_depth + 1:
+            if rank_attrs is not None:
+                key = (rank_attrs["scheme"], rank_attrs.get("domain", ""))
+                try:
+                    entry_ranks.setdefault(key, Rank(*key, float(value)))
+                except ValueError:
+                    pass
+                rank_attrs = None
+            elif name.rpartition(" ")[2] in ENTRY_ID_TAGS:
+                entry_id = value
+
+    def character_data(data: Text) -> None:
+        text.append(data)
+
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+
+    try:
+        parser.Parse(content, True)
+    except (expat.ExpatError, ValueError):
+        pass
+    return ranks
+
+
+class FeedHints(NamedTuple):
+    """
+    What a feed says about how often it's worth polling: RSS 2.0's `ttl`, in
+    minutes, and the `skipHours` (in GMT) and `skipDays` during which readers
+    shouldn't bother. Days are numbered from Monday as 0, like
+    `datetime.weekday()`. Also, whether there's a WebSub `hub` which can
+    notify us of changes instead, and the `topic` URL to subscribe to there.
+    """
+
+    ttl: Optional[int] = None
+    skip_hours: FrozenSet[int] = frozenset()
+    skip_days: FrozenSet[int] = frozenset()
+    hub: Optional[Text] = None
+    topic: Optional[Text] = None
+
+
+WEEKDAYS = {
+    day: number
+    for number, day in enumerate(
+        ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+    )
+}
+
+
+def scan_hints(content: bytes) -> FeedHints:
+    """
+    Find a feed's polling hints. feedparser keeps only the last of each
+    `hour` and `day`, so we look for these ourselves.
+
+    >>> scan_hints(
+    ...     b"<rss><channel><ttl>60</ttl>"
+    ...     b"<skipHours><hour>1</hour><hour>2</hour></skipHours>"
+    ...     b"<skipDays><day>Sunday</day></skipDays></channel></rss>"
+    ... )[:3]
+    (60, frozenset({1, 2}), frozenset({6}))
+    """
+
+    parser = expat.ParserCreate()
+    stack: List[Text] = []
+    text: List[Text] = []
+    ttl: Optional[int] = None
+    skip_hours = set()
+    skip_days = set()
+
+    def start_element(name: Text, attrs: Dict[Text, Text]) -> None:
+        stack.append(local_name(name))
+        text.clear()
+
+    def end_element(name: Text) -> None:
+        nonlocal ttl
+        value = "".join(text).strip()
+        text.clear()
+        path = tuple(stack[-3:])
+        stack.pop()
+        try:
+            if path[-2:] == ("channel", "ttl"):
+                ttl = int(value)
+            elif path == ("channel", "skipHours", "hour"):
+                skip_hours.add(int(value) % 24)
+            elif path == ("channel", "skipDays", "day"):
+                skip_days.add(WEEKDAYS[value.lower()])
+        except (ValueError, KeyError):
+            pass
+
+    def character_data(data: Text) -> None:
+        text.append(data)
+
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+
+    try:
+        parser.Parse(content, True)
+    except (expat.ExpatError, ValueError):
+        pass
+
+    return FeedHints(
+        ttl=ttl, skip_hours=frozenset(skip_hours), skip_days=frozenset(skip_days)
+    )
+
+
+class FeedIndex(NamedTuple):
+    """
+    Just the parts of a feed document that the crawler needs. Unlike a full
+    parse result, this is small and cheap to send back from a worker process.
+    """
+
+    links: Tuple[Tuple[Text, Text], ...]
+    posts: Mapping[Text, PostMetadata]
+    layout: Optional[EntryLayout] = None
+    hints: Optional[FeedHints] = None
+    ranks: Mapping[Text, Tuple[Rank, ...]] = {}
+
+    def get_link(self, rel: Text) -> Optional[Text]:
+        for link_rel, href in self.links:
+            if link_rel == rel:
+                return href
+        return None
+
+
+def parse(content: bytes, headers: Mapping[Text, Text]) -> "feedparser.FeedParserDict":
+    import feedparser
+
+    # Wrap the content so feedparser can't mistake it for a URL or filename.
+    return feedparser.parse(io.BytesIO(content), response_headers=headers)
+
+
+def index_of(doc: "feedparser.FeedParserDict") -> FeedIndex:
+    links = tuple(
+        (link.rel, cast(Text, link.href))
+        for link in doc.feed.get("links", ())
+        if "rel" in link and "href" in link
+    )
+    posts = {}
+    for raw_entry in doc.entries:
+        guid = cast(Text, raw_entry.get("id"))
+        if guid:
+            posts[guid] = PostMetadata.from_parsed(raw_entry)
+    return FeedIndex(links=links, posts=posts)
+
+
+def parse_index(
+    content: bytes,
+    headers: Mapping[Text, Text],
+    layout: bool = False,
+    hints: bool = False,
+) -> FeedIndex:
+    "Parse a feed document in whatever process this is called from."
+
+    index = index_of(parse(content, headers))
+    # Most feeds don't use feed-index ranks, so don't scan them for no reason.
+    if RANK_NS.encode() in content:
+        index = index._replace(ranks=scan_ranks(content))
+    if layout:
+        index = index._replace(layout=scan_entries(content))
+    if hints:
+        index = index._replace(hints=scan_hints(content))
+    return index
+
+
+def validator_of(headers: Mapping[Text, Text]) -> Optional[Text]:
+    """
+    Pick a response header which will change if the document does. Weak ETags
+    don't promise byte-for-byte identical content, so they won't do.
+
+    >>> validator_of({"etag": '"abc"', "last-modified": "yesterday"})
+    '"abc"'
+    >>> validator_of({"etag": 'W/"abc"', "last-modified": "yesterday"})
+    'yesterday'
+    >>> validator_of({}) is None
+    True
+    """
+
+    etag = headers.get("etag")
+    if etag is not None and not etag.startswith("W/"):
+        return etag
+    return headers.get("last-modified")
+
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+# Statuses which mean a document has moved for good, so we should go straight
+# to its new URL from now on.
+PERMANENT_REDIRECTS = (301, 308)
+
+
+def canonical_url(url: Text) -> Text:
+    """
+    Normalize the parts of a URL which can't change what it refers to: the
+    case of the scheme and host, a default port, an empty path, and the
+    fragment. Anything else, such as whether http and https are the same
+    feed, is up to the server, which can tell us with a permanent redirect.
+
+    >>> canonical_url("HTTP://Feed.Example:80/#top")
+    'http://feed.example'
+    >>> canonical_url("https://feed.example:8443/Feed/?page=1")
+    'https://feed.example:8443/Feed/?page=1'
+    """
+
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS or not parts.hostname:
+        return url
+
+    userinfo, _, _ = parts.netloc.rpartition("@")
+    host = parts.hostname
+    if ":" in host:
+        host = f"[{host}]"
+    netloc = f"{userinfo}@{host}" if userinfo else host
+    if port is not None and port != DEFAULT_PORTS[scheme]:
+        netloc += f":{port}"
+    path = "" if parts.path == "/" and not parts.query else parts.path
+    return urlunsplit((scheme, netloc, path, parts.query, ""))
+
+
+class FetchError(Exception):
+    """
+    A feed document couldn't be fetched: either there was no response, or
+    there was an error response, whose status and headers are kept here.
+    """
+
+    def __init__(
+        self,
+        url: Text,
+        message: Text,
+        status: Optional[int] = None,
+        headers: Mapping[Text, Text] = {},
+    ) -> None:
+        super().__init__(f"{url}: {message}")
+        self.url = url
+        self.status = status
+        self.headers = headers
+        # When whoever raised this thinks it's worth trying again, if known.
+        self.retry_at: Optional[datetime.datetime] = None
+
+    @property
+    def gone(self) -> bool:
+        "Whether the server says there's no such document."
+        return self.status in (404, 410)
+
+    @property
+    def host_failed(self) -> bool:
+        """
+        Whether this error suggests the whole server is in trouble, not just
+        this one document.
+        """
+        return self.status is None or self.status == 429 or self.status >= 500
+
+
 class FeedDocument:
     def __init__(
-        self, url: Text, proxy: Optional[Text] = None, headers: Dict[Text, Text] = {}
+        self,
+        url: Text,
+        proxy: Optional[Text] = None,
+        headers: Dict[Text, Text] = {},
+        timeout: Optional[float] = None,
     ):
-        response = appconfig.http_client.get(
-            url if proxy is None else proxy + url, headers=headers
-        )
-        response.raise_for_status()
+        import httpx
 
-        if "content-location" not in response.headers:
+        client = appconfig.get_http_client()
+        target = url if proxy is None else proxy + url
+        with tracing.span("fetch", **{"http.url": url, "proxy": proxy}) as span:
+            try:
+                # With no timeout given, use the client's default.
+                if timeout is None:
+                    response = client.get(target, headers=headers)
+                else:
+                    response = client.get(target, headers=headers, timeout=timeout)
+                response.raise_for_status()
+            except httpx.HTTPStatusError as e:
+                raise FetchError(
+                    url,
+                    f"HTTP {e.response.status_code}",
+                    e.response.status_code,
+                    dict(e.response.headers),
+                ) from e
+            except httpx.HTTPError as e:
+                raise FetchError(url, str(e) or type(e).__name__) from e
+            if span is not None:
+                span.set_attribute("http.status_code", response.status_code)
+                span.set_attribute(
+                    "http.response_content_length", len(response.content)
+                )
+
+        self.content = response.content
+        self.headers = dict(response.headers)
+        if "content-location" not in self.headers:
             assert response.url is not None
-            response.headers["content-location"] = str(response.url)
+            self.headers["content-location"] = str(response.url)
+
+        # Where this document lives now, as far as permanent redirects say,
+        # and each of those redirects, in terms of the origin's URLs.
+        self.url = url
+        self.redirects: List[Tuple[Text, Text]] = []
+        hops = response.history + [response]
+        for previous, following in zip(hops, hops[1:]):
+            if previous.status_code not in PERMANENT_REDIRECTS:
+                break
+            target = str(following.url)
+            if proxy is not None:
+                if not target.startswith(proxy):
+                    break
+                target = target[len(proxy) :]
+            target = canonical_url(target)
+            self.redirects.append((self.url, target))
+            self.url = target
+
+        self._doc: Optional["feedparser.FeedParserDict"] = None
+
+    @property
+    def doc(self) -> "feedparser.FeedParserDict":
+        "The full parse of this document, computed on first use."
+
+        if self._doc is None:
+            self._doc = parse(self.content, self.headers)
+        return self._doc
+
+    @property
+    def validator(self) -> Optional[Text]:
+        return validator_of(self.headers)
+
+    def index(self, layout: bool = False, hints: bool = False) -> FeedIndex:
+        """
+        Parse just what the crawler needs from this document, and optionally
+        where each entry is in it and its polling hints. Parsing is
+        CPU-bound, so if appconfig.get_parse_executor() returns a pool, do it
+        there, where it isn't competing for this process's global interpreter
+        lock.
+        """
+
+        executor = appconfig.get_parse_executor()
+        with tracing.span("parse", **{"http.url": self.url}):
+            if executor is None:
+                return parse_index(self.content, self.headers, layout, hints)
+            return executor.submit(
+                parse_index, self.content, self.headers, layout, hints
+            ).result()
+
+    def entries(
+        self, guids: AbstractSet[Text], layout: Optional[EntryLayout] = None
+    ) -> Dict[Text, Any]:
+        """
+        Return the fully-parsed entries with the given IDs, if present. When
+        possible, this skips over the other entries without parsing or
+        sanitizing them, which matters when a big archive page has only a
+        few of the entries we want.
+
+        If the caller already knows where the entries are in this document,
+        it can pass in a layout to skip scanning for them too. That layout
+        must cover all the requested IDs and must have been recorded from a
+        copy of this document with the same validator.
+        """
+
+        if self._doc is None:
+            found = self._excerpt_entries(guids, layout)
+            if found is None:
+                found = self._excerpt_entries(guids, scan_entries(self.content, guids))
+            if found is not None:
+                return found
+
+        return {
+            entry.id: entry for entry in self.doc.entries if entry.get("id") in guids
+        }
 
-        self.doc = feedparser.parse(response, response_headers=response.headers)
+    def _excerpt_entries(
+        self, guids: AbstractSet[Text], layout: Optional[EntryLayout]
+    ) -> Optional[Dict[Text, Any]]:
+        if layout is None or not guids <= layout.spans.keys():
+            return None
+        doc = parse(excerpt(self.content, layout, guids), self.headers)
+        found = {entry.id: entry for entry in doc.entries if entry.get("id") in guids}
+        # If feedparser disagrees with our layout about which entries have
+        # which IDs, trust feedparser.
+        if len(found) != len(guids):
+            return None
+        return found
 
     def get_link(self, rel: Text) -> Optional[Text]:
         for link in self.doc.feed.get("links", ()):
@@ -60,9 +643,4 @@ class FeedDocument:
         return None
 
     def posts(self) -> Mapping[Text, PostMetadata]:
-        posts = {}
-        for raw_entry in self.doc.entries:
-            guid = cast(Text, raw_entry.get("id"))
-            if guid:
-                posts[guid] = PostMetadata.from_parsed(raw_entry)
-        return posts
+        return index_of(self.doc).posts
@@ -0,0 +1,98 @@
+from collections import deque
+from concurrent.futures import Executor, Future, FIRST_COMPLETED, wait
+import threading
+import time
+from typing import Callable, Deque, Iterator, List, Sequence, Set, TypeVar
+
+
+T = TypeVar("T")
+
+
+class LatencyTracker:
+    """
+    Remembers how long recent fetches took, to decide how long to wait for a
+    fetch before hedging it: waiting until about the 95th percentile means
+    only about one fetch in twenty gets a second request, but those are
+    exactly the ones that would otherwise hold up a response the longest.
+    """
+
+    def __init__(
+        self, percentile: float, initial: float, minimum: float, samples: int = 1000
+    ) -> None:
+        self.percentile = percentile
+        self.initial = initial
+        self.minimum = minimum
+        self.lock = threading.Lock()
+        self.samples: Deque[float] = deque(maxlen=samples)
+
+    def record(self, seconds: float) -> None:
+        with self.lock:
+            self.samples.append(seconds)
+
+    def delay(self) -> float:
+        """
+        >>> tracker = LatencyTracker(95, initial=1.0, minimum=0.01)
+        >>> tracker.delay()
+        1.0
+        >>> for n in range(1, 101): tracker.record(n / 1000)
+        >>> tracker.delay()
+        0.095
+        """
+
+        with self.lock:
+            ordered = sorted(self.samples)
+        if len(ordered) < 20:
+            return self.initial
+        rank = max(0, -(-len(ordered) * self.percentile // 100) - 1)
+        return max(self.minimum, ordered[int(rank)])
+
+
+def hedged(
+    attempts: Sequence[Callable[[], T]],
+    delay: float,
+    deadline: float,
+    executor: Executor,
+) -> T:
+    """
+    Start the first attempt, and start the next one whenever `delay` seconds
+    pass without any attempt succeeding, or as soon as one fails. Return the
+    result of whichever succeeds first. If they all fail, raise the last
+    failure; if none has succeeded by the time the monotonic clock reaches
+    `deadline`, raise TimeoutError.
+
+    Attempts which lose the race are left to finish in the background, so
+    each should have its own timeout.
+    """
+
+    remaining: Iterator[Callable[[], T]] = iter(attempts)
+    pending: Set["Future[T]"] = set()
+    errors: List[BaseException] = []
+    next_start = time.monotonic()
+
+    while True:
+        now = time.monotonic()
+        if now >= deadline:
+            raise TimeoutError("no attempt finished before the deadline")
+
+        if now >= next_start:
+            attempt = next(remaining, None)
+            if attempt is None:
+                next_start = float("inf")
+            else:
+                pending.add(executor.submit(attempt))
+                next_start = now + delay
+
+        if not pending:
+            raise errors[-1] if errors else ValueError("nothing to attempt")
+
+        done, pending = wait(
+            pending,
+            timeout=min(deadline, next_start) - now,
+            return_when=FIRST_COMPLETED,
+        )
+        for future in done:
+            error = future.exception()
+            if error is None:
+                return future.result()
+            errors.append(error)
+            next_start = time.monotonic()
@@ -0,0 +1,331 @@
+"""
+Measure how the server holds up under a mix of reads and crawls.
+
+    python -m crawl_rss.loadtest --help
+
+This starts three local servers: the app itself under uvicorn, with a
+scratch SQLite database; a stand-in origin serving synthetic archived feeds;
+and a stand-in caching proxy between them, with configurable latency and hit
+ratio. Then it drives a mixed workload against the app and reports throughput
+and latency percentiles per route.
+"""
+
+import argparse
+import asyncio
+from contextlib import contextmanager
+import datetime
+import os
+import random
+import socket
+import sqlalchemy
+from starlette.applications import Starlette
+from starlette.config import Config
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.routing import Route
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, Iterator, List, Mapping, NamedTuple, Sequence, Tuple
+from . import appconfig, models
+
+
+# Settings for the stand-in servers, which run in their own processes and get
+# their configuration from the environment.
+config = Config()
+ORIGIN_LATENCY = config("LOADTEST_ORIGIN_LATENCY", cast=float, default=0.05)
+ORIGIN_PAGES = config("LOADTEST_ORIGIN_PAGES", cast=int, default=5)
+ORIGIN_POSTS = config("LOADTEST_ORIGIN_POSTS", cast=int, default=50)
+# How often, in seconds, each feed publishes a new post.
+ORIGIN_CHURN = config("LOADTEST_ORIGIN_CHURN", cast=float, default=10)
+PROXY_LATENCY = config("LOADTEST_PROXY_LATENCY", cast=float, default=0.005)
+PROXY_HIT_RATIO = config("LOADTEST_PROXY_HIT_RATIO", cast=float, default=0.9)
+ORIGIN_URL = config("LOADTEST_ORIGIN_URL", default="http://127.0.0.1:8002")
+
+EPOCH = datetime.datetime(2020, 1, 1)
+
+
+def feed_document(feed: int, page: int, now: float) -> bytes:
+    """
+    Build one page of a synthetic archived feed. Page 0 is the subscription
+    document, which gets a new post every ORIGIN_CHURN seconds; the archive
+    pages count up from 1 and never change.
+    """
+
+    base = f"{ORIGIN_URL}/feeds/{feed}"
+    parts = ['<feed xmlns="http://www.w3.org/2005/Atom">']
+    if page == 0:
+        prev = ORIGIN_PAGES - 1
+        tick = int(now // ORIGIN_CHURN)
+        posts = [(f"urn:loadtest:{feed}:new:{tick}", EPOCH.replace(year=2030))]
+    else:
+        prev = page - 1
+        posts = [
+            (f"urn:loadtest:{feed}:{page}:{n}", EPOCH + datetime.timedelta(hours=n))
+            for n in range(page * ORIGIN_POSTS, (page + 1) * ORIGIN_POSTS)
+        ]
+    if prev > 0:
+        parts.append(f'<link rel="prev-archive" href="{base}/{prev}"/>')
+    for guid, published in posts:
+        parts.append(
+            f"<entry><id>{guid}</id><title>{guid}</title>"
+            f"<published>{published.isoformat()}Z</published>"
+            f"<content>{'Lorem ipsum dolor sit amet. ' * 20}</content></entry>"
+        )
+    parts.append("</feed>")
+    return "".join(parts).encode()
+
+
+async def serve_feed(request: Request) -> Response:
+    await asyncio.sleep(ORIGIN_LATENCY)
+    feed = request.path_params["feed"]
+    page = request.path_params.get("page", 0)
+    headers = {} if page == 0 else {"ETag": f'"{feed}-{page}"'}
+    return Response(
+        feed_document(feed, page, time.time()),
+        media_type="application/atom+xml",
+        headers=headers,
+    )
+
+
+origin = Starlette(
+    routes=[
+        Route("/feeds/{feed:int}", serve_feed),
+        Route("/feeds/{feed:int}/{page:int}", serve_feed),
+    ]
+)
+
+
+proxy_cache: Dict[str, Tuple[bytes, Dict[str, str]]] = {}
+
+
+async def serve_proxied(request: Request) -> Response:
+    """
+    Serve `http://proxy/http://origin/path` like the proxies in the proxy
+    table expect, from cache for the configured fraction of requests.
+    """
+
+    import httpx
+
+    await asyncio.sleep(PROXY_LATENCY)
+    url = request.url.path[1:]
+    cached = proxy_cache.get(url)
+    if cached is None or random.random() >= PROXY_HIT_RATIO:
+        async with httpx.AsyncClient() as client:
+            response = await client.get(url)
+        keep = ("content-type", "etag", "last-modified", "cache-control")
+        headers = {k: v for k, v in response.headers.items() if k in keep}
+        cached = proxy_cache[url] = (response.content, headers)
+    return Response(cached[0], headers=cached[1])
+
+
+proxy = Starlette(routes=[Route("/{url:path}", serve_proxied)])
+
+
+def percentile(ordered: Sequence[float], q: float) -> float:
+    """
+    The nearest-rank percentile of some already-sorted samples.
+
+    >>> percentile([1, 2, 3, 4], 50)
+    2
+    >>> percentile([1, 2, 3, 4], 99)
+    4
+    >>> percentile([], 50)
+    nan
+    """
+
+    if not ordered:
+        return float("nan")
+    rank = max(0, -(-len(ordered) * q // 100) - 1)
+    return ordered[int(rank)]
+
+
+class RouteStats(NamedTuple):
+    requests: int
+    errors: int
+    p50: float
+    p95: float
+    p99: float
+
+    @classmethod
+    def of(cls, latencies: List[float], errors: int) -> "RouteStats":
+        ordered = sorted(latencies)
+        return cls(
+            requests=len(ordered),
+            errors=errors,
+            p50=percentile(ordered, 50),
+            p95=percentile(ordered, 95),
+            p99=percentile(ordered, 99),
+        )
+
+
+def report(stats: Mapping[str, RouteStats], duration: float) -> str:
+    """
+    Format the results as a table, with latencies in milliseconds.
+
+    >>> print(report({"posts": RouteStats(200, 1, 0.01, 0.02, 0.05)}, 10))
+    route      requests  errors     req/s     p50 ms     p95 ms     p99 ms
+    posts           200       1      20.0       10.0       20.0       50.0
+    """
+
+    lines = [
+        f"{'route':<8} {'requests':>10} {'errors':>7} {'req/s':>9}"
+        f" {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}"
+    ]
+    for route, s in stats.items():
+        lines.append(
+            f"{route:<8} {s.requests:>10} {s.errors:>7} {s.requests / duration:>9.1f}"
+            f" {s.p50 * 1000:>10.1f} {s.p95 * 1000:>10.1f} {s.p99 * 1000:>10.1f}"
+        )
+    return "\n".join(lines)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return int(s.getsockname()[1])
+
+
+@contextmanager
+def uvicorn(app: str, port: int, env: Mapping[str, str]) -> Iterator[str]:
+    "Run an ASGI app in a child process until the block exits."
+
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", app, "--port", str(port)]
+        + ["--log-level", "warning"],
+        env={**os.environ, **env},
+    )
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"{app} didn't start")
+                time.sleep(0.1)
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def prepare_database(url: str, proxy_url: str, feed_urls: Sequence[str]) -> List[int]:
+    "Create the schema and subscribe to the feeds through the stand-in proxy."
+
+    engine = sqlalchemy.create_engine(url)
+    appconfig.metadata.create_all(engine)
+    with engine.begin() as connection:
+        proxy_id = connection.execute(
+            models.proxy.insert(), url=proxy_url + "/", name="loadtest", priority=0
+        ).inserted_primary_key[0]
+        return [
+            connection.execute(
+                models.feed.insert(), url=feed_url, proxy_id=proxy_id
+            ).inserted_primary_key[0]
+            for feed_url in feed_urls
+        ]
+
+
+async def drive(
+    app_url: str,
+    feed_urls: Sequence[str],
+    feed_ids: Sequence[int],
+    args: argparse.Namespace,
+) -> Dict[str, RouteStats]:
+    import httpx
+
+    latencies: Dict[str, List[float]] = {"posts": [], "river": [], "crawl": []}
+    errors = dict.fromkeys(latencies, 0)
+    weights = [1 - args.crawl_ratio - args.river_ratio, args.river_ratio]
+    weights.append(args.crawl_ratio)
+
+    def pick() -> Tuple[str, str]:
+        route = random.choices(list(latencies), weights)[0]
+        if route == "posts":
+            feed_id = random.choice(feed_ids)
+            return route, f"/posts/{feed_id}?page={random.randrange(3)}"
+        if route == "river":
+            feeds = random.sample(feed_ids, min(len(feed_ids), 5))
+            return route, "/posts?" + "&".join(f"feed={f}" for f in feeds)
+        return route, f"/crawl/{random.choice(feed_urls)}"
+
+    async with httpx.AsyncClient(base_url=app_url, timeout=60) as client:
+        # Every feed needs to be crawled once before there's anything to read.
+        for feed_url in feed_urls:
+            response = await client.get(f"/crawl/{feed_url}", allow_redirects=False)
+            response.raise_for_status()
+
+        deadline = time.monotonic() + args.duration
+
+        async def worker() -> None:
+            while time.monotonic() < deadline:
+                route, path = pick()
+                start = time.perf_counter()
+                try:
+                    response = await client.get(path, allow_redirects=False)
+                    failed = response.status_code >= 400
+                except httpx.HTTPError:
+                    failed = True
+                latencies[route].append(time.perf_counter() - start)
+                errors[route] += failed
+
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+
+    stats = {
+        route: RouteStats.of(values, errors[route])
+        for route, values in latencies.items()
+    }
+    stats["all"] = RouteStats.of(
+        [v for values in latencies.values() for v in values], sum(errors.values())
+    )
+    return stats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m crawl_rss.loadtest",
+        description=__doc__.split("\n\n")[1],
+    )
+    parser.add_argument("--feeds", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=ORIGIN_PAGES)
+    parser.add_argument("--posts-per-page", type=int, default=ORIGIN_POSTS)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--crawl-ratio", type=float, default=0.05)
+    parser.add_argument("--river-ratio", type=float, default=0.2)
+    parser.add_argument("--origin-latency", type=float, default=ORIGIN_LATENCY)
+    parser.add_argument("--proxy-latency", type=float, default=PROXY_LATENCY)
+    parser.add_argument("--hit-ratio", type=float, default=PROXY_HIT_RATIO)
+    args = parser.parse_args()
+
+    origin_port, proxy_port, app_port = free_port(), free_port(), free_port()
+    origin_url = f"http://127.0.0.1:{origin_port}"
+    stand_in_env = {
+        "LOADTEST_ORIGIN_URL": origin_url,
+        "LOADTEST_ORIGIN_LATENCY": str(args.origin_latency),
+        "LOADTEST_ORIGIN_PAGES": str(args.pages),
+        "LOADTEST_ORIGIN_POSTS": str(args.posts_per_page),
+        "LOADTEST_PROXY_LATENCY": str(args.proxy_latency),
+        "LOADTEST_PROXY_HIT_RATIO": str(args.hit_ratio),
+    }
+    feed_urls = [f"{origin_url}/feeds/{n}" for n in range(args.feeds)]
+
+    with tempfile.TemporaryDirectory() as scratch:
+        database_url = f"sqlite:///{scratch}/loadtest.sqlite"
+        with uvicorn("crawl_rss.loadtest:origin", origin_port, stand_in_env), uvicorn(
+            "crawl_rss.loadtest:proxy", proxy_port, stand_in_env
+        ) as proxy_url:
+            feed_ids = prepare_database(database_url, proxy_url, feed_urls)
+            with uvicorn(
+                "crawl_rss.server:app", app_port, {"DATABASE_URL": database_url}
+            ) as app_url:
+                stats = asyncio.run(drive(app_url, feed_urls, feed_ids, args))
+
+    print(report(stats, args.duration))
+
+
+if __name__ == "__main__":
+    main()
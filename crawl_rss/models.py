@@ -1,6 +1,9 @@
+import hashlib
 from sqlalchemy import (
+    BigInteger,
     Column,
     DateTime,
+    Float,
     ForeignKey,
     Index,
     Integer,
@@ -11,9 +14,27 @@ from sqlalchemy import (
     UniqueConstraint,
 )
 from sqlalchemy.sql import func
+from typing import Any
 from . import appconfig
 
 
+def hash_guid(guid: str) -> int:
+    """
+    A 64-bit hash of a post's GUID, as a signed integer so it fits in a
+    BIGINT column in every database.
+
+    >>> hash_guid("urn:example:1")
+    5242570134504571895
+    """
+
+    digest = hashlib.blake2b(guid.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def default_guid_hash(context: Any) -> int:
+    return hash_guid(context.get_current_parameters()["guid"])
+
+
 proxy = Table(
     "proxy",
     appconfig.metadata,
@@ -31,6 +52,11 @@ feed = Table(
     Column("proxy_id", ForeignKey(proxy.c.id, ondelete="RESTRICT")),
     Column("properties", JSON, nullable=False, default={}),
     Column("next_check", DateTime, nullable=False, default=func.now()),
+    # Incremented every time a crawl changes this feed's posts, so readers can
+    # tell whether anything they've seen before might be different now.
+    Column("generation", Integer, nullable=False, default=0, server_default="0"),
+    # When the most recent crawl of this feed was committed, in UTC.
+    Column("crawled", DateTime),
 )
 
 page = Table(
@@ -41,6 +67,25 @@ page = Table(
     Column("idx", Integer, nullable=False),
     Column("url", Text, unique=True, nullable=False),
     UniqueConstraint("feed_id", "idx"),
+    # For archive pages, which shouldn't change without moving to a new URL,
+    # we record where the entries are in the document we saw, so we can cut
+    # out just the ones we need later. These are only valid if the document
+    # still has the same ETag or Last-Modified header as recorded here.
+    Column("validator", Text),
+    # Byte offsets of the first entry and of the end of the last entry.
+    Column("entries_start", Integer),
+    Column("entries_end", Integer),
+    # Summaries of this page's posts, kept up to date by the crawler, so
+    # readers can find which pages hold posts from a given date range, or
+    # the Nth post, without reading all the posts before it. The counts of
+    # published and updated only include posts where those aren't NULL.
+    Column("post_count", Integer, nullable=False, default=0, server_default="0"),
+    Column("published_count", Integer, nullable=False, default=0, server_default="0"),
+    Column("published_min", DateTime),
+    Column("published_max", DateTime),
+    Column("updated_count", Integer, nullable=False, default=0, server_default="0"),
+    Column("updated_min", DateTime),
+    Column("updated_max", DateTime),
 )
 
 # Index of posts found from a given feed. This table should contain the bare
@@ -51,6 +96,10 @@ post = Table(
     appconfig.metadata,
     Column("id", Integer, primary_key=True),
     Column("guid", Text, nullable=False),
+    # GUIDs are often long URLs, so rather than searching an index of them,
+    # look posts up by this hash and then compare the full GUID to rule out
+    # collisions.
+    Column("guid_hash", BigInteger, nullable=False, default=default_guid_hash),
     # Note that a GUID may appear on multiple pages of an archived feed. To
     # keep the schema simple, we only record whichever copy is "current"
     # according to RFC5005 deduplication. The feed crawler may have to rescan
@@ -58,7 +107,11 @@ post = Table(
     Column("page_id", ForeignKey(page.c.id, ondelete="RESTRICT"), nullable=False),
     # Denormalized to support good indexes: must match page_id->feed_id
     Column("feed_id", ForeignKey(feed.c.id, ondelete="CASCADE"), nullable=False),
+    # Lookups use ix_guid_hash, but only a constraint on the full GUID can
+    # guarantee that the crawler never stores a post twice.
     UniqueConstraint("feed_id", "guid"),
+    Index("ix_guid_hash", "feed_id", "guid_hash"),
+    Index("ix_page_id", "page_id"),
     # Published/updated are in both RSS and Atom
     Column("published", DateTime),
     Index("ix_published", "feed_id", "published"),
@@ -68,29 +121,94 @@ post = Table(
     Column("season", Integer),
     Column("episode", Integer),
     Index("ix_season_episode", "feed_id", "season", "episode"),
+    # Where this post's entry is within its page, if the page has a validator.
+    Column("entry_offset", Integer),
+    Column("entry_length", Integer),
 )
 
 # A schema for https://tools.ietf.org/html/draft-snell-atompub-feed-index-10:
-# rank_scheme = Table(
-#    "rank_scheme",
-#    appconfig.metadata,
-#    Column("id", Integer, primary_key=True),
-#    Column("uri", Text, unique=True, nullable=False),
-# )
-#
-# rank_domain = Table(
-#    "rank_domain",
-#    appconfig.metadata,
-#    Column("id", Integer, primary_key=True),
-#    Column("uri", Text, unique=True, nullable=False),
-# )
-#
-# rank = Table(
-#    "rank",
-#    appconfig.metadata,
-#    Column("post_id", ForeignKey(post.c.id, ondelete="CASCADE"), nullable=False),
-#    Column("scheme_id", ForeignKey(rank_scheme.c.id, ondelete="RESTRICT"), nullable=False),
-#    Column("domain_id", ForeignKey(rank_domain.c.id, ondelete="RESTRICT"), nullable=False),
-#    Column("rank", Float),
-#    UniqueConstraint("post_id", "scheme_id", "domain_id"),
-# )
+rank_scheme = Table(
+    "rank_scheme",
+    appconfig.metadata,
+    Column("id", Integer, primary_key=True),
+    Column("uri", Text, unique=True, nullable=False),
+)
+
+# Ranks without an explicit domain are recorded with the empty URI, meaning
+# "within this feed".
+rank_domain = Table(
+    "rank_domain",
+    appconfig.metadata,
+    Column("id", Integer, primary_key=True),
+    Column("uri", Text, unique=True, nullable=False),
+)
+
+rank = Table(
+    "rank",
+    appconfig.metadata,
+    Column("post_id", ForeignKey(post.c.id, ondelete="CASCADE"), nullable=False),
+    # Denormalized to support good indexes: must match post_id->feed_id
+    Column("feed_id", ForeignKey(feed.c.id, ondelete="CASCADE"), nullable=False),
+    Column(
+        "scheme_id", ForeignKey(rank_scheme.c.id, ondelete="RESTRICT"), nullable=False
+    ),
+    Column(
+        "domain_id", ForeignKey(rank_domain.c.id, ondelete="RESTRICT"), nullable=False
+    ),
+    Column("rank", Float, nullable=False),
+    UniqueConstraint("post_id", "scheme_id", "domain_id"),
+    # Lets a page of posts in rank order be read with one index seek.
+    Index("ix_rank", "feed_id", "scheme_id", "domain_id", "rank", "post_id"),
+)
+
+# Subscriptions to WebSub hubs (https://www.w3.org/TR/websub/), for feeds
+# whose subscription document names one. While a lease is current, the hub
+# tells us when the feed changes, so there's no need to poll it.
+websub = Table(
+    "websub",
+    appconfig.metadata,
+    Column("feed_id", ForeignKey(feed.c.id, ondelete="CASCADE"), primary_key=True),
+    Column("hub", Text, nullable=False),
+    Column("topic", Text, nullable=False),
+    # For checking the signatures on notifications from the hub.
+    Column("secret", Text, nullable=False),
+    # When we last asked the hub to subscribe us; NULL if we need to ask.
+    Column("requested", DateTime),
+    # When the hub's lease ends; NULL until the hub verifies the subscription.
+    Column("expires", DateTime),
+)
+
+# Every post a crawl inserted, updated, or deleted, in the order the crawls
+# committed, so other services can mirror the posts table by reading only
+# what changed since they last looked.
+change_log = Table(
+    "change_log",
+    appconfig.metadata,
+    Column("seq", Integer, primary_key=True),
+    Column("feed_id", ForeignKey(feed.c.id, ondelete="CASCADE"), nullable=False),
+    Column("guid", Text, nullable=False),
+    # "insert", "update", or "delete"
+    Column("action", Text, nullable=False),
+    Index("ix_change_log_feed", "feed_id", "seq"),
+)
+
+# A single row which crawls update before appending to change_log. The row
+# lock that takes is held until the crawl commits, so a crawl which allocated
+# smaller sequence numbers can't commit after one which allocated larger ones,
+# and readers never skip past changes that just hadn't been committed yet.
+change_log_lock = Table(
+    "change_log_lock",
+    appconfig.metadata,
+    Column("id", Integer, primary_key=True),
+    Column("appends", Integer, nullable=False, default=0),
+)
+
+# Permanent (301 or 308) redirects we've seen, so later fetches can go
+# straight to the new URL, and requests for a feed's old URL find the feed.
+redirect = Table(
+    "redirect",
+    appconfig.metadata,
+    Column("url", Text, primary_key=True),
+    Column("target", Text, nullable=False),
+    Column("recorded", DateTime, nullable=False, default=func.now()),
+)
@@ -0,0 +1,160 @@
+"""
+Optional hash partitioning of the post table by feed_id, for very large
+deployments on PostgreSQL 12 or newer.
+
+Every query the crawler and the server make on posts is for a single feed, so
+each one touches only that feed's partition. Each partition keeps its own,
+smaller, indexes, which makes index maintenance during a crawl cheaper, and
+lets vacuum work through the table a piece at a time.
+
+PostgreSQL requires every unique constraint on a partitioned table to include
+the partition key. So when partitioned, post's primary key becomes
+(id, feed_id), and rank's foreign key to it includes feed_id. The page table
+stays as it is: it's a small fraction of the size of post, and partitioning
+it would mean a page's URL could only be kept unique within its feed, while
+crawls rely on it being unique across all of them. SQLAlchemy's models don't
+need to know about any of this: they still describe every query correctly.
+
+The migration which introduced this partitions the table if POST_PARTITIONS
+is set when it runs. To switch an existing database either way later, run:
+
+    python -m crawl_rss.partitioning PARTITIONS
+
+with 0 partitions to go back to a plain table. Either way rebuilds the table,
+copying every row, so it's best done while crawlers are stopped.
+"""
+
+import argparse
+import sys
+from typing import List, Mapping, Sequence
+from . import appconfig
+
+
+# How the table is laid out when it isn't partitioned, and when it is. Only
+# the differences between the two are listed here; everything else comes
+# along from the existing table.
+POST_CONSTRAINTS = {
+    False: ["CONSTRAINT pk_post PRIMARY KEY (id)"],
+    True: ["CONSTRAINT pk_post PRIMARY KEY (id, feed_id)"],
+}
+
+RANK_POST_FOREIGN_KEY = {
+    False: "FOREIGN KEY (post_id) REFERENCES post (id) ON DELETE CASCADE",
+    True: "FOREIGN KEY (post_id, feed_id) REFERENCES post (id, feed_id)"
+    " ON DELETE CASCADE",
+}
+
+# Constraints and indexes which are the same either way.
+POST_COMMON = [
+    "CONSTRAINT uq_post_feed_id UNIQUE (feed_id, guid)",
+    "CONSTRAINT fk_post_page_id_page FOREIGN KEY (page_id)"
+    " REFERENCES page (id) ON DELETE RESTRICT",
+    "CONSTRAINT fk_post_feed_id_feed FOREIGN KEY (feed_id)"
+    " REFERENCES feed (id) ON DELETE CASCADE",
+]
+
+POST_INDEXES = {
+    "ix_guid_hash": "feed_id, guid_hash",
+    "ix_page_id": "page_id",
+    "ix_published": "feed_id, published",
+    "ix_updated": "feed_id, updated",
+    "ix_season_episode": "feed_id, season, episode",
+}
+
+
+def is_partitioned_sql() -> str:
+    "A query for whether the post table is currently partitioned."
+
+    return "SELECT relkind = 'p' FROM pg_class WHERE oid = 'post'::regclass"
+
+
+def rebuild_statements(partitions: int) -> List[str]:
+    """
+    SQL to rebuild the post table with this many hash partitions, or
+    unpartitioned if it's 0. Existing rows are copied over.
+
+    >>> sql = rebuild_statements(4)
+    >>> sql[1]
+    'CREATE TABLE post_rebuild (LIKE post INCLUDING DEFAULTS) PARTITION BY HASH (feed_id)'
+    >>> sql[2]
+    'CREATE TABLE post_rebuild_p0 PARTITION OF post_rebuild FOR VALUES WITH (MODULUS 4, REMAINDER 0)'
+    """
+
+    partitioned = partitions > 0
+    statements = [
+        # Nothing may refer to the old table once it's dropped.
+        "ALTER TABLE rank DROP CONSTRAINT fk_rank_post_id_post",
+    ]
+    statements += _rebuild(
+        "post", partitions, POST_CONSTRAINTS[partitioned] + POST_COMMON, POST_INDEXES
+    )
+    statements += [
+        "ALTER TABLE rank ADD CONSTRAINT fk_rank_post_id_post "
+        + RANK_POST_FOREIGN_KEY[partitioned],
+        "ANALYZE post",
+    ]
+    return statements
+
+
+def _rebuild(
+    table: str,
+    partitions: int,
+    constraints: Sequence[str],
+    indexes: Mapping[str, str],
+) -> List[str]:
+    new = f"{table}_rebuild"
+    sequence = f"{table}_id_seq"
+
+    create = f"CREATE TABLE {new} (LIKE {table} INCLUDING DEFAULTS)"
+    if partitions > 0:
+        create += " PARTITION BY HASH (feed_id)"
+    statements = [create]
+    statements += [
+        f"CREATE TABLE {new}_p{n} PARTITION OF {new}"
+        f" FOR VALUES WITH (MODULUS {partitions}, REMAINDER {n})"
+        for n in range(partitions)
+    ]
+
+    statements += [
+        f"INSERT INTO {new} SELECT * FROM {table}",
+        # Dropping the old table would take its ID sequence with it.
+        f"ALTER SEQUENCE {sequence} OWNED BY NONE",
+        f"DROP TABLE {table}",
+        f"ALTER TABLE {new} RENAME TO {table}",
+    ]
+    statements += [
+        f"ALTER TABLE {new}_p{n} RENAME TO {table}_p{n}" for n in range(partitions)
+    ]
+    statements.append(f"ALTER SEQUENCE {sequence} OWNED BY {table}.id")
+
+    statements += [
+        f"ALTER TABLE {table} ADD {constraint}" for constraint in constraints
+    ]
+    statements += [
+        f"CREATE INDEX {name} ON {table} ({columns})"
+        for name, columns in indexes.items()
+    ]
+    return statements
+
+
+def main(argv: Sequence[str] = sys.argv[1:]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m crawl_rss.partitioning",
+        description="Rebuild the post table with PARTITIONS hash partitions,"
+        " or without partitions if it's 0.",
+    )
+    parser.add_argument("partitions", metavar="PARTITIONS", type=int)
+    args = parser.parse_args(argv)
+
+    engine = appconfig.get_engine()
+    if engine.name != "postgresql":
+        parser.error("partitioning is only supported on PostgreSQL")
+
+    with engine.begin() as connection:
+        for statement in rebuild_statements(max(0, args.partitions)):
+            connection.execute(statement)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
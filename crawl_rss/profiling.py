@@ -0,0 +1,111 @@
+"""
+An opt-in sampling profiler for finding out where slow crawls spend their
+time.
+
+While PROFILE_SLOW_CRAWLS is set, another thread looks at the crawling
+thread's stack every PROFILE_INTERVAL seconds. Crawls which turn out to be
+slow have their samples saved in the "collapsed stack" format, one stack and
+its sample count per line, which flamegraph.pl, speedscope, and similar tools
+turn into flame graphs. Samples from fast crawls are thrown away.
+"""
+
+from collections import Counter
+import contextlib
+import datetime
+import os
+import sys
+import threading
+import time
+from types import FrameType
+from typing import Iterator, Mapping, Optional, Tuple
+from . import appconfig
+
+
+Stack = Tuple[str, ...]
+
+
+def stack_of(frame: Optional[FrameType]) -> Stack:
+    "The functions on this frame's stack, outermost first."
+
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename)
+        stack.append(f"{code.co_name} ({filename}:{code.co_firstlineno})")
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
+
+
+class Sampler:
+    "Counts how often each stack is found on one thread, from another thread."
+
+    def __init__(self, thread_id: int, interval: float) -> None:
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts: "Counter[Stack]" = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.counts[stack_of(frame)] += 1
+            # Don't keep the sampled thread's frames alive.
+            del frame
+
+
+def collapsed(counts: Mapping[Stack, int]) -> str:
+    """
+    >>> print(collapsed({("main", "crawl"): 2, ("main",): 1}), end="")
+    main 1
+    main;crawl 2
+    """
+
+    return "".join(
+        "{} {}\n".format(";".join(stack), count)
+        for stack, count in sorted(counts.items())
+    )
+
+
+@contextlib.contextmanager
+def profile_if_slow(name: str) -> Iterator[None]:
+    """
+    Sample this thread while the body runs, and if that takes at least
+    PROFILE_SLOW_CRAWLS seconds, save the samples in PROFILE_DIR, in a file
+    named for `name` and when it finished.
+    """
+
+    threshold = appconfig.PROFILE_SLOW_CRAWLS
+    if threshold <= 0:
+        yield
+        return
+
+    sampler = Sampler(threading.get_ident(), appconfig.PROFILE_INTERVAL)
+    start = time.perf_counter()
+    sampler.start()
+    try:
+        yield
+    finally:
+        sampler.stop()
+        if time.perf_counter() - start >= threshold and sampler.counts:
+            save(name, sampler.counts)
+
+
+def save(name: str, counts: Mapping[Stack, int]) -> str:
+    "Write a profile to PROFILE_DIR, and return its path."
+
+    os.makedirs(appconfig.PROFILE_DIR, exist_ok=True)
+    stamp = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S.%f")
+    path = os.path.join(appconfig.PROFILE_DIR, f"{name}-{stamp}.folded")
+    with open(path, "w") as f:
+        f.write(collapsed(counts))
+    return path
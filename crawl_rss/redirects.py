@@ -0,0 +1,35 @@
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql import bindparam, select
+from typing import Iterable, Set, Text, Tuple
+from . import models
+
+
+# Give up following a chain of stored redirects after this many, in case
+# servers have sent us around in a loop over time.
+MAX_HOPS = 10
+
+
+def resolve(connection: Connection, url: Text) -> Text:
+    "Follow any permanent redirects we've recorded from this URL."
+
+    seen: Set[Text] = set()
+    query = select([models.redirect.c.target]).where(
+        models.redirect.c.url == bindparam("url")
+    )
+    while len(seen) < MAX_HOPS:
+        seen.add(url)
+        target = connection.execute(query, url=url).scalar()
+        if target is None or target in seen:
+            break
+        url = target
+    return url
+
+
+def record(connection: Connection, redirects: Iterable[Tuple[Text, Text]]) -> None:
+    "Remember these permanent redirects, replacing any older ones."
+
+    for url, target in redirects:
+        if url == target:
+            continue
+        connection.execute(models.redirect.delete().where(models.redirect.c.url == url))
+        connection.execute(models.redirect.insert().values(url=url, target=target))
@@ -0,0 +1,264 @@
+import datetime
+from email.utils import parsedate_to_datetime
+import random
+import re
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql import select
+from typing import Any, Dict, Mapping, Optional, Sequence, Text
+from . import appconfig, models
+from .feeds import FeedHints, FetchError
+
+
+# How many of a feed's most recent posts to consider when estimating how
+# often it publishes.
+HISTORY_POSTS = 20
+
+# How long before a WebSub lease ends to go back to polling, in case renewing
+# it doesn't work.
+LEASE_MARGIN = datetime.timedelta(hours=1)
+
+
+def parse_http_date(value: Text) -> Optional[datetime.datetime]:
+    "Parse an HTTP date as a naive UTC datetime, or None if it isn't one."
+
+    try:
+        parsed = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def http_interval(
+    headers: Mapping[Text, Text], now: datetime.datetime
+) -> Optional[datetime.timedelta]:
+    """
+    How long the server has asked us to wait before fetching this document
+    again, if it said. Retry-After is explicit; otherwise a response that may
+    be cached for a while won't be any different until then.
+
+    >>> now = datetime.datetime(2020, 1, 1)
+    >>> http_interval({"cache-control": "public, max-age=600"}, now)
+    datetime.timedelta(seconds=600)
+    >>> http_interval({"expires": "Wed, 01 Jan 2020 01:00:00 GMT"}, now)
+    datetime.timedelta(seconds=3600)
+    >>> http_interval({"retry-after": "120", "cache-control": "max-age=60"}, now)
+    datetime.timedelta(seconds=120)
+    >>> http_interval({"cache-control": "no-cache"}, now) is None
+    True
+    """
+
+    intervals = []
+
+    retry_after = headers.get("retry-after", "").strip()
+    if retry_after.isdigit():
+        intervals.append(datetime.timedelta(seconds=int(retry_after)))
+    elif retry_after:
+        when = parse_http_date(retry_after)
+        if when is not None:
+            intervals.append(when - now)
+
+    max_age = re.search(
+        r"(?:^|[,\s])max-age=\"?(\d+)", headers.get("cache-control", "")
+    )
+    if max_age is not None:
+        intervals.append(datetime.timedelta(seconds=int(max_age.group(1))))
+    elif "expires" in headers:
+        expires = parse_http_date(headers["expires"])
+        date = parse_http_date(headers.get("date", "")) or now
+        if expires is not None:
+            intervals.append(expires - date)
+
+    if not intervals:
+        return None
+    return max(datetime.timedelta(0), max(intervals))
+
+
+def posting_interval(
+    published: Sequence[datetime.datetime], now: datetime.datetime
+) -> Optional[datetime.timedelta]:
+    """
+    Estimate how often a feed publishes from the dates of its recent posts.
+    The median gap isn't thrown off by one long hiatus or one burst, but a
+    feed that has gone quiet since its newest post is polled no more often
+    than it has lately been publishing.
+
+    >>> days = [datetime.datetime(2020, 1, d) for d in (1, 2, 4, 5, 30)]
+    >>> posting_interval(days, datetime.datetime(2020, 1, 30, 12))
+    datetime.timedelta(days=1, seconds=43200)
+    >>> posting_interval(days, datetime.datetime(2020, 3, 1))
+    datetime.timedelta(days=31)
+    >>> posting_interval(days[:1], datetime.datetime(2020, 3, 1)) is None
+    True
+    """
+
+    ordered = sorted(published)
+    gaps = sorted(later - earlier for earlier, later in zip(ordered, ordered[1:]))
+    if not gaps:
+        return None
+    median = (gaps[(len(gaps) - 1) // 2] + gaps[len(gaps) // 2]) / 2
+    return max(median, now - ordered[-1])
+
+
+def skip_ahead(when: datetime.datetime, hints: FeedHints) -> datetime.datetime:
+    """
+    Move a time forward to the start of the next hour that the feed hasn't
+    asked us to skip.
+
+    >>> hints = FeedHints(skip_hours=frozenset({0, 1}), skip_days=frozenset({6}))
+    >>> skip_ahead(datetime.datetime(2020, 1, 3, 0, 30), hints)
+    datetime.datetime(2020, 1, 3, 2, 0)
+    >>> skip_ahead(datetime.datetime(2020, 1, 5, 12), hints)
+    datetime.datetime(2020, 1, 6, 2, 0)
+    """
+
+    # If a feed asks us to skip every hour, ignore it rather than never
+    # checking the feed again.
+    for _ in range(24 * 7):
+        if when.hour not in hints.skip_hours and when.weekday() not in hints.skip_days:
+            return when
+        when = when.replace(minute=0, second=0, microsecond=0)
+        when += datetime.timedelta(hours=1)
+    return when
+
+
+def next_check(
+    now: datetime.datetime,
+    posting: Optional[datetime.timedelta],
+    http: Optional[datetime.timedelta],
+    hints: FeedHints,
+    rng: random.Random = random.Random(),
+) -> datetime.datetime:
+    """
+    Decide when to poll a feed next. We aim to check about as often as it
+    publishes, but no sooner than the feed or its server asked, and always
+    within the configured bounds. Jitter keeps feeds that were crawled together
+    from staying in lockstep.
+    """
+
+    interval = posting if posting is not None else appconfig.POLL_MAX_INTERVAL
+    if hints.ttl is not None:
+        interval = max(interval, datetime.timedelta(minutes=hints.ttl))
+    if http is not None:
+        interval = max(interval, http)
+    interval = min(
+        max(interval, appconfig.POLL_MIN_INTERVAL), appconfig.POLL_MAX_INTERVAL
+    )
+    interval *= rng.uniform(1 - appconfig.POLL_JITTER, 1 + appconfig.POLL_JITTER)
+    return skip_ahead(now + interval, hints)
+
+
+def reschedule(
+    feed_id: int,
+    connection: Connection,
+    headers: Mapping[Text, Text],
+    hints: FeedHints,
+    now: Optional[datetime.datetime] = None,
+    lease: Optional[datetime.datetime] = None,
+) -> datetime.datetime:
+    """
+    Set the feed's next_check after a crawl, and record what went into that
+    decision in its properties so it's possible to see why later. While a
+    WebSub hub's `lease` lasts, the hub tells us about changes, so the feed
+    needn't be polled again until the lease is nearly up.
+    """
+
+    if now is None:
+        now = datetime.datetime.utcnow()
+
+    published = [
+        row[0]
+        for row in connection.execute(
+            select([models.post.c.published])
+            .where(models.post.c.feed_id == feed_id)
+            .where(models.post.c.published.isnot(None))
+            .order_by(models.post.c.published.desc())
+            .limit(HISTORY_POSTS)
+        )
+    ]
+    posting = posting_interval(published, now)
+    http = http_interval(headers, now)
+    when = next_check(now, posting, http, hints)
+    if lease is not None:
+        when = max(when, lease - LEASE_MARGIN)
+
+    properties: Dict[str, Any] = dict(
+        connection.execute(
+            select([models.feed.c.properties]).where(models.feed.c.id == feed_id)
+        ).scalar()
+        or {}
+    )
+    properties.pop("failure", None)
+    properties["schedule"] = {
+        "posting_interval": None if posting is None else posting.total_seconds(),
+        "http_interval": None if http is None else http.total_seconds(),
+        "ttl": hints.ttl,
+        "skip_hours": sorted(hints.skip_hours),
+        "skip_days": sorted(hints.skip_days),
+        "websub_lease": None if lease is None else lease.isoformat(),
+    }
+
+    connection.execute(
+        models.feed.update()
+        .where(models.feed.c.id == feed_id)
+        .values(next_check=when, properties=properties)
+    )
+    return when
+
+
+def backoff_interval(
+    failures: int,
+    retry_after: Optional[datetime.timedelta],
+    rng: random.Random = random.Random(),
+) -> datetime.timedelta:
+    """
+    How long to wait before crawling a feed again after it has failed this
+    many times in a row. The wait doubles with each failure, but is at least
+    as long as the server asked for with Retry-After, and at most
+    BACKOFF_MAX_INTERVAL.
+    """
+
+    interval = appconfig.POLL_MIN_INTERVAL * 2 ** min(failures - 1, 32)
+    if retry_after is not None:
+        interval = max(interval, retry_after)
+    interval = min(interval, appconfig.BACKOFF_MAX_INTERVAL)
+    return interval * rng.uniform(1 - appconfig.POLL_JITTER, 1 + appconfig.POLL_JITTER)
+
+
+def backoff(
+    feed_id: int,
+    connection: Connection,
+    error: FetchError,
+    now: Optional[datetime.datetime] = None,
+) -> datetime.datetime:
+    """
+    Record a failed crawl in the feed's properties and push its next_check
+    back accordingly. The next successful crawl's call to reschedule clears
+    the record.
+    """
+
+    if now is None:
+        now = datetime.datetime.utcnow()
+
+    properties: Dict[str, Any] = dict(
+        connection.execute(
+            select([models.feed.c.properties]).where(models.feed.c.id == feed_id)
+        ).scalar()
+        or {}
+    )
+    failures = properties.get("failure", {}).get("count", 0) + 1
+    when = now + backoff_interval(failures, http_interval(error.headers, now))
+    properties["failure"] = {
+        "count": failures,
+        "error": str(error),
+        "status": error.status,
+        "since": properties.get("failure", {}).get("since", now.isoformat()),
+    }
+
+    connection.execute(
+        models.feed.update()
+        .where(models.feed.c.id == feed_id)
+        .values(next_check=when, properties=properties)
+    )
+    return when
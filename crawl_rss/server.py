@@ -1,13 +1,44 @@
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import datetime
+import hashlib
+import heapq
+from itertools import chain, islice
+import json
 import re
-from sqlalchemy import select
+from sqlalchemy import Column, select
+from sqlalchemy.engine import Connection, Engine, RowProxy
+from sqlalchemy.sql import and_, bindparam, func, or_, ClauseElement
 from starlette.applications import Starlette
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
 from starlette.exceptions import HTTPException
-from starlette.responses import JSONResponse, RedirectResponse
+from starlette.responses import RedirectResponse, Response, StreamingResponse
 from starlette.requests import Request
 from starlette.routing import Route
-from . import appconfig, models
-from .crawl import crawl, DiffPosts
-from .feeds import FeedDocument
+import threading
+import time
+from typing import (
+    Any,
+    Callable,
+    DefaultDict,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+    cast,
+)
+from urllib.parse import urlencode
+from . import appconfig, export, models, websub
+from .crawl import refresh
+from .feeds import EntryLayout, FeedDocument, FetchError
+from .hedging import hedged, LatencyTracker
 
 
 POST_ORDERS = {
@@ -16,50 +47,506 @@ POST_ORDERS = {
     "episode": (models.post.c.season, models.post.c.episode),
 }
 
+# Orders which /posts can jump into the middle of, using the per-page
+# summaries of these columns: page.<column>_count, _min, and _max.
+SEEK_COLUMNS = {models.post.c.published, models.post.c.updated}
+SUMMARY_SUFFIXES = ("_count", "_min", "_max")
 
-def crawl_feed(request: Request) -> RedirectResponse:
-    url = request.path_params["url"]
+# Orderings defined by the publisher, using draft-snell-atompub-feed-index.
+RANK_ORDER = "rank"
+RANK_COLUMNS = (models.rank.c.rank, models.rank.c.post_id)
 
-    with appconfig.engine.begin() as connection:
-        feed = connection.execute(
-            models.feed.select().where(models.feed.c.url == url)
-        ).first()
+# What the change log tells clients about a post it inserted or updated,
+# besides its GUID.
+CHANGE_FIELDS = {
+    "page_url": models.page.c.url,
+    "published": models.post.c.published,
+    "updated": models.post.c.updated,
+    "season": models.post.c.season,
+    "episode": models.post.c.episode,
+}
 
-        if feed is None:
-            result = connection.execute(models.feed.insert().values(url=url))
-            feed_id = result.inserted_primary_key[0]
-        else:
-            feed_id = feed[models.feed.c.id]
+# How many posts to return per page, unless the client asks for a different
+# number; and the most any client may ask for at once.
+DEFAULT_LIMIT = 25
+MAX_LIMIT = 1000
+
+# What we need to know to find a post's full contents in its archive page.
+POST_COLUMNS = [
+    models.post.c.page_id,
+    models.post.c.guid,
+    models.post.c.entry_offset,
+    models.post.c.entry_length,
+]
+PAGE_COLUMNS = [
+    models.page.c.id,
+    models.page.c.feed_id,
+    models.page.c.url,
+    models.page.c.validator,
+    models.page.c.entries_start,
+    models.page.c.entries_end,
+]
+
+# Limits on merged timelines: how many feeds one request may combine, and how
+# many archive pages to load at once, across all requests, while filling them.
+MAX_RIVER_FEEDS = 500
+RIVER_FETCH_THREADS = 16
+
+# Archive pages for readers are fetched on this pool, shared by all requests,
+# so that a hedged fetch which loses the race can finish in the background.
+FETCH_THREADS = 32
+fetch_executor = ThreadPoolExecutor(max_workers=FETCH_THREADS)
+fetch_latency = LatencyTracker(appconfig.HEDGE_PERCENTILE, initial=1.0, minimum=0.02)
+
+# Merged timelines load their pages ahead of rendering on this pool. Each load
+# waits for its fetches on fetch_executor, so if loads took threads from that
+# pool too, enough of them could leave no threads for the fetches themselves.
+river_executor = ThreadPoolExecutor(max_workers=RIVER_FETCH_THREADS)
+
+# Ways that loading an archive page for a reader can fail which just mean its
+# posts are missing from the response. Anything else is a bug.
+LOAD_FAILURES = (FetchError, TimeoutError, FutureTimeoutError)
+
+# Databases which sort NULL after every other value in ascending order.
+NULLS_HIGH_DIALECTS = {"postgresql", "oracle"}
+
+
+def encode_json(content: Any) -> bytes:
+    "Serialize the same way as Starlette's JSONResponse."
+
+    return json.dumps(
+        content,
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Check an If-None-Match request header against our ETag, using the weak
+    comparison that RFC7232 requires for this header.
+
+    >>> etag_matches('"1", W/"2"', 'W/"2"')
+    True
+    >>> etag_matches("*", 'W/"3"')
+    True
+    >>> etag_matches('W/"1"', 'W/"2"')
+    False
+    >>> etag_matches(None, 'W/"1"')
+    False
+    """
+
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+
+class PageCache:
+    """
+    Thread-safe LRU cache of rendered lists of posts. Keys include the feed's
+    generation, so entries never need to be invalidated; they just stop being
+    requested after the next crawl which changes the feed.
+    """
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[Hashable, bytes]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def saving(
+        self,
+        key: Hashable,
+        chunks: Iterable[bytes],
+        complete: Callable[[], bool] = lambda: True,
+    ) -> Iterator[bytes]:
+        """
+        Pass chunks through, then cache them all if we got to the end and
+        `complete` says the result is worth keeping.
+        """
+
+        saved = []
+        for chunk in chunks:
+            saved.append(chunk)
+            yield chunk
+        if complete():
+            self.put(key, b"".join(saved))
+
+    def put(self, key: Hashable, value: bytes) -> None:
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
 
-        diff = DiffPosts()
-        crawl(feed_id, connection, diff)
-        diff.apply(feed_id, connection)
 
-    return RedirectResponse(request.url_for("list_posts", feed_id=feed_id))
+page_cache = PageCache(appconfig.POSTS_CACHE_SIZE)
 
 
-def list_posts(request: Request) -> JSONResponse:
+def crawl_feed(request: Request) -> Response:
+    try:
+        feed_id = refresh(request.path_params["url"])
+    except FetchError as error:
+        headers = {}
+        if error.retry_at is not None:
+            wait = error.retry_at - datetime.datetime.utcnow()
+            headers["Retry-After"] = str(max(0, int(wait.total_seconds())))
+        return Response(str(error), status_code=502, headers=headers)
+
+    url = request.url_for("list_posts", feed_id=feed_id)
+
+    if appconfig.DATABASE_READ_URL is not None and appconfig.READ_YOUR_WRITES:
+        with appconfig.get_engine().begin() as connection:
+            generation = connection.execute(
+                select([models.feed.c.generation]).where(models.feed.c.id == feed_id)
+            ).scalar()
+        url += "?" + urlencode({"generation": generation})
+
+    return RedirectResponse(url)
+
+
+async def websub_callback(request: Request) -> Response:
+    """
+    Answer a WebSub hub: confirm subscriptions we asked for, and when the hub
+    says the feed changed, crawl it after responding. Notifications without a
+    valid signature are acknowledged but otherwise ignored, as the spec asks.
+    """
+
     feed_id = request.path_params["feed_id"]
 
+    if request.method == "GET":
+        params = dict(request.query_params)
+
+        def verify() -> Optional[str]:
+            with appconfig.get_engine().begin() as connection:
+                return websub.verify(feed_id, connection, params)
+
+        challenge = await run_in_threadpool(verify)
+        if challenge is None:
+            raise HTTPException(404)
+        return Response(challenge, media_type="text/plain")
+
+    body = await request.body()
+    signature = request.headers.get("X-Hub-Signature")
+
+    def authentic() -> Optional[str]:
+        with appconfig.get_engine().begin() as connection:
+            if not websub.authentic(feed_id, connection, body, signature):
+                return None
+            return cast(
+                Optional[str],
+                connection.execute(
+                    select([models.feed.c.url]).where(models.feed.c.id == feed_id)
+                ).scalar(),
+            )
+
+    url = await run_in_threadpool(authentic)
+    if url is None:
+        return Response(status_code=202)
+    return Response(status_code=202, background=BackgroundTask(crawl_notified, url))
+
+
+def crawl_notified(url: str) -> None:
     try:
-        page = int(request.query_params.get("page", 0))
-    except ValueError:
-        raise HTTPException(404, "invalid page number")
+        refresh(url, fresh_for=datetime.timedelta(0), revalidate=True)
+    except FetchError:
+        # The failure is recorded with the feed, which will be polled again.
+        pass
+
+
+def read_engine(feed_id: int, generation: Optional[int]) -> Engine:
+    """
+    Pick the database to list this feed's posts from: the read replica, if
+    there is one, unless the client asked for a generation of the feed which
+    the replica hasn't caught up to yet.
+    """
+
+    engine = appconfig.get_read_engine()
+    if generation is None or engine is appconfig.get_engine():
+        return engine
+
+    with engine.begin() as connection:
+        replicated = connection.execute(
+            select([models.feed.c.generation]).where(models.feed.c.id == feed_id)
+        ).scalar()
+    if replicated is None or replicated < generation:
+        return appconfig.get_engine()
+    return engine
+
+
+def parse_order(
+    request: Request, ranked: bool = False
+) -> Tuple[str, Sequence[Column], bool]:
+    """
+    Returns the order as the client spelled it, its columns, and direction.
+    If `ranked` is set, also accept the publisher-defined orderings in
+    RANK_COLUMNS; see parse_ranking.
+    """
 
     order = re.fullmatch(r"(-?)(.*)", request.query_params.get("order", "-published"))
+    if order is not None and ranked and order.group(2) == RANK_ORDER:
+        return order.group(0), RANK_COLUMNS, order.group(1) == "-"
     if order is None or order.group(2) not in POST_ORDERS:
         raise HTTPException(404, "unrecognized order")
 
     # Use database ID for a last-resort stable order
     order_columns = POST_ORDERS[order.group(2)] + (models.post.c.id,)
-    if order.group(1) == "-":
-        order_clause = [col.desc() for col in order_columns]
+    return order.group(0), order_columns, order.group(1) == "-"
+
+
+def parse_ranking(
+    request: Request, connection: Connection
+) -> Tuple[Dict[str, str], ClauseElement]:
+    """
+    For a feed-index ranking, given by the `scheme` and optional `domain`
+    query parameters, return those parameters and the condition which selects
+    ranks in that ordering.
+    """
+
+    params = {"scheme": request.query_params.get("scheme", "")}
+    if "domain" in request.query_params:
+        params["domain"] = request.query_params["domain"]
+
+    scheme_id = connection.execute(
+        select([models.rank_scheme.c.id]).where(
+            models.rank_scheme.c.uri == params["scheme"]
+        )
+    ).scalar()
+    domain_id = connection.execute(
+        select([models.rank_domain.c.id]).where(
+            models.rank_domain.c.uri == params.get("domain", "")
+        )
+    ).scalar()
+    if scheme_id is None or domain_id is None:
+        raise HTTPException(404, "no such ranking")
+
+    return params, and_(
+        models.rank.c.scheme_id == scheme_id, models.rank.c.domain_id == domain_id
+    )
+
+
+def parse_limit(request: Request) -> int:
+    try:
+        limit = int(request.query_params.get("limit", DEFAULT_LIMIT))
+    except ValueError:
+        raise HTTPException(404, "invalid limit")
+    if not 0 < limit <= MAX_LIMIT:
+        raise HTTPException(404, "limit must be between 1 and {}".format(MAX_LIMIT))
+    return limit
+
+
+def order_by(columns: Sequence[Column], descending: bool) -> List[ClauseElement]:
+    if descending:
+        return [col.desc() for col in columns]
+    return [col.asc() for col in columns]
+
+
+def parse_seek(request: Request) -> Union[None, int, datetime.datetime]:
+    """
+    Returns the `offset` or `at` query parameter, if there is one. Dates
+    without a time zone are taken to be in UTC.
+    """
+
+    if "offset" in request.query_params:
+        try:
+            offset = int(request.query_params["offset"])
+        except ValueError:
+            offset = -1
+        if offset < 0:
+            raise HTTPException(404, "invalid offset")
+        return offset
+
+    if "at" in request.query_params:
+        at = request.query_params["at"]
+        if at.endswith("Z"):
+            at = at[:-1] + "+00:00"
+        try:
+            target = datetime.datetime.fromisoformat(at)
+        except ValueError:
+            raise HTTPException(404, "invalid date")
+        # Posts' dates are stored as naive UTC, and can't be compared with
+        # dates that have a time zone.
+        if target.tzinfo is not None:
+            target = target.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return target
+
+    return None
+
+
+def clean_cuts(
+    pages: Sequence[Tuple[int, datetime.datetime, datetime.datetime]],
+    descending: bool,
+) -> List[Tuple[datetime.datetime, int]]:
+    """
+    Given the count, minimum, and maximum of some column on each page, find
+    the values which split the posts without any page having posts on both
+    sides, and how many posts sort before each of those values.
+
+    >>> d = datetime.datetime
+    >>> pages = [
+    ...     (2, d(2020, 1, 1), d(2020, 1, 5)),
+    ...     (3, d(2020, 1, 3), d(2020, 1, 9)),
+    ...     (1, d(2020, 2, 1), d(2020, 2, 1)),
+    ... ]
+    >>> [(str(cut.date()), n) for cut, n in clean_cuts(pages, descending=False)]
+    [('2020-01-01', 0), ('2020-02-01', 5)]
+    >>> [(str(cut.date()), n) for cut, n in clean_cuts(pages, descending=True)]
+    [('2020-02-01', 0), ('2020-01-09', 1)]
+    """
+
+    cuts = []
+    before = 0
+    reach: Optional[datetime.datetime] = None
+    for count, low, high in sorted(
+        pages, key=lambda page: page[2] if descending else page[1], reverse=descending
+    ):
+        start, end = (high, low) if descending else (low, high)
+        if reach is None or (reach > start if descending else reach < start):
+            cuts.append((start, before))
+        before += count
+        if reach is None or (reach > end if descending else reach < end):
+            reach = end
+    return cuts
+
+
+def seek(
+    connection: Connection,
+    feed_id: int,
+    column: Column,
+    descending: bool,
+    target: Union[int, datetime.datetime],
+) -> Tuple[int, Optional[ClauseElement], int]:
+    """
+    Find where to start listing posts, given either how many posts to skip
+    or a date to start from. Returns the number of posts skipped, a condition
+    which an index on this column can use to skip almost all of those, and
+    how many matching posts still need to be skipped.
+
+    Each page's summary says how many posts it has in some range of values,
+    so wherever no pages overlap, we can tell how many posts come before a
+    value without counting them.
+    """
+
+    post = models.post
+    nulls_high = connection.dialect.name in NULLS_HIGH_DIALECTS
+    nulls_first = nulls_high == descending
+    nulls = connection.execute(
+        select([func.count()]).where(post.c.feed_id == feed_id).where(column.is_(None))
+    ).scalar()
+
+    summary = [models.page.c[column.name + suffix] for suffix in SUMMARY_SUFFIXES]
+    cuts = clean_cuts(
+        [
+            (row[0], row[1], row[2])
+            for row in connection.execute(
+                select(summary)
+                .where(models.page.c.feed_id == feed_id)
+                .where(summary[0] > 0)
+            )
+        ],
+        descending,
+    )
+
+    def from_cut(value: datetime.datetime) -> ClauseElement:
+        "Match posts from this cut onward, not counting NULLs."
+        return column <= value if descending else column >= value
+
+    if isinstance(target, datetime.datetime):
+        # Count the posts which sort before the target date, starting from
+        # the last cut that isn't past it.
+        before_target = column > target if descending else column < target
+        count = select([func.count()]).where(post.c.feed_id == feed_id)
+        count = count.where(before_target)
+        reached = [
+            (value, before)
+            for value, before in cuts
+            if (value >= target if descending else value <= target)
+        ]
+        skipped = 0
+        if reached:
+            value, skipped = reached[-1]
+            count = count.where(from_cut(value))
+        skipped += connection.execute(count).scalar()
+        if nulls_first:
+            skipped += nulls
     else:
-        order_clause = [col.asc() for col in order_columns]
+        skipped = target
+
+    remaining = skipped
+    condition: Optional[ClauseElement] = None
+    if nulls_first:
+        if remaining < nulls:
+            return skipped, None, remaining
+        remaining -= nulls
+        condition = column.isnot(None)
+
+    usable = [(value, before) for value, before in cuts if before <= remaining]
+    if usable:
+        value, before = usable[-1]
+        remaining -= before
+        condition = from_cut(value)
+        if not nulls_first:
+            condition = or_(condition, column.is_(None))
+
+    return skipped, condition, remaining
 
-    per_page = 25
 
-    with appconfig.engine.begin() as connection:
+def list_posts(request: Request) -> Response:
+    feed_id = request.path_params["feed_id"]
+
+    try:
+        page = int(request.query_params.get("page", 0))
+    except ValueError:
+        raise HTTPException(404, "invalid page number")
+
+    try:
+        min_generation: Optional[int] = int(request.query_params["generation"])
+    except KeyError:
+        min_generation = None
+    except ValueError:
+        raise HTTPException(404, "invalid generation")
+
+    deadline = time.monotonic() + appconfig.READ_DEADLINE
+    order, order_columns, descending = parse_order(request, ranked=True)
+    limit = parse_limit(request)
+    query = select(POST_COLUMNS).where(models.post.c.feed_id == feed_id)
+    ranking: Dict[str, str] = {}
+    offset = page * limit
+
+    target = parse_seek(request)
+    if target is not None and order_columns[0] not in SEEK_COLUMNS:
+        raise HTTPException(404, "can only seek when ordered by published or updated")
+
+    with read_engine(feed_id, min_generation).begin() as connection:
+        if order_columns is RANK_COLUMNS:
+            # Publisher-defined orderings are served entirely by the rank
+            # table's index, which only contains posts that have a rank.
+            ranking, in_ranking = parse_ranking(request, connection)
+            query = (
+                query.select_from(models.post.join(models.rank))
+                .where(models.rank.c.feed_id == feed_id)
+                .where(in_ranking)
+            )
+
         feed = connection.execute(
             models.feed.outerjoin(models.proxy)
             .select()
@@ -69,60 +556,606 @@ def list_posts(request: Request) -> JSONResponse:
         if feed is None:
             raise HTTPException(404, "no such feed")
 
-        posts = connection.execute(
-            select([models.post.c.page_id, models.post.c.guid])
-            .where(models.post.c.feed_id == feed_id)
-            .order_by(*order_clause)
-            .limit(per_page)
-            .offset(page * per_page)
-        ).fetchall()
+        merged_into = (feed[models.feed.c.properties] or {}).get("merged_into")
+        if merged_into is not None:
+            url = request.url_for("list_posts", feed_id=merged_into)
+            if request.url.query:
+                url += "?" + request.url.query
+            return RedirectResponse(url, status_code=301)
 
-        if not posts:
-            raise HTTPException(404, "page does not exist")
+        # This page can only change when a crawl changes the feed's posts, so
+        # the generation is all a client needs to revalidate its copy.
+        generation = feed[models.feed.c.generation]
+        headers = {
+            "ETag": 'W/"{}"'.format(generation),
+            "Cache-Control": "max-age={}".format(appconfig.POSTS_MAX_AGE),
+        }
+        if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+            return Response(status_code=304, headers=headers)
 
-        page_ids = {post[models.post.c.page_id] for post in posts}
-        pages = connection.execute(
-            select([models.page.c.id, models.page.c.url]).where(
-                models.page.c.id.in_(page_ids)
+        if target is not None:
+            offset, condition, remaining = seek(
+                connection, feed_id, order_columns[0], descending, target
             )
+            if condition is not None:
+                query = query.where(condition)
+        else:
+            remaining = offset
+
+        cache_key = (feed_id, generation, order, tuple(ranking.items()), offset, limit)
+        rendered = page_cache.get(cache_key)
+
+        if rendered is None:
+            posts = connection.execute(
+                query.order_by(*order_by(order_columns, descending))
+                .limit(limit)
+                .offset(remaining)
+            ).fetchall()
+
+            if not posts:
+                raise HTTPException(404, "page does not exist")
+
+            pages = get_pages(connection, posts)
+            sources = fetch_sources(feed[models.proxy.c.url], get_proxies(connection))
+
+    # Clients that seek get links by offset; otherwise keep counting pages.
+    position: Dict[str, int] = {"page": page + 1}
+    if target is not None:
+        position = {"offset": offset + limit}
+    query_params = {**position, "order": order, "limit": limit, **ranking}
+    links = {
+        "next": "{}?{}".format(
+            request.url_for("list_posts", feed_id=feed_id), urlencode(query_params)
+        )
+    }
+    tail = b',"links":' + encode_json(links) + b"}"
+
+    if rendered is not None:
+        return Response(
+            b'{"posts":' + rendered + tail,
+            media_type="application/json",
+            headers=headers,
+        )
+
+    wanted = posts_by_page(posts)
+    missing: List[str] = []
+    body = render_posts(
+        posts,
+        lambda page_id: load_entries(
+            pages[page_id], sources, wanted[page_id], deadline
+        ),
+        missing,
+    )
+    if page_cache.size > 0:
+        body = page_cache.saving(cache_key, body, lambda: not missing)
+
+    return StreamingResponse(
+        chain([b'{"posts":'], body, [tail]),
+        media_type="application/json",
+        headers=headers,
+    )
+
+
+def keyset_ranges(
+    columns: Sequence[Column], values: Sequence[Any], descending: bool, nulls_high: bool
+) -> List[ClauseElement]:
+    """
+    Match rows which come after the given values in the given order, as a
+    list of conditions which each pick out one range of an index on those
+    columns. The ranges don't overlap and are listed in order, so reading
+    them one after another gives the same rows as a single ORDER BY, but
+    every read starts with an index seek. A single condition like `a > x OR
+    (a = x AND b > y)` can't be served by one seek, and a row-value
+    comparison would lose NULLs, which sort wherever the database would have
+    put them in an ORDER BY.
+    """
+
+    column, value = columns[0], values[0]
+    nulls_last = nulls_high != descending
+    ranges: List[ClauseElement] = []
+    if len(columns) > 1:
+        same = column.is_(None) if value is None else column == value
+        ranges.extend(
+            and_(same, rest)
+            for rest in keyset_ranges(columns[1:], values[1:], descending, nulls_high)
+        )
+    if value is not None:
+        ranges.append(column < value if descending else column > value)
+        if nulls_last:
+            ranges.append(column.is_(None))
+    elif not nulls_last:
+        ranges.append(column.isnot(None))
+    return ranges
+
+
+def sort_key(values: Sequence[Any], nulls_high: bool) -> Tuple[Tuple[Any, ...], ...]:
+    """
+    Make a Python sort key that puts rows in the same order that the
+    database's ORDER BY would.
+
+    >>> sorted([(None, 2), (1, 1), (1, None)], key=lambda r: sort_key(r, False))
+    [(None, 2), (1, None), (1, 1)]
+    >>> sorted([(None, 2), (1, 1), (1, None)], key=lambda r: sort_key(r, True))
+    [(1, 1), (1, None), (None, 2)]
+    """
+
+    return tuple(
+        (int(nulls_high),) if value is None else (int(not nulls_high), value)
+        for value in values
+    )
+
+
+def list_river(request: Request) -> Response:
+    """
+    Merge the posts from several feeds into one timeline. Each page picks up
+    after the post named in its "after" parameter, so every feed only needs
+    a few index seeks plus enough rows to fill one page, no matter how deep
+    into the timeline the client is or how many posts these feeds have in
+    total.
+    """
+
+    try:
+        feed_ids = sorted(
+            {int(feed_id) for feed_id in request.query_params.getlist("feed")}
+        )
+        after = request.query_params.get("after")
+        after_id = None if after is None else int(after)
+    except ValueError:
+        raise HTTPException(404, "invalid feed or post ID")
+    if not 0 < len(feed_ids) <= MAX_RIVER_FEEDS:
+        raise HTTPException(
+            404, "must name between 1 and {} feeds".format(MAX_RIVER_FEEDS)
+        )
+
+    deadline = time.monotonic() + appconfig.READ_DEADLINE
+    order, order_columns, descending = parse_order(request)
+    limit = parse_limit(request)
+
+    with appconfig.get_read_engine().begin() as connection:
+        nulls_high = connection.dialect.name in NULLS_HIGH_DIALECTS
+
+        feeds = connection.execute(
+            select([models.feed.c.id, models.feed.c.generation, models.proxy.c.url])
+            .select_from(models.feed.outerjoin(models.proxy))
+            .where(models.feed.c.id.in_(feed_ids))
+            .order_by(models.feed.c.id)
         ).fetchall()
 
-    proxy = feed[models.proxy.c.url]
-    full_posts = {}
-    for page_id, page_url in pages:
-        # Always fetch from cache if possible, for two reasons:
-        # - The cached copy is more likely to match what we saw the last time
-        #   we crawled this feed, so we have better odds of returning a result
-        #   that was at least valid then.
-        # - This is a latency-sensitive endpoint since a person is sitting on
-        #   the other end waiting to read whatever we pull up, so we should
-        #   retrieve the data they want from as close-by as possible.
-        doc = FeedDocument(page_url, proxy, headers={"Cache-Control": "max-stale"})
-        full_posts[page_id] = {
-            post.id: post for post in doc.doc.entries if "id" in post
+        if len(feeds) != len(feed_ids):
+            raise HTTPException(404, "no such feed")
+
+        # Any crawl which changes one of these feeds changes its generation.
+        generations = ",".join("{}:{}".format(feed[0], feed[1]) for feed in feeds)
+        headers = {
+            "ETag": 'W/"{}"'.format(hashlib.sha1(generations.encode()).hexdigest()),
+            "Cache-Control": "max-age={}".format(appconfig.POSTS_MAX_AGE),
         }
+        if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+
+        query = (
+            select([*POST_COLUMNS, *order_columns])
+            .where(models.post.c.feed_id == bindparam("feed_id"))
+            .order_by(*order_by(order_columns, descending))
+            .limit(limit)
+        )
 
-    return JSONResponse(
-        {
-            "posts": [
-                full_posts[post[models.post.c.page_id]][post[models.post.c.guid]]
-                for post in posts
-            ],
-            "links": {
-                "next": "{}?page={}&order={}".format(
-                    request.url_for("list_posts", feed_id=feed_id),
-                    page + 1,
-                    order.group(0),
+        queries = [query]
+        if after_id is not None:
+            cursor = connection.execute(
+                select(order_columns)
+                .where(models.post.c.id == after_id)
+                .where(models.post.c.feed_id.in_(feed_ids))
+            ).first()
+            if cursor is None:
+                raise HTTPException(404, "no such post")
+            queries = [
+                query.where(condition)
+                for condition in keyset_ranges(
+                    order_columns, list(cursor), descending, nulls_high
                 )
-            },
+            ]
+
+        def feed_posts(feed_id: int) -> Iterator[RowProxy]:
+            "Read the ranges in order, stopping once one page is full."
+            ranges = (
+                connection.execute(ranged, feed_id=feed_id).fetchall()
+                for ranged in queries
+            )
+            return islice(chain.from_iterable(ranges), limit)
+
+        # Each feed's rows are already sorted, so a k-way merge only has to
+        # look at the first page's worth of them.
+        posts = list(
+            islice(
+                heapq.merge(
+                    *(feed_posts(feed_id) for feed_id in feed_ids),
+                    key=lambda post: sort_key(
+                        tuple(post)[len(POST_COLUMNS) :], nulls_high
+                    ),
+                    reverse=descending,
+                ),
+                limit,
+            )
+        )
+
+        if not posts:
+            raise HTTPException(404, "page does not exist")
+
+        pages = get_pages(connection, posts)
+        all_proxies = get_proxies(connection)
+
+    query_params: List[Tuple[str, Any]] = [("feed", feed_id) for feed_id in feed_ids]
+    query_params += [
+        ("order", order),
+        ("limit", limit),
+        ("after", posts[-1][models.post.c.id]),
+    ]
+    links = {
+        "next": "{}?{}".format(request.url_for("list_river"), urlencode(query_params))
+    }
+
+    # Unlike a single feed, which usually has only a page or two of recent
+    # posts, a river may draw from as many archive pages as it has posts, so
+    # start loading all of them at once.
+    sources = {feed[0]: fetch_sources(feed[2], all_proxies) for feed in feeds}
+    wanted = posts_by_page(posts)
+    loading = {
+        page_id: river_executor.submit(
+            load_entries,
+            page,
+            sources[page[models.page.c.feed_id]],
+            wanted[page_id],
+            deadline,
+        )
+        for page_id, page in pages.items()
+    }
+
+    return StreamingResponse(
+        chain(
+            [b'{"posts":'],
+            render_posts(posts, lambda page_id: loading.pop(page_id).result(), []),
+            [b',"links":' + encode_json(links) + b"}"],
+        ),
+        media_type="application/json",
+        headers=headers,
+    )
+
+
+def list_changes(request: Request) -> Response:
+    """
+    The posts crawls have inserted, updated, or deleted since sequence number
+    `after`, in the order they were committed, for every feed or just one.
+    Clients keep following the `next` link to stay in sync.
+
+    Inserts and updates come with the post's current archive page URL, dates,
+    season and episode, and feed-index ranks, so clients don't have to look
+    the post up again. A post that a later change deleted has none of these.
+    """
+
+    feed_id = request.path_params.get("feed_id")
+    try:
+        after = int(request.query_params.get("after", 0))
+    except ValueError:
+        raise HTTPException(404, "invalid sequence number")
+    limit = parse_limit(request)
+
+    change_log = models.change_log
+    post = models.post
+    query = (
+        select(
+            [
+                change_log,
+                post.c.id.label("post_id"),
+                *(column.label(name) for name, column in CHANGE_FIELDS.items()),
+            ]
+        )
+        .select_from(
+            change_log.outerjoin(
+                post,
+                and_(
+                    change_log.c.action != "delete",
+                    post.c.feed_id == change_log.c.feed_id,
+                    post.c.guid == change_log.c.guid,
+                ),
+            ).outerjoin(models.page)
+        )
+        .where(change_log.c.seq > after)
+        .order_by(change_log.c.seq)
+        .limit(limit)
+    )
+    if feed_id is not None:
+        query = query.where(change_log.c.feed_id == feed_id)
+
+    with appconfig.get_read_engine().begin() as connection:
+        if feed_id is not None and (
+            connection.execute(
+                select([models.feed.c.id]).where(models.feed.c.id == feed_id)
+            ).first()
+            is None
+        ):
+            raise HTTPException(404, "no such feed")
+        changes = connection.execute(query).fetchall()
+        ranks = get_ranks(
+            connection,
+            [change["post_id"] for change in changes if change["post_id"] is not None],
+        )
+
+    events = []
+    for change in changes:
+        event = {
+            "seq": change[change_log.c.seq],
+            "feed_id": change[change_log.c.feed_id],
+            "id": change[change_log.c.guid],
+            "action": change[change_log.c.action],
         }
+        if change["post_id"] is not None:
+            event.update((name, encode_field(change[name])) for name in CHANGE_FIELDS)
+            event["ranks"] = ranks.get(change["post_id"], [])
+        events.append(event)
+
+    if changes:
+        after = changes[-1][change_log.c.seq]
+    if feed_id is None:
+        url = request.url_for("list_changes")
+    else:
+        url = request.url_for("list_feed_changes", feed_id=feed_id)
+
+    return Response(
+        encode_json(
+            {
+                "changes": events,
+                "links": {
+                    "next": "{}?{}".format(
+                        url, urlencode({"after": after, "limit": limit})
+                    )
+                },
+            }
+        ),
+        media_type="application/json",
+    )
+
+
+def get_ranks(
+    connection: Connection, post_ids: Sequence[int]
+) -> Dict[int, List[Dict[str, Any]]]:
+    """
+    The feed-index ranks of these posts, with each ranking named the way
+    /posts/<feed id> takes it: a `scheme`, and a `domain` unless it's the
+    feed itself.
+    """
+
+    ranks: DefaultDict[int, List[Dict[str, Any]]] = defaultdict(list)
+    if not post_ids:
+        return ranks
+    for post_id, scheme, domain, rank in connection.execute(
+        select(
+            [
+                models.rank.c.post_id,
+                models.rank_scheme.c.uri,
+                models.rank_domain.c.uri,
+                models.rank.c.rank,
+            ]
+        )
+        .select_from(models.rank.join(models.rank_scheme).join(models.rank_domain))
+        .where(models.rank.c.post_id.in_(post_ids))
+        .order_by(models.rank_scheme.c.uri, models.rank_domain.c.uri)
+    ):
+        ranking = {"scheme": scheme, "domain": domain} if domain else {"scheme": scheme}
+        ranks[post_id].append({**ranking, "rank": rank})
+    return ranks
+
+
+def encode_field(value: Any) -> Any:
+    "Dates in JSON are strings, as in ISO 8601."
+
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def export_posts(request: Request) -> Response:
+    """
+    Stream the post index of the feeds given as `feed` parameters, or of
+    every feed, without touching the archive documents.
+    """
+
+    output_format = request.query_params.get("format", "ndjson")
+    if output_format not in export.FORMATS:
+        raise HTTPException(404, "unrecognized format")
+    try:
+        feed_ids = [int(feed) for feed in request.query_params.getlist("feed")]
+    except ValueError:
+        raise HTTPException(404, "invalid feed ID")
+
+    return StreamingResponse(
+        export.export_on_thread(feed_ids, output_format),
+        media_type=export.MEDIA_TYPES[output_format],
+    )
+
+
+def get_pages(connection: Connection, posts: Sequence[RowProxy]) -> Dict[int, RowProxy]:
+    page_ids = {post[models.post.c.page_id] for post in posts}
+    return {
+        page[models.page.c.id]: page
+        for page in connection.execute(
+            select(PAGE_COLUMNS).where(models.page.c.id.in_(page_ids))
+        )
+    }
+
+
+def posts_by_page(posts: Sequence[RowProxy]) -> Dict[int, List[RowProxy]]:
+    wanted: DefaultDict[int, List[RowProxy]] = defaultdict(list)
+    for post in posts:
+        wanted[post[models.post.c.page_id]].append(post)
+    return wanted
+
+
+def stored_layout(page: RowProxy, posts: Sequence[RowProxy]) -> Optional[EntryLayout]:
+    "Where the crawler found these posts in this page, if it recorded that."
+
+    if page[models.page.c.validator] is None:
+        return None
+    spans = {}
+    for post in posts:
+        offset = post[models.post.c.entry_offset]
+        if offset is None:
+            return None
+        spans[post[models.post.c.guid]] = (
+            offset,
+            offset + post[models.post.c.entry_length],
+        )
+    return EntryLayout(
+        head=page[models.page.c.entries_start],
+        tail=page[models.page.c.entries_end],
+        closing=b"",
+        spans=spans,
     )
 
 
+def get_proxies(connection: Connection) -> List[str]:
+    "All the proxies' URLs, highest priority first."
+
+    return [
+        row[0]
+        for row in connection.execute(
+            select([models.proxy.c.url]).order_by(models.proxy.c.priority.desc())
+        )
+    ]
+
+
+def fetch_sources(
+    proxy: Optional[str], proxies: Sequence[str]
+) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Where to fetch a feed's archive pages from for a reader: first the feed's
+    own proxy, and then, if that's slow, the highest-priority other proxy, or
+    the origin server if there isn't another proxy. A feed that isn't fetched
+    through a proxy is hedged with another request straight to its origin.
+
+    >>> fetch_sources("http://a/", ["http://a/", "http://b/"])
+    ('http://a/', 'http://b/')
+    >>> fetch_sources("http://a/", ["http://a/"])
+    ('http://a/', None)
+    >>> fetch_sources(None, ["http://a/"])
+    (None, None)
+    """
+
+    if proxy is None:
+        return None, None
+    return proxy, next((other for other in proxies if other != proxy), None)
+
+
+def load_entries(
+    page: RowProxy,
+    sources: Sequence[Optional[str]],
+    posts: Sequence[RowProxy],
+    deadline: float,
+) -> Dict[str, Any]:
+    """
+    Fetch an archive page and return the entries for these posts. The page
+    is fetched from each of `sources` in turn, without waiting for an
+    earlier one to finish if it's taking longer than most fetches do, and
+    whichever answers first wins. Raises TimeoutError if none has answered
+    by `deadline`, on the monotonic clock.
+    """
+
+    # Always fetch from cache if possible, for two reasons:
+    # - The cached copy is more likely to match what we saw the last time we
+    #   crawled this feed, so we have better odds of returning a result that
+    #   was at least valid then.
+    # - This is a latency-sensitive endpoint since a person is sitting on the
+    #   other end waiting to read whatever we pull up, so we should retrieve
+    #   the data they want from as close-by as possible.
+    def fetch(proxy: Optional[str]) -> Callable[[], FeedDocument]:
+        def attempt() -> FeedDocument:
+            start = time.monotonic()
+            doc = FeedDocument(
+                page[models.page.c.url],
+                proxy,
+                headers={"Cache-Control": "max-stale"},
+                timeout=max(deadline - start, 0.001),
+            )
+            fetch_latency.record(time.monotonic() - start)
+            return doc
+
+        return attempt
+
+    doc = hedged(
+        [fetch(proxy) for proxy in sources],
+        fetch_latency.delay(),
+        deadline,
+        fetch_executor,
+    )
+
+    # Archive pages aren't supposed to change, but if this one has, then the
+    # offsets we recorded are useless.
+    layout = stored_layout(page, posts)
+    if doc.validator != page[models.page.c.validator]:
+        layout = None
+
+    return doc.entries({post[models.post.c.guid] for post in posts}, layout)
+
+
+def render_posts(
+    posts: Sequence[RowProxy],
+    load_page: Callable[[int], Dict[str, Any]],
+    missing: List[str],
+) -> Iterator[bytes]:
+    """
+    Generate a JSON array of the full contents of the given posts, in order,
+    loading each archive page only when the first post from it is needed and
+    forgetting it again after the last one. That way the client starts
+    receiving posts as soon as the first page is loaded, and we don't hold
+    more parsed documents in memory than the post order forces us to.
+
+    If a page can't be fetched in time, or no longer has one of the posts,
+    that post is rendered as just its ID with `"missing": true`, and its ID
+    is appended to `missing`. By then the response headers have already been
+    sent, so clients that see a missing post should retry without
+    revalidating. Errors other than LOAD_FAILURES are raised as usual.
+    """
+
+    last_use = {post[models.post.c.page_id]: idx for idx, post in enumerate(posts)}
+    full_posts: Dict[int, Dict[str, Any]] = {}
+
+    for idx, post in enumerate(posts):
+        page_id = post[models.post.c.page_id]
+        entries = full_posts.get(page_id)
+        if entries is None:
+            try:
+                entries = load_page(page_id)
+            except LOAD_FAILURES:
+                entries = {}
+            full_posts[page_id] = entries
+
+        if last_use[page_id] == idx:
+            del full_posts[page_id]
+
+        guid = post[models.post.c.guid]
+        entry = entries.get(guid)
+        if entry is None:
+            missing.append(guid)
+            entry = {"id": guid, "missing": True}
+        yield (b"[" if idx == 0 else b",") + encode_json(entry)
+
+    yield b"]"
+
+
 app = Starlette(
     debug=appconfig.DEBUG,
     routes=[
         Route("/crawl/{url:path}", crawl_feed, name="crawl_feed"),
+        Route("/posts", list_river, name="list_river"),
         Route("/posts/{feed_id:int}", list_posts, name="list_posts"),
+        Route("/export", export_posts, name="export_posts"),
+        Route("/changes", list_changes, name="list_changes"),
+        Route("/changes/{feed_id:int}", list_changes, name="list_feed_changes"),
+        Route(
+            "/websub/{feed_id:int}",
+            websub_callback,
+            methods=["GET", "POST"],
+            name="websub_callback",
+        ),
     ],
 )
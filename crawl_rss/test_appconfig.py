@@ -0,0 +1,39 @@
+import os
+from . import appconfig
+from .benchmarks.startup import HEAVY, measure
+
+
+def test_lazy_startup():
+    "Importing the server shouldn't create clients or load feedparser yet."
+
+    result = measure("crawl_rss.server", runs=1)
+    assert [name for name in HEAVY if name in result.loaded] == []
+    assert result.eager == []
+
+
+def test_fork_gets_new_engine():
+    engine = appconfig.get_engine()
+    client = appconfig.get_http_client()
+    assert appconfig.get_engine() is engine
+
+    pid = os.fork()
+    if pid == 0:
+        fresh = (
+            appconfig.get_engine() is not engine
+            and appconfig.get_http_client() is not client
+        )
+        os._exit(0 if fresh else 1)
+
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+    assert appconfig.get_engine() is engine
+
+
+def test_read_engine(monkeypatch):
+    assert appconfig.get_read_engine() is appconfig.get_engine()
+
+    monkeypatch.setattr(appconfig, "DATABASE_READ_URL", "sqlite:///")
+    monkeypatch.setattr(appconfig, "_read_engine", None)
+    replica = appconfig.get_read_engine()
+    assert replica is not appconfig.get_engine()
+    assert appconfig.get_read_engine() is replica
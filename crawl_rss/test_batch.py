@@ -0,0 +1,89 @@
+import datetime
+from sqlalchemy.sql import select
+from . import models
+from .batch import apply_batch, due_feeds, fetch_feed
+from .crawl import DiffPosts, merge_feed
+from .feeds import FetchError, PostMetadata
+from .test_crawl import get_pages
+
+
+def add_feed(connection, url, **values):
+    result = connection.execute(models.feed.insert(), url=url, **values)
+    return result.inserted_primary_key[0]
+
+
+def mock_feed(httpx_mock, url, guid):
+    httpx_mock.add_response(
+        url=url,
+        data='<feed xmlns="http://www.w3.org/2005/Atom">'
+        f"<entry><id>{guid}</id></entry>"
+        "</feed>",
+    )
+
+
+class BrokenDiff(DiffPosts):
+    def apply(self, feed_id, connection):
+        super().apply(feed_id, connection)
+        raise RuntimeError("broken")
+
+
+def test_due_feeds(connection):
+    now = datetime.datetime(2020, 1, 2)
+    late = add_feed(connection, "http://late.example", next_check=now)
+    add_feed(connection, "http://early.example", next_check=now.replace(day=3))
+    later = add_feed(connection, "http://later.example", next_check=now.replace(day=1))
+
+    assert due_feeds(connection, 10, now) == [later, late]
+    assert due_feeds(connection, 1, now) == [later]
+
+
+def test_due_feeds_skips_merged(connection):
+    now = datetime.datetime(2020, 1, 2)
+    merged = add_feed(connection, "http://feed.example", next_check=now)
+    into = add_feed(connection, "https://feed.example", next_check=now)
+
+    merge_feed(merged, connection, into)
+    assert due_feeds(connection, 10, now) == [into]
+    assert due_feeds(connection, 10, now.replace(year=3000)) == [into]
+
+
+def test_apply_batch(httpx_mock, connection):
+    urls = [f"http://feed{n}.example" for n in range(4)]
+    good, stale, broken, missing = [add_feed(connection, url) for url in urls]
+    for n, url in enumerate(urls[:3]):
+        mock_feed(httpx_mock, url, f"urn:example:{n}")
+    httpx_mock.add_response(url=urls[3], status_code=404)
+
+    batch = [fetch_feed(feed_id, connection) for feed_id in (good, stale, broken)]
+    batch[2].diff.__class__ = BrokenDiff
+    batch.append(fetch_feed(missing, connection))
+    assert isinstance(batch[3].error, FetchError)
+
+    # Another crawl of this feed commits after the batch fetched it.
+    connection.execute(
+        models.feed.update()
+        .where(models.feed.c.id == stale)
+        .values(crawled=datetime.datetime.utcnow())
+    )
+
+    outcomes = apply_batch(connection, batch)
+    assert outcomes[good] == "crawled"
+    assert outcomes[stale] == "skipped"
+    assert isinstance(outcomes[broken], RuntimeError)
+    assert outcomes[missing] is batch[3].error
+    assert outcomes[missing].retry_at is not None
+
+    assert get_pages(connection, good) == [
+        ("http://feed0.example", {"urn:example:0": PostMetadata()})
+    ]
+    assert get_pages(connection, stale) == []
+    # The broken feed's partial changes were rolled back to its savepoint.
+    assert get_pages(connection, broken) == []
+
+    properties = dict(
+        connection.execute(
+            select([models.feed.c.id, models.feed.c.properties])
+        ).fetchall()
+    )
+    assert properties[missing]["failure"]["status"] == 404
+    assert properties[broken] == {}
@@ -1,9 +1,16 @@
+from concurrent.futures import ThreadPoolExecutor
+import datetime
 from itertools import islice
 import pytest
-from sqlalchemy.sql import bindparam
-from . import models
-from .crawl import crawl, DiffPosts
-from .feeds import PostMetadata
+import threading
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import bindparam, select
+from . import appconfig, models, redirects
+from . import crawl as crawl_module
+from .crawl import crawl, DiffPosts, FeedMoved, refresh_feed, SingleFlight
+from .crawl import StagedDiffPosts
+from .failures import CircuitBreaker, NegativeCache
+from .feeds import FetchError, PostMetadata
 
 
 post_page_query = models.page.join(models.post).select()
@@ -18,6 +25,15 @@ def feed_id(connection):
     return result.inserted_primary_key[0]
 
 
+@pytest.fixture(params=["memory", "staged"])
+def new_diff(request, connection):
+    "Check that both ways of computing a diff agree."
+
+    if request.param == "staged":
+        return lambda: StagedDiffPosts(connection)
+    return DiffPosts
+
+
 def set_pages(connection, feed_id, pages):
     page_query = models.page.insert().values(feed_id=feed_id)
     post_query = models.post.insert().values(feed_id=feed_id)
@@ -57,19 +73,25 @@ def get_pages(connection, feed_id):
     return pages
 
 
-def test_diff_empty(connection, feed_id):
-    diff = DiffPosts()
+def get_generation(connection, feed_id):
+    return connection.execute(
+        select([models.feed.c.generation]).where(models.feed.c.id == feed_id)
+    ).scalar()
+
+
+def test_diff_empty(connection, feed_id, new_diff):
+    diff = new_diff()
     diff.apply(feed_id, connection)
     assert get_pages(connection, feed_id) == []
 
 
-def test_diff_add_all(connection, feed_id):
+def test_diff_add_all(connection, feed_id, new_diff):
     pages = [
         ("http://feed.example/1", {"urn:example:1": PostMetadata(episode=1)}),
         ("http://feed.example", {"urn:example:2": PostMetadata(episode=2)}),
     ]
 
-    diff = DiffPosts()
+    diff = new_diff()
     for url, posts in reversed(pages):
         diff.new_page(url, None, posts)
     diff.apply(feed_id, connection)
@@ -77,14 +99,14 @@ def test_diff_add_all(connection, feed_id):
     assert get_pages(connection, feed_id) == pages
 
 
-def test_diff_remove_all(connection, feed_id):
+def test_diff_remove_all(connection, feed_id, new_diff):
     pages = [
         ("http://feed.example/1", {"urn:example:1": PostMetadata(episode=1)}),
         ("http://feed.example", {"urn:example:2": PostMetadata(episode=2)}),
     ]
     set_pages(connection, feed_id, pages)
 
-    diff = DiffPosts()
+    diff = new_diff()
     for post in connection.execute(post_page_query):
         diff.old_post(post)
     diff.apply(feed_id, connection)
@@ -92,14 +114,14 @@ def test_diff_remove_all(connection, feed_id):
     assert get_pages(connection, feed_id) == []
 
 
-def test_diff_unchanged(connection, feed_id):
+def test_diff_unchanged(connection, feed_id, new_diff):
     pages = [
         ("http://feed.example/1", {"urn:example:1": PostMetadata(episode=1)}),
         ("http://feed.example", {"urn:example:2": PostMetadata(episode=2)}),
     ]
     page_ids = set_pages(connection, feed_id, pages)
 
-    diff = DiffPosts()
+    diff = new_diff()
     diff.new_page(pages[1][0], page_ids[pages[1][0]], pages[1][1])
     for post in connection.execute(post_page_query):
         diff.old_post(post)
@@ -107,9 +129,101 @@ def test_diff_unchanged(connection, feed_id):
     diff.apply(feed_id, connection)
 
     assert get_pages(connection, feed_id) == pages
+    assert get_generation(connection, feed_id) == 0
+
+
+def get_changes(connection):
+    return [
+        tuple(row)
+        for row in connection.execute(
+            select(
+                [
+                    models.change_log.c.feed_id,
+                    models.change_log.c.guid,
+                    models.change_log.c.action,
+                ]
+            ).order_by(models.change_log.c.seq)
+        )
+    ]
 
 
-def test_diff_changed(connection, feed_id):
+def test_diff_change_log(connection, feed_id, new_diff):
+    pages = [
+        ("http://feed.example/1", {"urn:example:1": PostMetadata(episode=1)}),
+        (
+            "http://feed.example",
+            {
+                "urn:example:2": PostMetadata(episode=2),
+                "urn:example:3": PostMetadata(episode=3),
+            },
+        ),
+    ]
+    page_ids = set_pages(connection, feed_id, pages)
+
+    # Moving a post to another page changes its page URL, so that's logged
+    # as an update too.
+    diff = new_diff()
+    diff.new_page(
+        pages[1][0],
+        page_ids[pages[1][0]],
+        {
+            "urn:example:2": PostMetadata(episode=2, season=1),
+            "urn:example:4": PostMetadata(episode=4),
+        },
+    )
+    for post in connection.execute(post_page_query):
+        diff.old_post(post)
+    diff.new_page(
+        pages[0][0],
+        page_ids[pages[0][0]],
+        {
+            "urn:example:1": PostMetadata(episode=1),
+            "urn:example:3": PostMetadata(episode=3),
+        },
+    )
+    diff.apply(feed_id, connection)
+
+    assert sorted(get_changes(connection)) == [
+        (feed_id, "urn:example:2", "update"),
+        (feed_id, "urn:example:3", "update"),
+        (feed_id, "urn:example:4", "insert"),
+    ]
+
+    # Each crawl's changes come after the previous crawl's.
+    diff = new_diff()
+    for post in connection.execute(post_page_query):
+        diff.old_post(post)
+    diff.apply(feed_id, connection)
+
+    assert sorted(get_changes(connection)[3:]) == [
+        (feed_id, "urn:example:1", "delete"),
+        (feed_id, "urn:example:2", "delete"),
+        (feed_id, "urn:example:3", "delete"),
+        (feed_id, "urn:example:4", "delete"),
+    ]
+
+
+def test_diff_unchanged_skips_change_log_lock(connection, feed_id, new_diff):
+    pages = [
+        ("http://feed.example/1", {"urn:example:1": PostMetadata(episode=1)}),
+        ("http://feed.example", {"urn:example:2": PostMetadata(episode=2)}),
+    ]
+    page_ids = set_pages(connection, feed_id, pages)
+
+    # A crawl which found the same posts on the same pages has nothing to
+    # log, so it shouldn't wait on other crawls' changes to commit.
+    diff = new_diff()
+    diff.new_page(pages[1][0], page_ids[pages[1][0]], pages[1][1])
+    for post in connection.execute(post_page_query):
+        diff.old_post(post)
+    diff.new_page(pages[0][0], page_ids[pages[0][0]], pages[0][1])
+    diff.apply(feed_id, connection)
+
+    assert get_changes(connection) == []
+    assert connection.execute(models.change_log_lock.select()).fetchall() == []
+
+
+def test_diff_changed(connection, feed_id, new_diff):
     pages = [
         ("http://feed.example/1", {"urn:example:1": PostMetadata(episode=1)}),
         ("http://feed.example", {"urn:example:2": PostMetadata(episode=2)}),
@@ -118,7 +232,7 @@ def test_diff_changed(connection, feed_id):
 
     pages[0][1]["urn:example:1"] = PostMetadata(episode=0)
 
-    diff = DiffPosts()
+    diff = new_diff()
     for post in connection.execute(post_page_query):
         diff.old_post(post)
     for url, posts in reversed(pages):
@@ -126,9 +240,10 @@ def test_diff_changed(connection, feed_id):
     diff.apply(feed_id, connection)
 
     assert get_pages(connection, feed_id) == pages
+    assert get_generation(connection, feed_id) == 1
 
 
-def test_diff_moved(connection, feed_id):
+def test_diff_moved(connection, feed_id, new_diff):
     pages = [
         (
             "http://feed.example",
@@ -145,24 +260,81 @@ def test_diff_moved(connection, feed_id):
         ("http://feed.example/1", {"urn:example:1": pages[0][1].pop("urn:example:1")}),
     )
 
-    diff = DiffPosts()
+    diff = new_diff()
+    for post in connection.execute(post_page_query):
+        diff.old_post(post)
+    for url, posts in reversed(pages):
+        diff.new_page(url, page_ids.get(url), posts)
+    diff.apply(feed_id, connection)
+
+    assert get_pages(connection, feed_id) == pages
+
+
+def test_diff_summaries(connection, feed_id, new_diff):
+    day = datetime.datetime(2020, 1, 1)
+    pages = [
+        (
+            "http://feed.example",
+            {
+                "urn:example:1": PostMetadata(published=day),
+                "urn:example:2": PostMetadata(published=day.replace(day=2)),
+                "urn:example:3": PostMetadata(),
+            },
+        ),
+    ]
+    page_ids = set_pages(connection, feed_id, pages)
+
+    pages.insert(
+        0,
+        ("http://feed.example/1", {"urn:example:1": pages[0][1].pop("urn:example:1")}),
+    )
+
+    diff = new_diff()
     for post in connection.execute(post_page_query):
         diff.old_post(post)
     for url, posts in reversed(pages):
         diff.new_page(url, page_ids.get(url), posts)
     diff.apply(feed_id, connection)
 
+    page = models.page.c
+    summaries = connection.execute(
+        select([page.post_count, page.published_count, page.published_min])
+        .where(page.feed_id == feed_id)
+        .order_by(page.idx)
+    ).fetchall()
+    assert summaries == [(1, 1, day), (2, 1, day.replace(day=2))]
+
+
+def test_diff_hash_collisions(monkeypatch, connection, feed_id, new_diff):
+    monkeypatch.setattr(models, "hash_guid", lambda guid: 0)
+
+    pages = [
+        ("http://feed.example/1", {"urn:example:1": PostMetadata(episode=1)}),
+        ("http://feed.example", {"urn:example:2": PostMetadata(episode=2)}),
+    ]
+    page_ids = set_pages(connection, feed_id, pages)
+
+    pages[0][1]["urn:example:1"] = PostMetadata(episode=0)
+    pages[1][1]["urn:example:3"] = PostMetadata(episode=3)
+
+    diff = new_diff()
+    for post in connection.execute(post_page_query):
+        diff.old_post(post)
+    for url, posts in reversed(pages):
+        diff.new_page(url, page_ids[url], posts)
+    diff.apply(feed_id, connection)
+
     assert get_pages(connection, feed_id) == pages
 
 
-def test_diff_add_empty_page(connection, feed_id):
+def test_diff_add_empty_page(connection, feed_id, new_diff):
     pages = [
         ("http://feed.example/1", {"urn:example:1": PostMetadata(episode=1)}),
         ("http://feed.example/2", {}),
         ("http://feed.example", {"urn:example:2": PostMetadata(episode=2)}),
     ]
 
-    diff = DiffPosts()
+    diff = new_diff()
     for url, posts in reversed(pages):
         diff.new_page(url, None, posts)
     diff.apply(feed_id, connection)
@@ -170,8 +342,8 @@ def test_diff_add_empty_page(connection, feed_id):
     assert get_pages(connection, feed_id) == pages
 
 
-def test_diff_add_duplicate(connection, feed_id):
-    diff = DiffPosts()
+def test_diff_add_duplicate(connection, feed_id, new_diff):
+    diff = new_diff()
     diff.new_page(
         "http://feed.example", None, {"urn:example:1": PostMetadata(episode=1)}
     )
@@ -186,7 +358,7 @@ def test_diff_add_duplicate(connection, feed_id):
     ]
 
 
-def test_diff_partial_rewrite(connection, feed_id):
+def test_diff_partial_rewrite(connection, feed_id, new_diff):
     pages = [
         ("http://feed.example/1", {"urn:example:1": PostMetadata(episode=1)}),
         ("http://feed.example", {"urn:example:2": PostMetadata(episode=2)}),
@@ -198,7 +370,7 @@ def test_diff_partial_rewrite(connection, feed_id):
         ("http://feed.example", {"urn:example:3": PostMetadata(episode=3)}),
     ]
 
-    diff = DiffPosts()
+    diff = new_diff()
     diff.new_page(pages[2][0], page_ids[pages[2][0]], pages[2][1])
     for post in connection.execute(post_page_query.where(models.page.c.idx > 0)):
         diff.old_post(post)
@@ -485,6 +657,62 @@ def test_crawl_remove_post(httpx_mock, connection, feed_id):
     MockDiffPosts(httpx_mock, connection, feed_id, old_pages, new_pages)
 
 
+def test_crawl_relisted_archive_post(httpx_mock, connection, feed_id, new_diff):
+    """
+    A post on an archive page which the crawl doesn't need to fetch again may
+    also turn up in a newer page. The newer copy is the current one, so the
+    post should move there rather than being stored twice.
+    """
+
+    old_pages = [
+        ("http://feed.example/1", {"urn:example:1": PostMetadata(episode=1)}),
+        ("http://feed.example", {"urn:example:2": PostMetadata(episode=2)}),
+    ]
+    set_pages(connection, feed_id, old_pages)
+
+    new_pages = [
+        old_pages[0],
+        (
+            "http://feed.example",
+            {
+                "urn:example:1": PostMetadata(episode=1),
+                "urn:example:2": PostMetadata(episode=2),
+            },
+        ),
+    ]
+    mock_feeds(httpx_mock, new_pages, skip=1)
+
+    diff = new_diff()
+    crawl(feed_id, connection, diff)
+    diff.apply(feed_id, connection)
+
+    assert get_pages(connection, feed_id) == [("http://feed.example/1", {})] + [
+        new_pages[1]
+    ]
+    post_counts = connection.execute(
+        select([models.page.c.post_count]).order_by(models.page.c.idx)
+    ).fetchall()
+    assert post_counts == [(0,), (2,)]
+
+
+def test_post_guid_unique(connection, feed_id):
+    page_ids = set_pages(
+        connection,
+        feed_id,
+        [
+            ("http://feed.example/1", {"urn:example:1": PostMetadata()}),
+            ("http://feed.example", {}),
+        ],
+    )
+    with pytest.raises(IntegrityError):
+        connection.execute(
+            models.post.insert(),
+            feed_id=feed_id,
+            page_id=page_ids["http://feed.example"],
+            guid="urn:example:1",
+        )
+
+
 def test_crawl_reorder_archives(httpx_mock, connection, feed_id):
     """
     An RFC-compliant publisher should not change the order of prev-archive
@@ -503,3 +731,309 @@ def test_crawl_reorder_archives(httpx_mock, connection, feed_id):
     new_pages = [old_pages[0], old_pages[2], old_pages[1], old_pages[3]]
 
     MockDiffPosts(httpx_mock, connection, feed_id, old_pages, new_pages, common=1)
+
+
+def test_crawl_records_offsets(httpx_mock, connection, feed_id):
+    """
+    For archive pages which have a validator, we record where each post is
+    within the document, so we can find it again later without a full parse.
+    The subscription document changes too often for that to be worthwhile.
+    """
+
+    archive = (
+        '<feed xmlns="http://www.w3.org/2005/Atom">'
+        "<entry><id>urn:example:1</id></entry>"
+        "<entry><id>urn:example:2</id></entry>"
+        "</feed>"
+    )
+    httpx_mock.add_response(
+        url="http://feed.example",
+        data='<feed xmlns="http://www.w3.org/2005/Atom">'
+        '<link rel="prev-archive" href="http://feed.example/1"/>'
+        "<entry><id>urn:example:3</id></entry>"
+        "</feed>",
+    )
+    httpx_mock.add_response(
+        url="http://feed.example/1", data=archive, headers={"ETag": '"v1"'}
+    )
+
+    diff = DiffPosts()
+    crawl(feed_id, connection, diff)
+    diff.apply(feed_id, connection)
+
+    pages = {
+        page[models.page.c.url]: page
+        for page in connection.execute(models.page.select())
+    }
+    assert pages["http://feed.example"][models.page.c.validator] is None
+    assert pages["http://feed.example/1"][models.page.c.validator] == '"v1"'
+    assert pages["http://feed.example/1"][models.page.c.entries_start] == 42
+    assert pages["http://feed.example/1"][models.page.c.entries_end] == len(archive) - 7
+
+    offsets = {
+        post[models.post.c.guid]: (
+            post[models.post.c.entry_offset],
+            post[models.post.c.entry_length],
+        )
+        for post in connection.execute(models.post.select())
+    }
+    assert offsets.pop("urn:example:3") == (None, None)
+    for guid, (offset, length) in offsets.items():
+        assert archive[offset : offset + length] == f"<entry><id>{guid}</id></entry>"
+
+
+def test_single_flight():
+    flights = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def work():
+        calls.append(None)
+        started.set()
+        release.wait(5)
+        return len(calls)
+
+    with ThreadPoolExecutor(4) as executor:
+        leader = executor.submit(flights.run, "a", work)
+        started.wait(5)
+        followers = [executor.submit(flights.run, "a", work) for _ in range(3)]
+        # A different key doesn't have to wait.
+        assert flights.run("b", lambda: "b") == "b"
+        release.set()
+        assert [f.result() for f in [leader, *followers]] == [1, 1, 1, 1]
+
+    # Once a flight lands, the next caller starts a new one.
+    assert flights.run("a", work) == 2
+
+
+def test_single_flight_shares_errors():
+    flights = SingleFlight()
+    with pytest.raises(ZeroDivisionError):
+        flights.run("a", lambda: 1 / 0)
+    assert flights.run("a", lambda: "recovered") == "recovered"
+
+
+def test_refresh_fresh_feed(httpx_mock, connection, feed_id):
+    httpx_mock.add_response(
+        url="http://feed.example",
+        data='<feed xmlns="http://www.w3.org/2005/Atom">'
+        "<entry><id>urn:example:1</id></entry>"
+        "</feed>",
+    )
+
+    fresh_for = datetime.timedelta(minutes=1)
+    assert refresh_feed(feed_id, connection, fresh_for)
+    assert get_pages(connection, feed_id) == [
+        ("http://feed.example", {"urn:example:1": PostMetadata()})
+    ]
+
+    # A second request within the freshness window doesn't fetch anything.
+    assert not refresh_feed(feed_id, connection, fresh_for)
+    assert len(httpx_mock.get_requests()) == 1
+
+    assert refresh_feed(feed_id, connection, datetime.timedelta(0))
+    assert len(httpx_mock.get_requests()) == 2
+
+
+def test_crawl_staged(httpx_mock, connection, feed_id):
+    """
+    Crawling with the diff staged in the database gives the same result as
+    doing it in memory, including when it has to rewrite the whole archive.
+    """
+
+    old_pages = [
+        ("http://feed.example/1", {"urn:example:1": PostMetadata(episode=1)}),
+        ("http://feed.example/2", {"urn:example:2": PostMetadata(episode=2)}),
+        ("http://feed.example", {"urn:example:3": PostMetadata(episode=3)}),
+    ]
+    set_pages(connection, feed_id, old_pages)
+
+    new_pages = [
+        (
+            "http://feed.example/3",
+            {
+                "urn:example:1": PostMetadata(episode=1),
+                "urn:example:2": PostMetadata(episode=0),
+            },
+        ),
+        ("http://feed.example/4", {"urn:example:2": PostMetadata(episode=2)}),
+        ("http://feed.example", {"urn:example:4": PostMetadata(episode=4)}),
+    ]
+    mock_feeds(httpx_mock, new_pages)
+
+    # The staged diff finds the old posts itself, so the crawl shouldn't spend
+    # time reading them.
+    diff = StagedDiffPosts(connection)
+    diff.old_post = lambda post: pytest.fail("read an old post")
+    crawl(feed_id, connection, diff)
+    diff.apply(feed_id, connection)
+
+    assert get_pages(connection, feed_id) == [
+        ("http://feed.example/3", {"urn:example:1": PostMetadata(episode=1)}),
+        ("http://feed.example/4", {"urn:example:2": PostMetadata(episode=2)}),
+        ("http://feed.example", {"urn:example:4": PostMetadata(episode=4)}),
+    ]
+    assert get_generation(connection, feed_id) == 1
+
+
+@pytest.mark.parametrize("staged", [False, True])
+def test_crawl_ranks(httpx_mock, connection, feed_id, staged):
+    """
+    Feed-index ranks are rewritten for every page we fetch, and only count as
+    a change if they're different.
+    """
+
+    def subscription(*ranks):
+        return "".join(
+            [
+                '<feed xmlns="http://www.w3.org/2005/Atom"'
+                ' xmlns:r="http://purl.org/atompub/rank/1.0">'
+            ]
+            + [
+                f'<entry><id>urn:example:{n}</id><r:rank scheme="urn:s">{rank}</r:rank>'
+                "</entry>"
+                for n, rank in enumerate(ranks)
+            ]
+            + ["</feed>"]
+        )
+
+    def get_ranks():
+        return dict(
+            connection.execute(
+                select([models.post.c.guid, models.rank.c.rank]).select_from(
+                    models.post.join(models.rank)
+                )
+            ).fetchall()
+        )
+
+    def crawl_once():
+        diff = StagedDiffPosts(connection) if staged else DiffPosts()
+        crawl(feed_id, connection, diff)
+        diff.apply(feed_id, connection)
+
+    for ranks, generation in [((2, 1), 1), ((2, 1), 1), ((1, 2), 2)]:
+        httpx_mock.add_response(url="http://feed.example", data=subscription(*ranks))
+        crawl_once()
+        assert get_ranks() == {f"urn:example:{n}": rank for n, rank in enumerate(ranks)}
+        assert get_generation(connection, feed_id) == generation
+
+
+@pytest.mark.parametrize("staged", [False, True])
+def test_refresh_failure(monkeypatch, httpx_mock, connection, feed_id, staged):
+    monkeypatch.setattr(appconfig, "STAGED_DIFF", staged)
+    monkeypatch.setattr(crawl_module, "host_breaker", CircuitBreaker(1, 60))
+    monkeypatch.setattr(crawl_module, "missing_pages", NegativeCache(60))
+
+    httpx_mock.add_response(
+        url="http://feed.example",
+        data='<feed xmlns="http://www.w3.org/2005/Atom">'
+        '<link rel="prev-archive" href="http://feed.example/1"/>'
+        "<entry><id>urn:example:2</id></entry>"
+        "</feed>",
+    )
+    httpx_mock.add_response(url="http://feed.example/1", status_code=404)
+
+    fresh_for = datetime.timedelta(0)
+    with pytest.raises(FetchError) as failed:
+        refresh_feed(feed_id, connection, fresh_for)
+    assert failed.value.gone
+    assert failed.value.retry_at is not None
+    assert get_pages(connection, feed_id) == []
+
+    # While the feed is backing off, it isn't fetched at all.
+    with pytest.raises(FetchError):
+        refresh_feed(feed_id, connection, fresh_for)
+    assert len(httpx_mock.get_requests()) == 2
+
+    # Nor is the missing page, even once the backoff is over.
+    connection.execute(models.feed.update().values(next_check=datetime.datetime.min))
+    with pytest.raises(FetchError):
+        refresh_feed(feed_id, connection, fresh_for)
+    assert len(httpx_mock.get_requests()) == 3
+
+    # A server error cuts off its host, since the breaker's threshold is 1.
+    connection.execute(models.feed.update().values(next_check=datetime.datetime.min))
+    httpx_mock.add_response(url="http://feed.example", status_code=503)
+    with pytest.raises(FetchError) as failed:
+        refresh_feed(feed_id, connection, fresh_for)
+    assert failed.value.status == 503
+    connection.execute(models.feed.update().values(next_check=datetime.datetime.min))
+    with pytest.raises(FetchError) as failed:
+        refresh_feed(feed_id, connection, fresh_for)
+    assert failed.value.status is None
+    assert len(httpx_mock.get_requests()) == 4
+
+
+def test_crawl_permanent_redirects(httpx_mock, connection, feed_id):
+    def moved(url, status_code=301):
+        httpx_mock.add_response(
+            url=url,
+            status_code=status_code,
+            headers={"Location": url.replace("http:", "https:") + "/"},
+        )
+
+    moved("http://feed.example")
+    moved("http://feed.example/1", 308)
+    httpx_mock.add_response(
+        url="https://feed.example",
+        data='<feed xmlns="http://www.w3.org/2005/Atom">'
+        '<link rel="prev-archive" href="http://feed.example/1"/>'
+        "<entry><id>urn:example:2</id></entry>"
+        "</feed>",
+    )
+    httpx_mock.add_response(
+        url="https://feed.example/1/",
+        data='<feed xmlns="http://www.w3.org/2005/Atom">'
+        "<entry><id>urn:example:1</id></entry>"
+        "</feed>",
+    )
+
+    refresh_feed(feed_id, connection, datetime.timedelta(0))
+    expected = [
+        ("https://feed.example/1/", {"urn:example:1": PostMetadata()}),
+        ("https://feed.example", {"urn:example:2": PostMetadata()}),
+    ]
+    assert get_pages(connection, feed_id) == expected
+    assert connection.execute(
+        select([models.feed.c.url]).where(models.feed.c.id == feed_id)
+    ).scalar() == ("https://feed.example")
+
+    # Later crawls go straight to the new URLs.
+    requests = len(httpx_mock.get_requests())
+    refresh_feed(feed_id, connection, datetime.timedelta(0))
+    assert [str(r.url) for r in httpx_mock.get_requests()[requests:]] == [
+        "https://feed.example"
+    ]
+    assert get_pages(connection, feed_id) == expected
+
+
+def test_refresh_merges_moved_feed(httpx_mock, connection, feed_id):
+    other_id = connection.execute(
+        models.feed.insert(), url="https://feed.example"
+    ).inserted_primary_key[0]
+    set_pages(
+        connection,
+        feed_id,
+        [("http://feed.example", {"urn:example:1": PostMetadata()})],
+    )
+    httpx_mock.add_response(
+        url="http://feed.example",
+        status_code=301,
+        headers={"Location": "HTTPS://FEED.EXAMPLE:443/"},
+    )
+    httpx_mock.add_response(
+        url="https://feed.example", data='<feed xmlns="http://www.w3.org/2005/Atom"/>'
+    )
+
+    with pytest.raises(FeedMoved) as moved:
+        refresh_feed(feed_id, connection, datetime.timedelta(0))
+    assert moved.value.feed_id == other_id
+    assert get_pages(connection, feed_id) == []
+    assert connection.execute(
+        select([models.feed.c.properties]).where(models.feed.c.id == feed_id)
+    ).scalar() == {"merged_into": other_id}
+    assert get_changes(connection) == [(feed_id, "urn:example:1", "delete")]
+
+    resolved = redirects.resolve(connection, "http://feed.example")
+    assert resolved == "https://feed.example"
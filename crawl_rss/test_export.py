@@ -0,0 +1,108 @@
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import json
+import pytest
+from sqlalchemy.exc import ProgrammingError
+import threading
+from . import export, models
+from .export import export_rows, format_csv, format_ndjson
+
+
+def test_export_rows(connection):
+    feed_ids = []
+    for n in range(2):
+        feed_id = connection.execute(
+            models.feed.insert(), url=f"http://feed{n}.example"
+        ).inserted_primary_key[0]
+        page_id = connection.execute(
+            models.page.insert(), feed_id=feed_id, idx=0, url=f"http://feed{n}.example"
+        ).inserted_primary_key[0]
+        connection.execute(
+            models.post.insert().values(feed_id=feed_id, page_id=page_id),
+            [
+                {
+                    "guid": "urn:example:1",
+                    "published": datetime.datetime(2020, 1, 1),
+                    "season": None,
+                    "episode": None,
+                },
+                {"guid": "urn:example:2", "published": None, "season": 1, "episode": 2},
+            ],
+        )
+        feed_ids.append(feed_id)
+
+    rows = list(export_rows(connection, feed_ids[1:]))
+    assert rows == [
+        {
+            "feed_id": feed_ids[1],
+            "guid": "urn:example:1",
+            "page_url": "http://feed1.example",
+            "published": datetime.datetime(2020, 1, 1),
+            "updated": None,
+            "season": None,
+            "episode": None,
+        },
+        {
+            "feed_id": feed_ids[1],
+            "guid": "urn:example:2",
+            "page_url": "http://feed1.example",
+            "published": None,
+            "updated": None,
+            "season": 1,
+            "episode": 2,
+        },
+    ]
+
+    everything = list(export_rows(connection))
+    assert [row["feed_id"] for row in everything] == [feed_ids[0]] * 2 + [
+        feed_ids[1]
+    ] * 2
+
+    ndjson = b"".join(format_ndjson(everything)).decode().splitlines()
+    assert len(ndjson) == 4
+    assert '"published":"2020-01-01T00:00:00"' in ndjson[0]
+
+    csv = b"".join(format_csv(everything)).decode().splitlines()
+    assert csv[0] == "feed_id,guid,page_url,published,updated,season,episode"
+    assert csv[4] == f"{feed_ids[1]},urn:example:2,http://feed1.example,,,1,2"
+
+
+def test_export_on_thread(monkeypatch, engine):
+    monkeypatch.setattr(export, "CHUNK_SIZE", 1)
+    with engine.begin() as connection:
+        feed_id = connection.execute(
+            models.feed.insert(), url="http://feed.example"
+        ).inserted_primary_key[0]
+        page_id = connection.execute(
+            models.page.insert(), feed_id=feed_id, idx=0, url="http://feed.example"
+        ).inserted_primary_key[0]
+        connection.execute(
+            models.post.insert().values(feed_id=feed_id, page_id=page_id),
+            [{"guid": f"urn:example:{n}"} for n in range(10)],
+        )
+
+    # Servers may ask for each chunk of a streamed response on a different
+    # thread, which a database connection can't follow.
+    def next_on_new_thread(chunks):
+        with ThreadPoolExecutor(1) as executor:
+            return executor.submit(next, chunks, None).result()
+
+    chunks = export.export([feed_id], "ndjson")
+    with pytest.raises(ProgrammingError):
+        for chunk in iter(lambda: next_on_new_thread(chunks), None):
+            pass
+
+    chunks = export.export_on_thread([feed_id], "ndjson")
+    lines = []
+    for chunk in iter(lambda: next_on_new_thread(chunks), None):
+        lines.append(json.loads(chunk))
+    assert [line["guid"] for line in lines] == [f"urn:example:{n}" for n in range(10)]
+
+    # A reader which stops early doesn't leave the export's thread stuck.
+    chunks = export.export_on_thread([feed_id], "ndjson")
+    assert next(chunks)
+    chunks.close()
+    for thread in threading.enumerate():
+        if thread.name == "export":
+            thread.join(5)
+            assert not thread.is_alive()
@@ -0,0 +1,59 @@
+import pytest
+from .failures import CircuitBreaker, NegativeCache
+from .feeds import FetchError
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_circuit_breaker():
+    clock = Clock()
+    breaker = CircuitBreaker(threshold=2, cooldown=60, clock=clock)
+
+    breaker.failed("feed.example")
+    breaker.check("feed.example", "http://feed.example")
+    breaker.failed("feed.example")
+    with pytest.raises(FetchError):
+        breaker.check("feed.example", "http://feed.example")
+    breaker.check("other.example", "http://other.example")
+
+    # After the cool-down, one request may try again. If it fails too, the
+    # circuit opens for another cool-down.
+    clock.now = 61
+    breaker.check("feed.example", "http://feed.example")
+    breaker.failed("feed.example")
+    with pytest.raises(FetchError):
+        breaker.check("feed.example", "http://feed.example")
+
+    clock.now = 122
+    breaker.succeeded("feed.example")
+    breaker.failed("feed.example")
+    breaker.check("feed.example", "http://feed.example")
+
+
+def test_negative_cache():
+    clock = Clock()
+    cache = NegativeCache(ttl=60, clock=clock)
+    error = FetchError("http://feed.example/1", "HTTP 404", 404)
+
+    cache.check("http://feed.example/1")
+    cache.put("http://feed.example/1", error)
+
+    # Each hit gets an error of its own, which says when to try again.
+    clock.now = 20
+    with pytest.raises(FetchError) as first:
+        cache.check("http://feed.example/1")
+    first.value.retry_at = object()
+    with pytest.raises(FetchError) as second:
+        cache.check("http://feed.example/1")
+    assert second.value is not first.value and second.value is not error
+    assert second.value.gone and second.value.retry_at is None
+    assert second.value.headers == {"retry-after": "40"}
+
+    clock.now = 60
+    cache.check("http://feed.example/1")
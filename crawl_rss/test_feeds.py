@@ -1,5 +1,7 @@
+from concurrent.futures import ProcessPoolExecutor
 import datetime
-from .feeds import FeedDocument, PostMetadata
+from . import appconfig, feeds
+from .feeds import FeedDocument, FeedIndex, PostMetadata
 
 
 def test_feed_parsing(httpx_mock):
@@ -100,3 +102,128 @@ def test_with_proxy(httpx_mock):
     )
     doc = FeedDocument(url, proxy)
     assert doc.get_link("self") == "http://other.example/feed.xml"
+
+
+def test_index_in_worker_process(httpx_mock, monkeypatch):
+    """
+    Crawls can hand parsing off to a process pool, which sends back only the
+    links and post metadata.
+    """
+
+    data = """
+    <feed xmlns="http://www.w3.org/2005/Atom">
+    <link rel="prev-archive" href="/archive/1.xml"/>
+    <entry>
+        <id>urn:example:pub</id>
+        <published>2020-01-01T00:00:00Z</published>
+    </entry>
+    </feed>
+    """
+
+    url = "http://feed.example/feed.xml"
+    httpx_mock.add_response(url=url, data=data)
+    doc = FeedDocument(url)
+
+    with ProcessPoolExecutor(1) as executor:
+        monkeypatch.setattr(appconfig, "get_parse_executor", lambda: executor)
+        index = doc.index()
+
+    assert index.get_link("prev-archive") == "http://feed.example/archive/1.xml"
+    assert index.get_link("next-archive") is None
+    assert index.posts == {
+        "urn:example:pub": PostMetadata(
+            published=datetime.datetime(2020, 1, 1),
+            updated=datetime.datetime(2020, 1, 1),
+        )
+    }
+    assert index == FeedIndex(
+        links=(("prev-archive", "http://feed.example/archive/1.xml"),),
+        posts=doc.posts(),
+    )
+
+
+def test_selected_entries(httpx_mock, monkeypatch):
+    """
+    We can fully parse just the entries we want from a large document, and get
+    the same results as if we'd parsed the whole thing.
+    """
+
+    url = "http://feed.example/feed.xml"
+    data = """<?xml version="1.0" encoding="utf-8"?>
+    <feed xmlns="http://www.w3.org/2005/Atom" xml:base="http://feed.example/">
+    <title>Example</title>
+    <entry><id>urn:example:1</id><title>One</title></entry>
+    <entry><title>No ID</title></entry>
+    <entry>
+        <id> urn:example:2 </id>
+        <source><id>urn:example:source</id></source>
+        <link href="/2.html"/>
+    </entry>
+    <entry><id>urn:example:3</id><title>Three</title></entry>
+    </feed>
+    """.encode()
+
+    # Scanning stops at the end of whichever chunk has the last wanted entry.
+    monkeypatch.setattr(feeds, "SCAN_CHUNK", 16)
+    layout = feeds.scan_entries(data, {"urn:example:2"})
+    assert layout is not None
+    assert layout.tail is None
+    assert set(layout.spans) == {"urn:example:1", "urn:example:2"}
+
+    httpx_mock.add_response(url=url, data=data)
+    selected = FeedDocument(url).entries({"urn:example:2", "urn:example:3"})
+
+    httpx_mock.add_response(url=url, data=data)
+    full = FeedDocument(url).doc.entries
+
+    assert selected == {"urn:example:2": full[2], "urn:example:3": full[3]}
+    assert selected["urn:example:2"].link == "http://feed.example/2.html"
+
+
+def test_selected_entries_fallback(httpx_mock):
+    """
+    If a document is too broken for our quick scan, selecting entries still
+    works by falling back to feedparser's more forgiving parse.
+    """
+
+    url = "http://feed.example/feed.xml"
+    data = b"""
+    <rss version="2.0"><channel>
+    <item><guid>urn:example:1</guid><title>One&nbsp;</title></item>
+    <item><guid>urn:example:2</guid><title>Two</title></item>
+    </channel></rss>
+    """
+
+    assert feeds.scan_entries(data) is None
+
+    httpx_mock.add_response(url=url, data=data)
+    selected = FeedDocument(url).entries({"urn:example:2"})
+    assert selected["urn:example:2"].title == "Two"
+    assert list(selected) == ["urn:example:2"]
+
+
+def test_entries_from_stored_layout(httpx_mock, monkeypatch):
+    """
+    Given where an entry was in a previous copy of this document, we don't
+    need to scan for it again.
+    """
+
+    url = "http://feed.example/feed.xml"
+    data = b"""<feed xmlns="http://www.w3.org/2005/Atom">
+    <entry><id>urn:example:1</id><title>One</title></entry>
+    <entry><id>urn:example:2</id><title>Two</title></entry>
+    </feed>"""
+
+    httpx_mock.add_response(url=url, data=data, headers={"ETag": '"v1"'})
+    doc = FeedDocument(url)
+    assert doc.validator == '"v1"'
+
+    layout = feeds.scan_entries(data)
+    assert layout is not None
+    stored = layout._replace(spans={"urn:example:2": layout.spans["urn:example:2"]})
+
+    def no_scan(*args):
+        raise AssertionError("should have used the stored layout")
+
+    monkeypatch.setattr(feeds, "scan_entries", no_scan)
+    assert doc.entries({"urn:example:2"}, stored)["urn:example:2"].title == "Two"
@@ -0,0 +1,74 @@
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import threading
+import time
+from .hedging import hedged
+
+
+@pytest.fixture
+def executor():
+    executor = ThreadPoolExecutor(max_workers=4)
+    yield executor
+    executor.shutdown(wait=True)
+
+
+def returns(value, after=0.0, release=None):
+    def attempt():
+        if release is not None:
+            release.wait(after)
+        else:
+            time.sleep(after)
+        return value
+
+    return attempt
+
+
+def fails(message):
+    def attempt():
+        raise RuntimeError(message)
+
+    return attempt
+
+
+def test_hedged_first_answers(executor):
+    started = []
+
+    def second():
+        started.append(True)
+        return "second"
+
+    deadline = time.monotonic() + 5
+    assert hedged([returns("first"), second], 1, deadline, executor) == "first"
+    assert started == []
+
+
+def test_hedged_slow_first(executor):
+    release = threading.Event()
+    deadline = time.monotonic() + 5
+    attempts = [returns("first", 5, release), returns("second")]
+    assert hedged(attempts, 0.01, deadline, executor) == "second"
+    release.set()
+
+
+def test_hedged_failure_starts_next(executor):
+    deadline = time.monotonic() + 5
+    start = time.monotonic()
+    assert (
+        hedged([fails("first"), returns("second")], 5, deadline, executor) == "second"
+    )
+    assert time.monotonic() - start < 1
+
+
+def test_hedged_all_fail(executor):
+    deadline = time.monotonic() + 5
+    with pytest.raises(RuntimeError, match="second"):
+        hedged([fails("first"), fails("second")], 0.01, deadline, executor)
+
+
+def test_hedged_deadline(executor):
+    release = threading.Event()
+    deadline = time.monotonic() + 0.05
+    attempts = [returns("first", 5, release), returns("second", 5, release)]
+    with pytest.raises(TimeoutError):
+        hedged(attempts, 0.01, deadline, executor)
+    release.set()
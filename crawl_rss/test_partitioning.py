@@ -0,0 +1,86 @@
+"""
+Partitioning only works on PostgreSQL, so these tests need a scratch
+PostgreSQL database at TEST_POSTGRES_URL, and are skipped without one. They
+drop every table in it.
+"""
+
+from alembic import command
+from alembic.config import Config
+import os
+import pytest
+from sqlalchemy.exc import IntegrityError
+from . import appconfig, models
+from .partitioning import is_partitioned_sql
+from .test_server import add_feed, get, ids, recrawl
+
+
+@pytest.fixture
+def postgres(monkeypatch):
+    url = os.environ.get("TEST_POSTGRES_URL")
+    if not url:
+        pytest.skip("TEST_POSTGRES_URL isn't set")
+
+    engine = appconfig._create_engine(url)
+
+    def drop_all():
+        appconfig.metadata.drop_all(engine)
+        engine.execute("DROP TABLE IF EXISTS alembic_version")
+
+    drop_all()
+    monkeypatch.setattr(appconfig, "_engine", engine)
+    yield engine
+    drop_all()
+    engine.dispose()
+
+
+def migrate(engine, action, revision):
+    config = Config("alembic.ini")
+    with engine.begin() as connection:
+        config.attributes["connection"] = connection
+        getattr(command, action)(config, revision)
+
+
+@pytest.mark.parametrize("staged", [False, True])
+def test_partitioned_posts(monkeypatch, httpx_mock, postgres, staged):
+    monkeypatch.setattr(appconfig, "POST_PARTITIONS", 4)
+    monkeypatch.setattr(appconfig, "STAGED_DIFF", staged)
+    migrate(postgres, "upgrade", "head")
+    assert postgres.execute(is_partitioned_sql()).scalar()
+
+    feed_id = add_feed(
+        postgres, httpx_mock, (1, "2020-01-01T00:00:00Z"), (2, "2020-01-02T00:00:00Z")
+    )
+    other_id = add_feed(
+        postgres, httpx_mock, (1, "2020-01-01T00:00:00Z"), url="http://other.example"
+    )
+    recrawl(
+        postgres,
+        httpx_mock,
+        feed_id,
+        (2, "2020-01-02T12:00:00Z"),
+        (3, "2020-01-03T00:00:00Z"),
+    )
+
+    assert ids(get(f"/posts/{feed_id}")) == ["urn:example:3", "urn:example:2"]
+    assert ids(get(f"/posts/{other_id}")) == ["urn:example:1"]
+
+    # GUIDs are still unique within a feed, and page URLs across all feeds.
+    page_id = postgres.execute(
+        models.page.select().where(models.page.c.feed_id == other_id)
+    ).first()[models.page.c.id]
+    with pytest.raises(IntegrityError):
+        postgres.execute(
+            models.post.insert(),
+            feed_id=other_id,
+            page_id=page_id,
+            guid="urn:example:1",
+        )
+    with pytest.raises(IntegrityError):
+        postgres.execute(
+            models.page.insert(), feed_id=other_id, idx=1, url="http://feed.example"
+        )
+
+    migrate(postgres, "downgrade", "-1")
+    assert not postgres.execute(is_partitioned_sql()).scalar()
+    assert ids(get(f"/posts/{feed_id}")) == ["urn:example:3", "urn:example:2"]
+    assert ids(get(f"/posts/{other_id}")) == ["urn:example:1"]
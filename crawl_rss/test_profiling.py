@@ -0,0 +1,39 @@
+import os
+import time
+from . import appconfig, profiling
+
+
+def spin(seconds):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+def test_profile_slow(monkeypatch, tmp_path):
+    monkeypatch.setattr(appconfig, "PROFILE_SLOW_CRAWLS", 0.05)
+    monkeypatch.setattr(appconfig, "PROFILE_INTERVAL", 0.001)
+    monkeypatch.setattr(appconfig, "PROFILE_DIR", str(tmp_path))
+
+    with profiling.profile_if_slow("fast"):
+        pass
+    assert os.listdir(tmp_path) == []
+
+    with profiling.profile_if_slow("slow"):
+        spin(0.1)
+    (name,) = os.listdir(tmp_path)
+    assert name.startswith("slow-") and name.endswith(".folded")
+
+    lines = (tmp_path / name).read_text().splitlines()
+    assert lines
+    stack, count = lines[-1].rsplit(" ", 1)
+    assert int(count) > 0
+    assert any("spin (test_profiling.py:" in line for line in lines)
+
+
+def test_profile_off(monkeypatch, tmp_path):
+    monkeypatch.setattr(appconfig, "PROFILE_SLOW_CRAWLS", 0)
+    monkeypatch.setattr(appconfig, "PROFILE_DIR", str(tmp_path))
+
+    with profiling.profile_if_slow("slow"):
+        spin(0.01)
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,305 @@
+"""
+Crawls of long, randomly edited feed histories, checked against a simple model
+of what the database should hold afterward. These also check that the number
+of SQL statements a crawl makes and the work the database does for them grow
+no faster than the amount of history it looks at. How long the crawls took is
+only reported, in the JUnit XML report's test properties, since wall-clock
+time on a shared machine is too noisy to assert on.
+"""
+
+import datetime
+import random
+import time
+from typing import NamedTuple
+from pytest_httpx import to_response
+from sqlalchemy import event, select
+from sqlalchemy.engine import Connection
+from . import models
+from .crawl import refresh_feed
+from .feeds import PostMetadata
+from .test_crawl import get_pages
+from .test_server import get
+
+
+SUBSCRIPTION_URL = "http://feed.example"
+POSTS_PER_PAGE = 4
+
+
+class Model:
+    """
+    What the publisher is currently serving: a list of pages, oldest first,
+    each a URL and the posts on it, with the subscription document last.
+    """
+
+    def __init__(self, seed, pages):
+        self.rng = random.Random(seed)
+        self.serial = 0
+        self.pages = []
+        for _ in range(pages - 1):
+            self.pages.append((self.page_url(), self.new_posts(POSTS_PER_PAGE)))
+        self.pages.append((SUBSCRIPTION_URL, self.new_posts(POSTS_PER_PAGE)))
+
+    def page_url(self):
+        self.serial += 1
+        return f"http://feed.example/archive/{self.serial}"
+
+    def new_posts(self, count):
+        posts = {}
+        for _ in range(count):
+            self.serial += 1
+            posts[f"urn:example:{self.serial}"] = PostMetadata(episode=self.serial)
+        return posts
+
+    def publish(self):
+        "Add a post, moving a full subscription document to a new archive page."
+
+        url, posts = self.pages[-1]
+        if len(posts) >= POSTS_PER_PAGE:
+            self.pages[-1] = (self.page_url(), posts)
+            posts = {}
+            self.pages.append((url, posts))
+        posts.update(self.new_posts(1))
+
+    def rewrite(self, depth, deletions):
+        """
+        Republish the newest `depth` pages at new URLs, as RFC5005 requires
+        when archives change: posts move between them, some are edited, and
+        if `deletions` is set, some are removed.
+        """
+
+        depth = min(depth, len(self.pages))
+        posts = [post for _, page in self.pages[-depth:] for post in page.items()]
+        if deletions:
+            posts = [post for post in posts if self.rng.random() >= 0.2]
+        posts = [
+            (guid, meta._replace(season=self.rng.randrange(10)))
+            if self.rng.random() < 0.1
+            else (guid, meta)
+            for guid, meta in posts
+        ]
+        self.rng.shuffle(posts)
+
+        del self.pages[-depth:]
+        while True:
+            chunk, posts = posts[:POSTS_PER_PAGE], posts[POSTS_PER_PAGE:]
+            if not posts:
+                self.pages.append((SUBSCRIPTION_URL, dict(chunk)))
+                break
+            self.pages.append((self.page_url(), dict(chunk)))
+
+    def mutate(self, deletions):
+        choice = self.rng.random()
+        if choice < 0.6:
+            for _ in range(self.rng.randint(1, 3)):
+                self.publish()
+        else:
+            self.rewrite(self.rng.randint(1, 20), deletions and choice >= 0.9)
+
+    def documents(self):
+        docs = {}
+        prev = None
+        for url, posts in self.pages:
+            data = ['<feed xmlns="http://www.w3.org/2005/Atom"']
+            data.append(' xmlns:itunes="http://www.itunes.com/DTDs/PodCast-1.0.dtd">')
+            if prev is not None:
+                data.append(f'<link rel="prev-archive" href="{prev}"/>')
+            for guid, post in posts.items():
+                data.append(f"<entry><id>{guid}</id>")
+                if post.season is not None:
+                    data.append(f"<itunes:season>{post.season}</itunes:season>")
+                data.append(f"<itunes:episode>{post.episode}</itunes:episode>")
+                data.append("</entry>")
+            data.append("</feed>")
+            docs[url] = "".join(data)
+            prev = url
+        return docs
+
+
+def serve(httpx_mock):
+    "Answer every request from a dict of documents which `crawl` fills in."
+
+    def callback(request, timeout):
+        return to_response(data=docs[str(request.url).rstrip("/")])
+
+    docs = {}
+    httpx_mock.add_callback(callback)
+    return docs
+
+
+class Cost(NamedTuple):
+    statements: int
+    # Thousands of SQLite virtual machine instructions, which unlike time is
+    # a repeatable measure of how much work the database did.
+    steps: int
+    seconds: float
+
+    def __add__(self, other):
+        return Cost(*(a + b for a, b in zip(self, other)))
+
+
+def measure(target, action):
+    """
+    Run `action`, and return what the statements it ran on `target`, an
+    engine or connection, cost.
+    """
+
+    statements = steps = 0
+
+    def before_cursor_execute(*args):
+        nonlocal statements
+        statements += 1
+
+    def progress():
+        nonlocal steps
+        steps += 1
+        return 0
+
+    def checkout(dbapi_connection, *args):
+        dbapi_connection.set_progress_handler(progress, 1000)
+
+    def checkin(dbapi_connection, *args):
+        dbapi_connection.set_progress_handler(None, 0)
+
+    if isinstance(target, Connection):
+        checkout(target.connection.connection)
+    else:
+        event.listen(target, "checkout", checkout)
+        event.listen(target, "checkin", checkin)
+    event.listen(target, "before_cursor_execute", before_cursor_execute)
+    try:
+        start = time.perf_counter()
+        action()
+        seconds = time.perf_counter() - start
+    finally:
+        event.remove(target, "before_cursor_execute", before_cursor_execute)
+        if isinstance(target, Connection):
+            checkin(target.connection.connection)
+        else:
+            event.remove(target, "checkout", checkout)
+            event.remove(target, "checkin", checkin)
+    return Cost(statements, steps, seconds)
+
+
+def crawl(connection, feed_id, docs, model):
+    "Crawl the model's current documents, and return what that cost."
+
+    docs.clear()
+    docs.update(model.documents())
+    return measure(
+        connection,
+        lambda: refresh_feed(feed_id, connection, datetime.timedelta(0)),
+    )
+
+
+def add_feed(connection):
+    result = connection.execute(models.feed.insert(), url=SUBSCRIPTION_URL)
+    return result.inserted_primary_key[0]
+
+
+def test_random_history(httpx_mock, connection):
+    feed_id = add_feed(connection)
+    model = Model(seed=0, pages=1000)
+    docs = serve(httpx_mock)
+
+    crawl(connection, feed_id, docs, model)
+    assert get_pages(connection, feed_id) == model.pages
+
+    for round in range(30):
+        model.mutate(deletions=True)
+        crawl(connection, feed_id, docs, model)
+        if round % 5 == 4:
+            assert get_pages(connection, feed_id) == model.pages
+
+
+def test_linear_growth(httpx_mock, connection, record_property):
+    """
+    Crawling a whole history, whether for the first time or to find out
+    whether posts which have disappeared were moved to older pages, should
+    cost in proportion to its length. Crawls which only touch the newest pages
+    should make the same statements no matter how long the history is, though
+    the database may take a little longer to run some of them.
+    """
+
+    docs = serve(httpx_mock)
+    sizes = (100, 1000)
+    initial, recent, deleted = [], [], []
+    for size in sizes:
+        connection.execute(models.feed.delete())
+        feed_id = add_feed(connection)
+        model = Model(seed=1, pages=size)
+        initial.append(crawl(connection, feed_id, docs, model))
+
+        total = Cost(0, 0, 0.0)
+        for _ in range(10):
+            model.mutate(deletions=False)
+            total += crawl(connection, feed_id, docs, model)
+        recent.append(total)
+
+        model.pages[-1][1].popitem()
+        deleted.append(crawl(connection, feed_id, docs, model))
+        assert get_pages(connection, feed_id) == model.pages
+
+    for name, costs in (("initial", initial), ("recent", recent), ("deleted", deleted)):
+        for size, cost in zip(sizes, costs):
+            record_property(f"{name}_{size}_seconds", cost.seconds)
+
+    # Linear growth with a fixed overhead stays within these bounds, while
+    # quadratic growth would go far past them. Index lookups get slower as
+    # tables grow, so those get some slack.
+    growth = sizes[1] / sizes[0]
+    for small, large in (initial, deleted):
+        assert large.statements <= growth * small.statements
+        assert large.steps <= 2 * growth * small.steps
+
+    small, large = recent
+    assert large.statements == small.statements
+    assert large.steps <= growth * small.steps
+
+
+def test_river_depth(httpx_mock, engine, record_property):
+    """
+    Each feed in a river is read from an index seek on the last post of the
+    previous page, so a page deep in a long feed should cost the database no
+    more than one near its start, in either direction.
+    """
+
+    httpx_mock.add_response(url=SUBSCRIPTION_URL, data="<feed/>")
+    start = datetime.datetime(2020, 1, 1)
+    with engine.begin() as connection:
+        feed_id = add_feed(connection)
+        page_id = connection.execute(
+            models.page.insert(), feed_id=feed_id, idx=0, url=SUBSCRIPTION_URL
+        ).inserted_primary_key[0]
+        connection.execute(
+            models.post.insert().values(feed_id=feed_id, page_id=page_id),
+            [
+                {
+                    "guid": f"urn:example:{n}",
+                    # Pairs of posts share a date, so the ID breaks ties.
+                    "published": start + datetime.timedelta(hours=n // 2),
+                }
+                for n in range(20000)
+            ],
+        )
+        ascending = [
+            row[0]
+            for row in connection.execute(
+                select([models.post.c.id]).order_by(
+                    models.post.c.published, models.post.c.id
+                )
+            )
+        ]
+
+    for order, ordered in (("published", ascending), ("-published", ascending[::-1])):
+        shallow, deep = (
+            measure(
+                engine,
+                lambda: get(
+                    f"/posts?feed={feed_id}&order={order}&after={ordered[depth]}"
+                ),
+            )
+            for depth in (10, len(ordered) - 100)
+        )
+        record_property(f"river_{order}_shallow_seconds", shallow.seconds)
+        record_property(f"river_{order}_deep_seconds", deep.seconds)
+        assert (deep.statements, deep.steps) == (shallow.statements, shallow.steps)
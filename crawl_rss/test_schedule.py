@@ -0,0 +1,133 @@
+import datetime
+import random
+from sqlalchemy.sql import select
+from . import appconfig, models
+from .feeds import FeedHints, FetchError
+from .schedule import backoff, next_check, reschedule
+
+
+now = datetime.datetime(2020, 1, 1, 12)
+
+
+def test_next_check_bounds():
+    rng = random.Random(0)
+    hints = FeedHints()
+    low = 1 - appconfig.POLL_JITTER
+    high = 1 + appconfig.POLL_JITTER
+
+    # A feed that publishes every minute is still only polled so often.
+    interval = next_check(now, datetime.timedelta(minutes=1), None, hints, rng) - now
+    assert low <= interval / appconfig.POLL_MIN_INTERVAL <= high
+
+    # A feed with no dated posts is polled rarely.
+    interval = next_check(now, None, None, hints, rng) - now
+    assert low <= interval / appconfig.POLL_MAX_INTERVAL <= high
+
+    # The feed's ttl and the server's caching headers are both lower bounds.
+    posting = datetime.timedelta(hours=1)
+    for ttl, http, expected in [
+        (120, None, datetime.timedelta(hours=2)),
+        (None, datetime.timedelta(hours=3), datetime.timedelta(hours=3)),
+        (30, datetime.timedelta(minutes=20), posting),
+    ]:
+        hints = FeedHints(ttl=ttl)
+        interval = next_check(now, posting, http, hints, rng) - now
+        assert low <= interval / expected <= high
+
+
+def test_reschedule(connection):
+    feed_id = connection.execute(
+        models.feed.insert(), url="http://feed.example", properties={"keep": 1}
+    ).inserted_primary_key[0]
+    page_id = connection.execute(
+        models.page.insert(), feed_id=feed_id, idx=0, url="http://feed.example"
+    ).inserted_primary_key[0]
+    connection.execute(
+        models.post.insert().values(feed_id=feed_id, page_id=page_id),
+        [
+            {"guid": str(hour), "published": now - datetime.timedelta(hours=hour)}
+            for hour in (0, 2, 4, 6)
+        ],
+    )
+
+    hints = FeedHints(skip_days=frozenset({now.weekday()}))
+    when = reschedule(feed_id, connection, {"cache-control": "max-age=60"}, hints, now)
+    assert when == datetime.datetime(2020, 1, 2)
+
+    feed = connection.execute(
+        select([models.feed]).where(models.feed.c.id == feed_id)
+    ).first()
+    assert feed[models.feed.c.next_check] == when
+    assert feed[models.feed.c.properties] == {
+        "keep": 1,
+        "schedule": {
+            "posting_interval": 2 * 60 * 60,
+            "http_interval": 60,
+            "ttl": None,
+            "skip_hours": [],
+            "skip_days": [now.weekday()],
+            "websub_lease": None,
+        },
+    }
+
+
+def test_reschedule_dormant(connection):
+    """
+    A feed which used to publish every couple of hours, but hasn't for a
+    month, shouldn't keep being polled every couple of hours.
+    """
+
+    feed_id = connection.execute(
+        models.feed.insert(), url="http://feed.example"
+    ).inserted_primary_key[0]
+    page_id = connection.execute(
+        models.page.insert(), feed_id=feed_id, idx=0, url="http://feed.example"
+    ).inserted_primary_key[0]
+    newest = now - datetime.timedelta(days=30)
+    connection.execute(
+        models.post.insert().values(feed_id=feed_id, page_id=page_id),
+        [
+            {"guid": str(hour), "published": newest - datetime.timedelta(hours=hour)}
+            for hour in (0, 2, 4, 6)
+        ],
+    )
+
+    when = reschedule(feed_id, connection, {}, FeedHints(), now)
+    assert when - now >= appconfig.POLL_MAX_INTERVAL * (1 - appconfig.POLL_JITTER)
+    properties = connection.execute(
+        select([models.feed.c.properties]).where(models.feed.c.id == feed_id)
+    ).scalar()
+    assert properties["schedule"]["posting_interval"] == 30 * 24 * 60 * 60
+
+
+def test_backoff(connection):
+    feed_id = connection.execute(
+        models.feed.insert(), url="http://feed.example"
+    ).inserted_primary_key[0]
+    low = 1 - appconfig.POLL_JITTER
+    high = 1 + appconfig.POLL_JITTER
+
+    def get_feed():
+        return connection.execute(
+            select([models.feed.c.next_check, models.feed.c.properties]).where(
+                models.feed.c.id == feed_id
+            )
+        ).first()
+
+    # Each failure doubles the wait.
+    for failures in (1, 2, 3):
+        when = backoff(feed_id, connection, FetchError("http://feed.example", "x"), now)
+        expected = appconfig.POLL_MIN_INTERVAL * 2 ** (failures - 1)
+        assert low <= (when - now) / expected <= high
+        next_check, properties = get_feed()
+        assert next_check == when
+        assert properties["failure"]["count"] == failures
+
+    # Unless the server asks for longer.
+    error = FetchError("http://feed.example", "x", 429, {"retry-after": "86400"})
+    when = backoff(feed_id, connection, error, now)
+    assert low <= (when - now) / datetime.timedelta(days=1) <= high
+
+    # A successful crawl forgets about the failures.
+    reschedule(feed_id, connection, {}, FeedHints(), now)
+    assert "failure" not in get_feed()[1]
@@ -0,0 +1,574 @@
+import asyncio
+import datetime
+import httpx
+from itertools import product
+import json
+import pytest
+from sqlalchemy.sql import select
+from . import appconfig, models, server
+from .crawl import refresh_feed
+from .feeds import FetchError
+from .test_websub import mock_feed, StandInHub, subscribe
+
+
+def request(method, path, **kwargs):
+    async def send():
+        async with httpx.AsyncClient(
+            app=server.app, base_url="http://app.test"
+        ) as client:
+            return await client.request(method, path, **kwargs)
+
+    return asyncio.run(send())
+
+
+def get(path, **kwargs):
+    return request("GET", path, **kwargs)
+
+
+def atom(*entries):
+    return (
+        '<feed xmlns="http://www.w3.org/2005/Atom">'
+        + "".join(
+            f"<entry><id>urn:example:{n}</id>"
+            + ("" if published is None else f"<published>{published}</published>")
+            + "</entry>"
+            for n, published in entries
+        )
+        + "</feed>"
+    )
+
+
+def add_feed(engine, httpx_mock, *entries, url="http://feed.example"):
+    httpx_mock.add_response(url=url, data=atom(*entries))
+    with engine.begin() as connection:
+        feed_id = connection.execute(
+            models.feed.insert(), url=url
+        ).inserted_primary_key[0]
+        refresh_feed(feed_id, connection, datetime.timedelta(0))
+    return feed_id
+
+
+def recrawl(engine, httpx_mock, feed_id, *entries, url="http://feed.example"):
+    httpx_mock.add_response(url=url, data=atom(*entries))
+    with engine.begin() as connection:
+        refresh_feed(feed_id, connection, datetime.timedelta(0))
+
+
+def ids(response):
+    assert response.status_code == 200
+    return [post["id"] for post in response.json()["posts"]]
+
+
+def test_page_cache():
+    cache = server.PageCache(2)
+    cache.put("a", b"1")
+    cache.put("b", b"2")
+    assert cache.get("a") == b"1"
+    cache.put("c", b"3")
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1"
+
+    assert b"".join(cache.saving("d", [b"4", b"5"], lambda: False)) == b"45"
+    assert cache.get("d") is None
+    assert b"".join(cache.saving("d", [b"4", b"5"])) == b"45"
+    assert cache.get("d") == b"45"
+
+    disabled = server.PageCache(0)
+    disabled.put("a", b"1")
+    assert disabled.get("a") is None
+
+
+def test_posts_etag(httpx_mock, engine):
+    feed_id = add_feed(engine, httpx_mock, (1, "2020-01-01T00:00:00Z"))
+
+    response = get(f"/posts/{feed_id}")
+    assert ids(response) == ["urn:example:1"]
+    etag = response.headers["ETag"]
+    assert etag == 'W/"1"'
+
+    response = get(f"/posts/{feed_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert response.content == b""
+
+    # A crawl which changes nothing keeps the same ETag; one which changes the
+    # posts doesn't.
+    recrawl(engine, httpx_mock, feed_id, (1, "2020-01-01T00:00:00Z"))
+    response = get(f"/posts/{feed_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    recrawl(engine, httpx_mock, feed_id, (2, "2020-01-02T00:00:00Z"))
+    response = get(f"/posts/{feed_id}", headers={"If-None-Match": etag})
+    assert ids(response) == ["urn:example:2"]
+    assert response.headers["ETag"] == 'W/"2"'
+
+
+def test_posts_page_cache(monkeypatch, httpx_mock, engine):
+    monkeypatch.setattr(server, "page_cache", server.PageCache(10))
+    feed_id = add_feed(engine, httpx_mock, (1, "2020-01-01T00:00:00Z"))
+
+    first = get(f"/posts/{feed_id}")
+    assert ids(first) == ["urn:example:1"]
+
+    loads = []
+
+    def load_entries(page, sources, posts, deadline):
+        loads.append(page[models.page.c.url])
+        return {}
+
+    monkeypatch.setattr(server, "load_entries", load_entries)
+    second = get(f"/posts/{feed_id}")
+    assert second.content == first.content
+    assert second.headers["ETag"] == first.headers["ETag"]
+    assert loads == []
+
+    # The next generation isn't in the cache yet, and a response with missing
+    # posts isn't saved in it.
+    recrawl(engine, httpx_mock, feed_id, (2, "2020-01-02T00:00:00Z"))
+    for expected in (1, 2):
+        response = get(f"/posts/{feed_id}")
+        assert response.json()["posts"] == [{"id": "urn:example:2", "missing": True}]
+        assert len(loads) == expected
+
+
+def test_posts_limit(httpx_mock, engine):
+    feed_id = add_feed(
+        engine,
+        httpx_mock,
+        (1, "2020-01-01T00:00:00Z"),
+        (2, "2020-01-02T00:00:00Z"),
+        (3, "2020-01-03T00:00:00Z"),
+    )
+
+    for limit in ("x", "0", "-1", str(server.MAX_LIMIT + 1)):
+        assert get(f"/posts/{feed_id}?limit={limit}").status_code == 404
+
+    response = get(f"/posts/{feed_id}?limit=2")
+    assert ids(response) == ["urn:example:3", "urn:example:2"]
+    next_url = response.json()["links"]["next"]
+    assert next_url == (
+        f"http://app.test/posts/{feed_id}?page=1&order=-published&limit=2"
+    )
+
+    response = get(next_url)
+    assert ids(response) == ["urn:example:1"]
+    assert get(response.json()["links"]["next"]).status_code == 404
+
+    response = get(f"/posts/{feed_id}?limit={server.MAX_LIMIT}&order=published")
+    assert ids(response) == ["urn:example:1", "urn:example:2", "urn:example:3"]
+
+
+def test_keyset_ranges(connection):
+    """
+    Whichever way the database sorts NULLs, reading the ranges keyset_ranges
+    returns one after another gives exactly the rows sort_key puts after the
+    cursor, in the same order.
+    """
+
+    feed_id = connection.execute(
+        models.feed.insert(), url="http://feed.example"
+    ).inserted_primary_key[0]
+    page_id = connection.execute(
+        models.page.insert(), feed_id=feed_id, idx=0, url="http://feed.example"
+    ).inserted_primary_key[0]
+    connection.execute(
+        models.post.insert().values(feed_id=feed_id, page_id=page_id),
+        [
+            {"guid": f"urn:example:{n}", "season": season, "episode": episode}
+            for n, (season, episode) in enumerate(
+                product([None, 1, 2], [None, 1, 2, 2])
+            )
+        ],
+    )
+
+    columns = (models.post.c.season, models.post.c.episode, models.post.c.id)
+    rows = connection.execute(select(columns)).fetchall()
+    for descending, nulls_high in product([False, True], repeat=2):
+        ordered = sorted(
+            rows,
+            key=lambda row: server.sort_key(row, nulls_high),
+            reverse=descending,
+        )
+        for idx, cursor in enumerate(ordered):
+            matched = []
+            for condition in server.keyset_ranges(
+                columns, list(cursor), descending, nulls_high
+            ):
+                matched.extend(
+                    sorted(
+                        connection.execute(select(columns).where(condition)),
+                        key=lambda row: server.sort_key(row, nulls_high),
+                        reverse=descending,
+                    )
+                )
+            assert matched == ordered[idx + 1 :]
+
+
+def test_river_paging(httpx_mock, engine):
+    feed_a = add_feed(
+        engine,
+        httpx_mock,
+        (1, "2020-01-01T00:00:00Z"),
+        (2, None),
+        (3, "2020-01-03T00:00:00Z"),
+        url="http://a.example",
+    )
+    feed_b = add_feed(
+        engine,
+        httpx_mock,
+        (4, "2020-01-02T00:00:00Z"),
+        (5, None),
+        (6, "2020-01-04T00:00:00Z"),
+        url="http://b.example",
+    )
+
+    # SQLite sorts NULLs first, and ties fall back to the post's ID.
+    for order, expected in [
+        ("published", [2, 5, 1, 4, 3, 6]),
+        ("-published", [6, 3, 4, 1, 5, 2]),
+    ]:
+        seen = []
+        url = f"/posts?feed={feed_b}&feed={feed_a}&order={order}&limit=4"
+        while True:
+            response = get(url)
+            if response.status_code == 404:
+                break
+            seen += ids(response)
+            url = response.json()["links"]["next"]
+        assert seen == [f"urn:example:{n}" for n in expected]
+
+    assert get(f"/posts?feed={feed_a}&feed=9999").status_code == 404
+    assert get(f"/posts?feed={feed_a}&after=9999").status_code == 404
+    assert get("/posts").status_code == 404
+
+
+def test_posts_rank_order(httpx_mock, engine):
+    httpx_mock.add_response(
+        url="http://feed.example",
+        data='<feed xmlns="http://www.w3.org/2005/Atom"'
+        ' xmlns:r="http://purl.org/atompub/rank/1.0">'
+        '<entry><id>urn:example:1</id><r:rank scheme="urn:s">3</r:rank>'
+        '<r:rank scheme="urn:s" domain="urn:d">1</r:rank></entry>'
+        '<entry><id>urn:example:2</id><r:rank scheme="urn:s">1</r:rank></entry>'
+        "<entry><id>urn:example:3</id></entry>"
+        '<entry><id>urn:example:4</id><r:rank scheme="urn:s">2</r:rank></entry>'
+        "</feed>",
+    )
+    with engine.begin() as connection:
+        feed_id = connection.execute(
+            models.feed.insert(), url="http://feed.example"
+        ).inserted_primary_key[0]
+        refresh_feed(feed_id, connection, datetime.timedelta(0))
+
+    # Only posts with a rank in the chosen scheme and domain are listed.
+    response = get(f"/posts/{feed_id}?order=rank&scheme=urn:s&limit=2")
+    assert ids(response) == ["urn:example:2", "urn:example:4"]
+    next_url = response.json()["links"]["next"]
+    assert "scheme=urn%3As" in next_url and "domain" not in next_url
+    assert ids(get(next_url)) == ["urn:example:1"]
+
+    response = get(f"/posts/{feed_id}?order=-rank&scheme=urn:s")
+    assert ids(response) == ["urn:example:1", "urn:example:4", "urn:example:2"]
+
+    response = get(f"/posts/{feed_id}?order=rank&scheme=urn:s&domain=urn:d")
+    assert ids(response) == ["urn:example:1"]
+    assert "domain=urn%3Ad" in response.json()["links"]["next"]
+
+    for query in ("scheme=urn:other", "scheme=urn:s&domain=urn:other", "scheme="):
+        assert get(f"/posts/{feed_id}?order=rank&{query}").status_code == 404
+    assert get(f"/posts/{feed_id}?order=ranked").status_code == 404
+
+
+def test_posts_seek_at(httpx_mock, engine):
+    feed_id = add_feed(
+        engine,
+        httpx_mock,
+        (1, "2020-01-01T00:00:00Z"),
+        (2, "2020-01-02T00:00:00Z"),
+        (3, "2020-01-03T00:00:00Z"),
+    )
+
+    # Dates without a time zone are UTC; others are converted to UTC.
+    for at in (
+        "2020-01-02T00:00:00",
+        "2020-01-02T00:00:00Z",
+        "2020-01-02T00:00:00%2B00:00",
+        "2020-01-01T19:00:00-05:00",
+    ):
+        response = get(f"/posts/{feed_id}?order=published&at={at}")
+        assert ids(response) == ["urn:example:2", "urn:example:3"]
+        assert "offset=26" in response.json()["links"]["next"]
+
+        response = get(f"/posts/{feed_id}?order=-published&at={at}")
+        assert ids(response) == ["urn:example:2", "urn:example:1"]
+
+    assert get(f"/posts/{feed_id}?order=published&at=soon").status_code == 404
+    assert get(f"/posts/{feed_id}?order=rank&at=2020-01-02").status_code == 404
+
+
+def test_read_replica(monkeypatch, httpx_mock, engine, tmp_path):
+    replica = appconfig._create_engine(f"sqlite:///{tmp_path / 'replica.sqlite'}")
+    appconfig.metadata.create_all(replica)
+    monkeypatch.setattr(appconfig, "DATABASE_READ_URL", "sqlite:///replica")
+    monkeypatch.setattr(appconfig, "_read_engine", replica)
+
+    # Crawls go to the primary, and say which generation they produced.
+    httpx_mock.add_response(url="http://feed.example", data=atom((1, None)))
+    response = get("/crawl/http://feed.example", allow_redirects=False)
+    assert response.status_code == 307
+    with engine.begin() as connection:
+        feed_id, url = connection.execute(
+            select([models.feed.c.id, models.feed.c.url])
+        ).first()
+    assert response.headers["location"] == (
+        f"http://app.test/posts/{feed_id}?generation=1"
+    )
+
+    # The replica hasn't seen the feed at all yet.
+    assert server.read_engine(feed_id, None) is replica
+    assert server.read_engine(feed_id, 1) is engine
+
+    with replica.begin() as connection:
+        connection.execute(models.feed.insert(), id=feed_id, url=url, generation=0)
+    assert server.read_engine(feed_id, 1) is engine
+    assert server.read_engine(feed_id, 0) is replica
+
+    # Only the primary has the posts, so that's where these were read from.
+    assert ids(get(response.headers["location"])) == ["urn:example:1"]
+    assert get(f"/posts/{feed_id}").status_code == 404
+
+    with replica.begin() as connection:
+        connection.execute(
+            models.feed.update().where(models.feed.c.id == feed_id), generation=2
+        )
+    assert server.read_engine(feed_id, 1) is replica
+
+    # Without READ_YOUR_WRITES, readers always use the replica.
+    monkeypatch.setattr(appconfig, "READ_YOUR_WRITES", False)
+    response = get("/crawl/http://feed.example", allow_redirects=False)
+    assert response.headers["location"] == f"http://app.test/posts/{feed_id}"
+
+
+def test_render_posts_failures():
+    posts = [
+        {models.post.c.page_id: page_id, models.post.c.guid: guid}
+        for page_id, guid in [(1, "a"), (2, "b"), (3, "c"), (1, "d")]
+    ]
+    failures = {
+        2: FetchError("http://feed.example/2", "HTTP 503", 503),
+        3: TimeoutError("no attempt finished before the deadline"),
+    }
+
+    def load_page(page_id):
+        if page_id in failures:
+            raise failures[page_id]
+        return {"a": {"id": "a"}}
+
+    missing = []
+    rendered = b"".join(server.render_posts(posts, load_page, missing))
+    assert json.loads(rendered) == [
+        {"id": "a"},
+        {"id": "b", "missing": True},
+        {"id": "c", "missing": True},
+        {"id": "d", "missing": True},
+    ]
+    assert missing == ["b", "c", "d"]
+
+    # Anything else is a bug, which shouldn't be mistaken for a slow fetch.
+    failures[2] = KeyError("oops")
+    with pytest.raises(KeyError):
+        b"".join(server.render_posts(posts, load_page, []))
+
+
+def test_websub_callback(monkeypatch, httpx_mock, engine):
+    monkeypatch.setattr(appconfig, "WEBSUB_CALLBACK_URL", "http://us.example/")
+    hub = StandInHub(httpx_mock)
+    mock_feed(httpx_mock)
+    with engine.begin() as connection:
+        feed_id = connection.execute(
+            models.feed.insert(), url="http://feed.example"
+        ).inserted_primary_key[0]
+        refresh_feed(feed_id, connection, datetime.timedelta(0))
+        subscribe(connection, feed_id, datetime.datetime.utcnow())
+
+    # We asked to subscribe, not to unsubscribe.
+    params = hub.params(feed_id, "unsubscribe")
+    assert get(f"/websub/{feed_id}", params=params).status_code == 404
+
+    response = get(f"/websub/{feed_id}", params=hub.params(feed_id))
+    assert response.status_code == 200
+    assert response.text == "challenge"
+
+    def crawls():
+        return httpx_mock.get_requests(url="http://feed.example")
+
+    # Notifications are acknowledged whether or not they're signed, but only
+    # signed ones start a crawl, which asks caches to check with the origin.
+    body = b"<feed/>"
+    crawled = len(crawls())
+    response = request("POST", f"/websub/{feed_id}", data=body)
+    assert response.status_code == 202
+    response = request(
+        "POST",
+        f"/websub/{feed_id}",
+        data=body,
+        headers={"X-Hub-Signature": hub.sign(b"<forged/>")},
+    )
+    assert response.status_code == 202
+    assert len(crawls()) == crawled
+
+    response = request(
+        "POST",
+        f"/websub/{feed_id}",
+        data=body,
+        headers={"X-Hub-Signature": hub.sign(body)},
+    )
+    assert response.status_code == 202
+    assert len(crawls()) == crawled + 1
+    assert crawls()[-1].headers["Cache-Control"] == "no-cache"
+
+
+def test_changes(httpx_mock, engine):
+    feed_id = add_feed(engine, httpx_mock, (1, None), (2, None))
+    other_id = add_feed(engine, httpx_mock, (3, None), url="http://other.example")
+    recrawl(engine, httpx_mock, feed_id, (2, None))
+
+    def changes(response):
+        assert response.status_code == 200
+        return [
+            (change["feed_id"], change["id"], change["action"])
+            for change in response.json()["changes"]
+        ]
+
+    response = get("/changes")
+    everything = response.json()["changes"]
+    assert [change["seq"] for change in everything] == sorted(
+        change["seq"] for change in everything
+    )
+    assert sorted(changes(response)[:2]) == [
+        (feed_id, "urn:example:1", "insert"),
+        (feed_id, "urn:example:2", "insert"),
+    ]
+    assert changes(response)[2:] == [
+        (other_id, "urn:example:3", "insert"),
+        (feed_id, "urn:example:1", "delete"),
+    ]
+
+    # Following the next links visits every change once, and the last one
+    # waits for changes after the end.
+    seen = []
+    next_url = "/changes?limit=3"
+    while True:
+        response = get(next_url)
+        if not response.json()["changes"]:
+            break
+        seen.extend(response.json()["changes"])
+        next_url = response.json()["links"]["next"]
+    assert seen == everything
+    assert next_url == (
+        "http://app.test/changes?after={}&limit=3".format(everything[-1]["seq"])
+    )
+
+    response = get(f"/changes/{feed_id}?after={everything[0]['seq']}&limit=1")
+    assert changes(response) == [changes(get("/changes"))[1]]
+    response = get(response.json()["links"]["next"])
+    assert changes(response) == [(feed_id, "urn:example:1", "delete")]
+    assert response.json()["links"]["next"] == (
+        f"http://app.test/changes/{feed_id}?after="
+        + "{}&limit=1".format(everything[-1]["seq"])
+    )
+
+    assert get(f"/changes/{other_id + 1}").status_code == 404
+    assert get("/changes?after=x").status_code == 404
+    assert get("/changes?limit=0").status_code == 404
+
+
+@pytest.mark.parametrize("staged", [False, True])
+def test_changes_page_moved(monkeypatch, httpx_mock, engine, staged):
+    """
+    A post that moves to another archive page is listed at a new URL, so the
+    move is logged as an update. Inserts and updates carry the post's current
+    fields; deletes only its GUID.
+    """
+
+    monkeypatch.setattr(appconfig, "STAGED_DIFF", staged)
+    entry = (
+        "<entry><id>urn:example:1</id>"
+        "<published>2020-01-01T00:00:00Z</published>"
+        '<r:rank scheme="urn:s">2</r:rank></entry>'
+    )
+    feed = (
+        '<feed xmlns="http://www.w3.org/2005/Atom"'
+        ' xmlns:r="http://purl.org/atompub/rank/1.0">{}</feed>'
+    )
+    httpx_mock.add_response(url="http://feed.example", data=feed.format(entry))
+    with engine.begin() as connection:
+        feed_id = connection.execute(
+            models.feed.insert(), url="http://feed.example"
+        ).inserted_primary_key[0]
+        refresh_feed(feed_id, connection, datetime.timedelta(0))
+
+    httpx_mock.add_response(
+        url="http://feed.example",
+        data=feed.format(
+            '<link rel="prev-archive" href="http://feed.example/1"/>'
+            "<entry><id>urn:example:2</id></entry>"
+        ),
+    )
+    httpx_mock.add_response(url="http://feed.example/1", data=feed.format(entry))
+    with engine.begin() as connection:
+        refresh_feed(feed_id, connection, datetime.timedelta(0))
+
+    httpx_mock.add_response(
+        url="http://feed.example",
+        data=feed.format('<link rel="prev-archive" href="http://feed.example/1"/>'),
+    )
+    with engine.begin() as connection:
+        refresh_feed(feed_id, connection, datetime.timedelta(0))
+
+    response = get(f"/changes/{feed_id}")
+    assert response.status_code == 200
+    changes = [
+        {key: value for key, value in change.items() if key not in ("seq", "feed_id")}
+        for change in response.json()["changes"]
+    ]
+    fields = {
+        "page_url": "http://feed.example/1",
+        "published": "2020-01-01T00:00:00",
+        "updated": "2020-01-01T00:00:00",
+        "season": None,
+        "episode": None,
+        "ranks": [{"scheme": "urn:s", "rank": 2.0}],
+    }
+    assert changes[0] == {"id": "urn:example:1", "action": "insert", **fields}
+    # The last crawl deleted the second crawl's new post, so only its GUID is
+    # left to report.
+    assert sorted(changes[1:3], key=lambda change: change["id"]) == [
+        {"id": "urn:example:1", "action": "update", **fields},
+        {"id": "urn:example:2", "action": "insert"},
+    ]
+    assert changes[3:] == [{"id": "urn:example:2", "action": "delete"}]
+
+
+def test_export(httpx_mock, engine):
+    feed_id = add_feed(engine, httpx_mock, (1, None), (2, None))
+    add_feed(engine, httpx_mock, (3, None), url="http://other.example")
+
+    response = get(f"/export?feed={feed_id}&format=csv")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "text/csv; charset=utf-8"
+    assert response.text.splitlines() == [
+        "feed_id,guid,page_url,published,updated,season,episode",
+        f"{feed_id},urn:example:1,http://feed.example,,,,",
+        f"{feed_id},urn:example:2,http://feed.example,,,,",
+    ]
+
+    response = get("/export")
+    assert [json.loads(line)["guid"] for line in response.text.splitlines()] == [
+        "urn:example:1",
+        "urn:example:2",
+        "urn:example:3",
+    ]
+
+    assert get("/export?format=xml").status_code == 404
+    assert get("/export?feed=x").status_code == 404
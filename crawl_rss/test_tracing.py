@@ -0,0 +1,148 @@
+import contextlib
+import datetime
+import json
+import pytest
+import sqlalchemy
+from . import appconfig, models, tracing
+from .crawl import refresh_feed
+
+
+class StandInSpan:
+    def __init__(self, name, attributes, parent):
+        self.name = name
+        self.attributes = dict(attributes or {})
+        self.parent = parent
+        self.ended = False
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def end(self):
+        self.ended = True
+
+
+class StandInTracer:
+    "Records spans the way OpenTelemetry's tracer would nest them."
+
+    def __init__(self):
+        self.spans = []
+        self.stack = []
+
+    def start_span(self, name, attributes=None):
+        span = StandInSpan(name, attributes, self.stack[-1] if self.stack else None)
+        self.spans.append(span)
+        return span
+
+    @contextlib.contextmanager
+    def start_as_current_span(self, name, attributes=None):
+        span = self.start_span(name, attributes)
+        self.stack.append(span)
+        try:
+            yield span
+        finally:
+            self.stack.pop()
+            span.end()
+
+    def tree(self, parent=None):
+        return [
+            (span.name, self.tree(span))
+            for span in self.spans
+            if span.parent is parent and not span.name.isupper()
+        ]
+
+
+@pytest.fixture
+def tracer(monkeypatch):
+    tracer = StandInTracer()
+    monkeypatch.setattr(tracing, "_tracer", tracer)
+    monkeypatch.setattr(tracing, "_tracer_created", True)
+    return tracer
+
+
+def test_span_off(monkeypatch):
+    monkeypatch.setattr(tracing, "_tracer", None)
+    monkeypatch.setattr(tracing, "_tracer_created", True)
+    with tracing.span("crawl", feed_id=1) as span:
+        assert span is None
+
+
+def test_statement_spans(tracer):
+    engine = sqlalchemy.create_engine("sqlite://")
+    tracing.instrument(engine)
+
+    with tracing.span("outer", skipped=None) as outer:
+        engine.execute("SELECT 1")
+
+    assert outer.attributes == {}
+    statement = tracer.spans[1]
+    assert statement.name == "SELECT"
+    assert statement.parent is outer
+    assert statement.attributes["db.statement"] == "SELECT 1"
+    assert statement.attributes["db.system"] == "sqlite"
+    assert statement.ended
+
+
+def test_crawl_spans(httpx_mock, connection, tracer):
+    feed_id = connection.execute(
+        models.feed.insert(), url="http://feed.example"
+    ).inserted_primary_key[0]
+    httpx_mock.add_response(
+        url="http://feed.example",
+        data='<feed xmlns="http://www.w3.org/2005/Atom">'
+        "<entry><id>urn:example:1</id></entry>"
+        "</feed>",
+    )
+
+    refresh_feed(feed_id, connection, datetime.timedelta(0))
+
+    assert tracer.tree() == [
+        (
+            "crawl",
+            [
+                ("fetch", []),
+                ("parse", []),
+                (
+                    "apply",
+                    [
+                        ("add_pages", []),
+                        ("apply_posts", []),
+                        ("apply_ranks", []),
+                        ("summarize_pages", []),
+                        ("renumber_pages", []),
+                    ],
+                ),
+            ],
+        )
+    ]
+    fetch = tracer.spans[1]
+    assert fetch.attributes["http.url"] == "http://feed.example"
+    assert fetch.attributes["http.status_code"] == 200
+    assert all(span.ended for span in tracer.spans)
+
+
+def test_file_exporter(monkeypatch, tmp_path):
+    pytest.importorskip("opentelemetry.sdk")
+    trace_file = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(appconfig, "TRACE_FILE", str(trace_file))
+    tracer = tracing._create_tracer("file")
+    monkeypatch.setattr(tracing, "_tracer", tracer)
+    monkeypatch.setattr(tracing, "_tracer_created", True)
+
+    engine = sqlalchemy.create_engine("sqlite://")
+    tracing.instrument(engine)
+    with tracing.span("crawl", feed_id=1):
+        engine.execute("SELECT 1")
+    tracer.span_processor.force_flush()
+
+    statement, crawl = [
+        json.loads(line) for line in trace_file.read_text().splitlines()
+    ]
+    assert crawl["name"] == "crawl"
+    assert crawl["attributes"] == {"feed_id": 1}
+    assert crawl["resource"]["attributes"]["service.name"] == "crawl-rss"
+    assert statement["name"] == "SELECT"
+    assert statement["attributes"]["db.statement"] == "SELECT 1"
+    assert statement["parent_id"] == crawl["context"]["span_id"]
+
+    with pytest.raises(ValueError):
+        tracing._create_tracer("carrier-pigeon")
@@ -0,0 +1,218 @@
+import datetime
+import hashlib
+import hmac
+import pytest
+from sqlalchemy.sql import select
+from pytest_httpx import to_response
+from urllib.parse import parse_qsl
+from . import appconfig, models, websub
+from .crawl import refresh_feed
+
+
+@pytest.fixture
+def feed_id(connection):
+    result = connection.execute(
+        models.feed.insert(),
+        url="http://feed.example",
+    )
+    return result.inserted_primary_key[0]
+
+
+@pytest.fixture(autouse=True)
+def callback_url(monkeypatch):
+    monkeypatch.setattr(appconfig, "WEBSUB_CALLBACK_URL", "http://us.example/")
+
+
+def mock_feed(httpx_mock, hub="http://hub.example/subscribe"):
+    links = "" if hub is None else f'<link rel="hub" href="{hub}"/>'
+    httpx_mock.add_response(
+        url="http://feed.example",
+        data='<feed xmlns="http://www.w3.org/2005/Atom">'
+        f'{links}<link rel="self" href="http://feed.example/topic"/>'
+        "<entry><id>urn:example:1</id></entry>"
+        "</feed>",
+    )
+
+
+class StandInHub:
+    "Records subscription requests the way a WebSub hub would receive them."
+
+    def __init__(self, httpx_mock):
+        self.requests = []
+        httpx_mock.add_callback(self.receive, url="http://hub.example/subscribe")
+
+    def receive(self, request, *args, **kwargs):
+        self.requests.append(dict(parse_qsl(request.read().decode())))
+        return to_response(status_code=202)
+
+    def params(self, feed_id, mode="subscribe"):
+        "What the hub sends to our callback to verify the last request."
+
+        request = self.requests[-1]
+        assert request["hub.callback"] == f"http://us.example/websub/{feed_id}"
+        return {
+            "hub.mode": mode,
+            "hub.topic": request["hub.topic"],
+            "hub.challenge": "challenge",
+            "hub.lease_seconds": request["hub.lease_seconds"],
+        }
+
+    def verify(self, connection, feed_id, now, mode="subscribe"):
+        return websub.verify(feed_id, connection, self.params(feed_id, mode), now)
+
+    def sign(self, body, method="sha256"):
+        secret = self.requests[-1]["hub.secret"].encode()
+        digest = hmac.new(secret, body, getattr(hashlib, method)).hexdigest()
+        return f"{method}={digest}"
+
+
+def subscribe(connection, feed_id, now):
+    request = websub.pending_request(feed_id, connection, now)
+    assert request is not None
+    websub.requesting(feed_id, connection, request, now)
+    assert websub.send(request)
+
+
+def get_next_check(connection, feed_id):
+    return connection.execute(
+        select([models.feed.c.next_check]).where(models.feed.c.id == feed_id)
+    ).scalar()
+
+
+def test_subscribe(httpx_mock, connection, feed_id):
+    hub = StandInHub(httpx_mock)
+    mock_feed(httpx_mock)
+    now = datetime.datetime.utcnow()
+
+    refresh_feed(feed_id, connection, datetime.timedelta(0))
+    polled = get_next_check(connection, feed_id)
+    subscribe(connection, feed_id, now)
+    assert hub.requests[-1]["hub.topic"] == "http://feed.example/topic"
+
+    # Nothing more to ask for until the hub answers or the request is stale.
+    assert websub.pending_request(feed_id, connection, now) is None
+
+    assert hub.verify(connection, feed_id, now) == "challenge"
+    lease = datetime.timedelta(seconds=appconfig.WEBSUB_LEASE_SECONDS)
+
+    # Once subscribed, the feed is only polled again near the lease's end.
+    mock_feed(httpx_mock)
+    refresh_feed(feed_id, connection, datetime.timedelta(0))
+    assert get_next_check(connection, feed_id) > polled
+    assert get_next_check(connection, feed_id) >= now + lease - websub.LEASE_MARGIN
+    assert websub.pending_request(feed_id, connection, now) is None
+
+    body = b"<feed/>"
+    assert websub.authentic(feed_id, connection, body, hub.sign(body))
+    assert websub.authentic(feed_id, connection, body, hub.sign(body, "sha1"))
+    assert not websub.authentic(feed_id, connection, b"<forged/>", hub.sign(body))
+    assert not websub.authentic(feed_id, connection, body, None)
+
+
+def test_renew(httpx_mock, connection, feed_id):
+    hub = StandInHub(httpx_mock)
+    mock_feed(httpx_mock)
+    lease = datetime.timedelta(seconds=appconfig.WEBSUB_LEASE_SECONDS)
+    start = datetime.datetime(2020, 1, 1)
+
+    websub.update(feed_id, connection, websub.FeedHints(), start)
+    refresh_feed(feed_id, connection, datetime.timedelta(0))
+    subscribe(connection, feed_id, start)
+    assert hub.verify(connection, feed_id, start) == "challenge"
+
+    hints = websub.FeedHints(
+        hub="http://hub.example/subscribe", topic="http://feed.example/topic"
+    )
+    assert websub.update(feed_id, connection, hints, start) == start + lease
+    assert websub.pending_request(feed_id, connection, start) is None
+
+    # Near the end of the lease, ask for another with the same secret.
+    secret = hub.requests[-1]["hub.secret"]
+    late = start + lease - websub.LEASE_MARGIN
+    websub.update(feed_id, connection, hints, late)
+    subscribe(connection, feed_id, late)
+    assert len(hub.requests) == 2
+    assert hub.requests[-1]["hub.secret"] == secret
+
+
+def test_hub_changes(httpx_mock, connection, feed_id):
+    hub = StandInHub(httpx_mock)
+    mock_feed(httpx_mock)
+    now = datetime.datetime.utcnow()
+
+    refresh_feed(feed_id, connection, datetime.timedelta(0))
+    subscribe(connection, feed_id, now)
+    assert hub.verify(connection, feed_id, now) == "challenge"
+
+    # Hubs may check that we really meant to unsubscribe; we didn't.
+    assert hub.verify(connection, feed_id, now, "unsubscribe") is None
+
+    # When the feed stops naming a hub, forget the subscription and poll.
+    mock_feed(httpx_mock, hub=None)
+    refresh_feed(feed_id, connection, datetime.timedelta(0))
+    assert connection.execute(select([models.websub])).fetchall() == []
+    assert hub.verify(connection, feed_id, now, "unsubscribe") == "challenge"
+    assert hub.verify(connection, feed_id, now) is None
+    assert not websub.authentic(feed_id, connection, b"", hub.sign(b""))
+
+
+def test_denied(httpx_mock, connection, feed_id):
+    hub = StandInHub(httpx_mock)
+    mock_feed(httpx_mock)
+    now = datetime.datetime.utcnow()
+
+    refresh_feed(feed_id, connection, datetime.timedelta(0))
+    subscribe(connection, feed_id, now)
+    assert hub.verify(connection, feed_id, now, "denied") == ""
+    assert connection.execute(select([models.websub])).fetchall() == []
+
+
+def test_unsolicited_verification(httpx_mock, connection, feed_id):
+    hub = StandInHub(httpx_mock)
+    mock_feed(httpx_mock)
+    now = datetime.datetime.utcnow()
+
+    # We know about the hub, but haven't asked it for anything yet.
+    refresh_feed(feed_id, connection, datetime.timedelta(0))
+    params = {
+        "hub.mode": "subscribe",
+        "hub.topic": "http://feed.example/topic",
+        "hub.challenge": "challenge",
+        "hub.lease_seconds": "60",
+    }
+    assert websub.verify(feed_id, connection, params, now) is None
+
+    # Once the hub has verified what we asked for, it can't do so again.
+    subscribe(connection, feed_id, now)
+    assert hub.verify(connection, feed_id, now) == "challenge"
+    assert hub.verify(connection, feed_id, now) is None
+
+
+@pytest.mark.parametrize(
+    "lease_seconds, expected",
+    [
+        ("315360000", datetime.timedelta(seconds=appconfig.WEBSUB_LEASE_SECONDS)),
+        ("99999999999999", datetime.timedelta(seconds=appconfig.WEBSUB_LEASE_SECONDS)),
+        ("60", datetime.timedelta(seconds=60)),
+        ("-60", None),
+    ],
+)
+def test_verify_lease(httpx_mock, connection, feed_id, lease_seconds, expected):
+    hub = StandInHub(httpx_mock)
+    mock_feed(httpx_mock)
+    now = datetime.datetime(2020, 1, 1)
+
+    refresh_feed(feed_id, connection, datetime.timedelta(0))
+    subscribe(connection, feed_id, now)
+    params = dict(hub.params(feed_id), **{"hub.lease_seconds": lease_seconds})
+    challenge = websub.verify(feed_id, connection, params, now)
+
+    expires = connection.execute(
+        select([models.websub.c.expires]).where(models.websub.c.feed_id == feed_id)
+    ).scalar()
+    if expected is None:
+        assert challenge is None
+        assert expires is None
+    else:
+        assert challenge == "challenge"
+        assert expires == now + expected
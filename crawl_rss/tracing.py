@@ -0,0 +1,138 @@
+"""
+Optional OpenTelemetry tracing of crawls.
+
+With TRACE_EXPORTER set, each crawl becomes a trace, with spans for fetching
+and parsing each feed document, for each phase of applying the changes, and
+for every SQL statement. Without it, `span` costs next to nothing and
+opentelemetry doesn't need to be installed.
+"""
+
+import contextlib
+import sqlalchemy
+from sqlalchemy.engine import Connection, Engine
+import threading
+from typing import Any, Iterator, Optional
+from . import appconfig
+
+
+_lock = threading.Lock()
+_tracer: Any = None
+_tracer_created = False
+
+
+def get_tracer() -> Any:
+    "The tracer to record spans with, or None if tracing is off."
+
+    global _tracer, _tracer_created
+    if not _tracer_created:
+        with _lock:
+            if not _tracer_created:
+                _tracer = _create_tracer(appconfig.TRACE_EXPORTER)
+                _tracer_created = True
+    return _tracer
+
+
+def _create_tracer(exporter_name: Optional[str]) -> Any:
+    if exporter_name is None:
+        return None
+
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+
+    if exporter_name == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import (
+            OTLPSpanExporter,
+        )
+
+        exporter = OTLPSpanExporter()
+    elif exporter_name == "file":
+        exporter = ConsoleSpanExporter(
+            out=open(appconfig.TRACE_FILE, "a"),
+            formatter=lambda span: span.to_json(indent=None) + "\n",
+        )
+    else:
+        raise ValueError(f"unknown TRACE_EXPORTER {exporter_name!r}")
+
+    provider = TracerProvider(resource=Resource.create({"service.name": "crawl-rss"}))
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    return provider.get_tracer(__name__)
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Any]:
+    """
+    Trace the body as a span, nested in whichever span is current, with these
+    attributes, leaving out any which are None. Yields the span, so more
+    attributes can be set on it once they're known, or None if tracing is off.
+    """
+
+    tracer = get_tracer()
+    if tracer is None:
+        yield None
+        return
+
+    attributes = {key: value for key, value in attributes.items() if value is not None}
+    with tracer.start_as_current_span(name, attributes=attributes) as current:
+        yield current
+
+
+def instrument(engine: Engine) -> None:
+    "Trace every SQL statement this engine runs, if tracing is on."
+
+    if get_tracer() is None:
+        return
+    sqlalchemy.event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    sqlalchemy.event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    sqlalchemy.event.listen(engine, "handle_error", _handle_error)
+
+
+def _before_cursor_execute(
+    connection: Connection,
+    cursor: Any,
+    statement: str,
+    parameters: Any,
+    context: Any,
+    executemany: bool,
+) -> None:
+    # Name the span for its operation, such as SELECT, so similar statements
+    # group together.
+    operation = statement.split(None, 1)[0].upper() if statement else "SQL"
+    current = get_tracer().start_span(
+        operation,
+        attributes={
+            "db.system": connection.dialect.name,
+            "db.statement": statement,
+            "db.executemany": executemany,
+        },
+    )
+    connection.info.setdefault("trace_spans", []).append(current)
+
+
+def _after_cursor_execute(
+    connection: Connection,
+    cursor: Any,
+    statement: str,
+    parameters: Any,
+    context: Any,
+    executemany: bool,
+) -> None:
+    spans = connection.info.get("trace_spans")
+    if spans:
+        current = spans.pop()
+        if cursor.rowcount is not None and cursor.rowcount >= 0:
+            current.set_attribute("db.rowcount", cursor.rowcount)
+        current.end()
+
+
+def _handle_error(context: Any) -> None:
+    connection = context.connection
+    spans = connection.info.get("trace_spans") if connection is not None else None
+    if spans:
+        from opentelemetry.trace import Status, StatusCode
+
+        current = spans.pop()
+        current.record_exception(context.original_exception)
+        current.set_status(Status(StatusCode.ERROR))
+        current.end()
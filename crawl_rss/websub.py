@@ -0,0 +1,272 @@
+"""
+Push notifications from WebSub hubs (https://www.w3.org/TR/websub/).
+
+After each crawl, `update` makes the feed's row in the websub table match
+whichever hub its subscription document names, and `send_request` then asks
+that hub to subscribe us, outside the crawl's transaction, since a hub may
+call back to verify before it even answers. Once the hub has verified our
+intent, the feed is only polled when its lease is about to run out, and is
+crawled whenever the hub sends a notification with a valid signature.
+"""
+
+import datetime
+import hashlib
+import hmac
+import secrets
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql import or_, select
+from typing import Mapping, NamedTuple, Optional, Text
+from . import appconfig, models
+from .feeds import FeedHints
+from .schedule import LEASE_MARGIN
+
+
+SIGNATURE_METHODS = {
+    "sha1": hashlib.sha1,
+    "sha256": hashlib.sha256,
+    "sha384": hashlib.sha384,
+    "sha512": hashlib.sha512,
+}
+
+
+class SubscribeRequest(NamedTuple):
+    hub: Text
+    topic: Text
+    callback: Text
+    secret: Text
+
+
+def callback_url(feed_id: int) -> Text:
+    assert appconfig.WEBSUB_CALLBACK_URL is not None
+    return "{}/websub/{}".format(appconfig.WEBSUB_CALLBACK_URL.rstrip("/"), feed_id)
+
+
+def update(
+    feed_id: int,
+    connection: Connection,
+    hints: FeedHints,
+    now: Optional[datetime.datetime] = None,
+) -> Optional[datetime.datetime]:
+    """
+    Record the hub this feed currently advertises, if any, and note whether
+    we need to ask it for a subscription. Returns when the current lease
+    expires, if the hub has verified one; until shortly before then, the feed
+    doesn't need to be polled.
+    """
+
+    if now is None:
+        now = datetime.datetime.utcnow()
+
+    websub = models.websub
+    row = connection.execute(
+        select([websub]).where(websub.c.feed_id == feed_id)
+    ).first()
+
+    if (
+        hints.hub is None
+        or hints.topic is None
+        or appconfig.WEBSUB_CALLBACK_URL is None
+    ):
+        # Without a hub, or a way for it to reach us, fall back to polling.
+        if row is not None:
+            connection.execute(websub.delete().where(websub.c.feed_id == feed_id))
+        return None
+
+    if row is None or (row[websub.c.hub], row[websub.c.topic]) != (
+        hints.hub,
+        hints.topic,
+    ):
+        connection.execute(websub.delete().where(websub.c.feed_id == feed_id))
+        connection.execute(
+            websub.insert().values(
+                feed_id=feed_id,
+                hub=hints.hub,
+                topic=hints.topic,
+                secret=secrets.token_urlsafe(32),
+            )
+        )
+        return None
+
+    # Verifying a subscription clears `requested`, so `pending_request` asks
+    # again near the end of the lease. If a hub hasn't verified one within
+    # about as long of our asking, ask again too.
+    expires = row[websub.c.expires]
+    requested = row[websub.c.requested]
+    renew = expires is None or expires - now <= LEASE_MARGIN
+    if renew and requested is not None and now - requested >= LEASE_MARGIN:
+        connection.execute(
+            websub.update().where(websub.c.feed_id == feed_id).values(requested=None)
+        )
+
+    if expires is None or expires <= now:
+        return None
+    return expires
+
+
+def pending_request(
+    feed_id: int, connection: Connection, now: Optional[datetime.datetime] = None
+) -> Optional[SubscribeRequest]:
+    """
+    The subscription request this feed is waiting to send, if any: when we
+    haven't asked yet, or the last lease is about to end.
+    """
+
+    if now is None:
+        now = datetime.datetime.utcnow()
+
+    websub = models.websub
+    row = connection.execute(
+        select([websub.c.hub, websub.c.topic, websub.c.secret])
+        .where(websub.c.feed_id == feed_id)
+        .where(websub.c.requested.is_(None))
+        .where(or_(websub.c.expires.is_(None), websub.c.expires <= now + LEASE_MARGIN))
+    ).first()
+    if row is None:
+        return None
+    return SubscribeRequest(row[0], row[1], callback_url(feed_id), row[2])
+
+
+def send(request: SubscribeRequest) -> bool:
+    "Ask the hub for this subscription. Returns whether the hub accepted."
+
+    import httpx
+
+    try:
+        response = appconfig.get_http_client().post(
+            request.hub,
+            data={
+                "hub.mode": "subscribe",
+                "hub.topic": request.topic,
+                "hub.callback": request.callback,
+                "hub.secret": request.secret,
+                "hub.lease_seconds": str(appconfig.WEBSUB_LEASE_SECONDS),
+            },
+        )
+        response.raise_for_status()
+    except httpx.HTTPError:
+        return False
+    return True
+
+
+def requesting(
+    feed_id: int,
+    connection: Connection,
+    request: SubscribeRequest,
+    now: Optional[datetime.datetime] = None,
+) -> None:
+    """
+    Note that we're about to send this request, unless it's been superseded.
+    That's done first, since only a hub we've asked may verify a subscription,
+    and it may do that before it even answers the request.
+    """
+
+    if now is None:
+        now = datetime.datetime.utcnow()
+
+    connection.execute(
+        models.websub.update()
+        .where(models.websub.c.feed_id == feed_id)
+        .where(models.websub.c.secret == request.secret)
+        .values(requested=now)
+    )
+
+
+def send_request(feed_id: int) -> None:
+    """
+    Ask the hub to subscribe us to this feed, if we need to. If the hub
+    doesn't accept, we keep polling, and try again after the next crawl.
+    """
+
+    with appconfig.get_engine().begin() as connection:
+        request = pending_request(feed_id, connection)
+        if request is None:
+            return
+        requesting(feed_id, connection, request)
+    if not send(request):
+        with appconfig.get_engine().begin() as connection:
+            connection.execute(
+                models.websub.update()
+                .where(models.websub.c.feed_id == feed_id)
+                .where(models.websub.c.secret == request.secret)
+                .values(requested=None)
+            )
+
+
+def verify(
+    feed_id: int,
+    connection: Connection,
+    params: Mapping[Text, Text],
+    now: Optional[datetime.datetime] = None,
+) -> Optional[Text]:
+    """
+    Handle a hub's verification of intent. Returns the challenge to echo back
+    if we agree with what the hub is doing, or None if we don't.
+    """
+
+    if now is None:
+        now = datetime.datetime.utcnow()
+
+    websub = models.websub
+    row = connection.execute(
+        select([websub]).where(websub.c.feed_id == feed_id)
+    ).first()
+    mode = params.get("hub.mode")
+    ours = row is not None and row[websub.c.topic] == params.get("hub.topic")
+
+    if mode == "denied":
+        if ours:
+            connection.execute(websub.delete().where(websub.c.feed_id == feed_id))
+        return ""
+
+    challenge = params.get("hub.challenge")
+    if challenge is None:
+        return None
+
+    # Only accept a subscription we asked for, and no longer a lease than we
+    # asked for, or anyone could stop us polling a feed.
+    if mode == "subscribe" and ours and row[websub.c.requested] is not None:
+        try:
+            lease = int(params["hub.lease_seconds"])
+            if lease < 0:
+                return None
+            lease = min(lease, appconfig.WEBSUB_LEASE_SECONDS)
+            expires = now + datetime.timedelta(seconds=lease)
+        except (KeyError, ValueError, OverflowError):
+            return None
+        connection.execute(
+            websub.update()
+            .where(websub.c.feed_id == feed_id)
+            .values(expires=expires, requested=None)
+        )
+        return challenge
+
+    # Confirm unsubscribing from anything we aren't subscribed to anymore.
+    if mode == "unsubscribe" and not ours:
+        return challenge
+
+    return None
+
+
+def authentic(
+    feed_id: int, connection: Connection, body: bytes, signature: Optional[Text]
+) -> bool:
+    """
+    Check the X-Hub-Signature on a notification against the secret we gave
+    the hub for this feed.
+    """
+
+    if signature is None or "=" not in signature:
+        return False
+    method, _, digest = signature.partition("=")
+    hash_function = SIGNATURE_METHODS.get(method.lower())
+    if hash_function is None:
+        return False
+
+    secret = connection.execute(
+        select([models.websub.c.secret]).where(models.websub.c.feed_id == feed_id)
+    ).scalar()
+    if secret is None:
+        return False
+
+    expected = hmac.new(secret.encode(), body, hash_function).hexdigest()
+    return hmac.compare_digest(expected, digest.lower())
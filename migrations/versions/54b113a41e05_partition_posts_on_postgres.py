@@ -0,0 +1,38 @@
+"""partition posts on postgres
+
+Revision ID: 54b113a41e05
+Revises: 2b981b56b47d
+Create Date: 2026-10-19 15:16:44.984780
+
+"""
+from alembic import op
+from crawl_rss import appconfig
+from crawl_rss.partitioning import is_partitioned_sql, rebuild_statements
+
+
+# revision identifiers, used by Alembic.
+revision = "54b113a41e05"
+down_revision = "2b981b56b47d"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Partitioning is optional, and only makes sense on PostgreSQL.
+    connection = op.get_bind()
+    if connection.dialect.name != "postgresql" or appconfig.POST_PARTITIONS <= 0:
+        return
+    if connection.execute(is_partitioned_sql()).scalar():
+        return
+    for statement in rebuild_statements(appconfig.POST_PARTITIONS):
+        op.execute(statement)
+
+
+def downgrade():
+    connection = op.get_bind()
+    if connection.dialect.name != "postgresql":
+        return
+    if not connection.execute(is_partitioned_sql()).scalar():
+        return
+    for statement in rebuild_statements(0):
+        op.execute(statement)